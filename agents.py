@@ -1,12 +1,14 @@
 import os
 from crewai import Agent
-from llms import llm
+from llms import create_llm
 
-kubernetes_api_agent = Agent(
-    role="Kubernetes API simulator",
-    goal="Answer user requests mimicing Kubernetes API",
-    backstory="You are an application that mimics Kubernetes API for educational purposes.",
-    llm=llm,
-    verbose=False,
-    allow_delegation=False
-)
\ No newline at end of file
+
+def create_kubernetes_api_agent(agent_llm=None):
+    return Agent(
+        role="Kubernetes API simulator",
+        goal="Answer user requests mimicing Kubernetes API",
+        backstory="You are an application that mimics Kubernetes API for educational purposes.",
+        llm=agent_llm or create_llm(),
+        verbose=False,
+        allow_delegation=False
+    )
@@ -1,5 +1,9 @@
 import os
 import logging
+import time
+
+startup_started = time.perf_counter()
+
 from flask import Flask
 from models import db
 
@@ -17,12 +21,25 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
 database_url = os.environ.get('DATABASE_URL')
 
-# Use connection pooling URL
-if '-pooler' not in database_url:
-    database_url = database_url.replace('.connect.', '-pooler.connect.')
+
+def pooler_url(url):
+    # Use connection pooling URL
+    if '-pooler' not in url:
+        url = url.replace('.connect.', '-pooler.connect.')
+    return url
+
+
+database_url = pooler_url(database_url)
+# Read replicas get their own binds; Flask-SQLAlchemy keeps one engine and
+# pool per bind for the whole process (see database.read_engine)
+replica_urls = [
+    pooler_url(url.strip())
+    for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+]
 
 app.config.update(
     SQLALCHEMY_DATABASE_URI=database_url,
+    SQLALCHEMY_BINDS={f'replica{i}': url for i, url in enumerate(replica_urls)},
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
     SQLALCHEMY_ENGINE_OPTIONS={
         'pool_size': 5,
@@ -42,7 +59,8 @@ logger.info(f"Database SSL mode required: {ssl_required}")
 # Initialize SQLAlchemy
 db.init_app(app)
 with app.app_context():
-    db.create_all()
+    # Replicas follow the primary's schema, only create tables there
+    db.create_all(bind_key=None)
     # Test database connection
     from models import check_connection
     check_connection(app)
@@ -56,3 +74,14 @@ def web_index():
 
 # Import routes after app initialization
 from routes import *  # noqa: E402
+
+# The LLM stack is imported on the first cache miss unless preloaded here,
+# e.g. for gunicorn --preload so forked workers share it
+from crew_pool import crew_pool  # noqa: E402
+
+if os.getenv('PRELOAD_LLM', 'false').lower() in ('true', '1'):
+    crew_pool.preload()
+logger.info(
+    f"Startup took {time.perf_counter() - startup_started:.2f}s (LLM stack "
+    + (f"loaded in {crew_pool.import_seconds:.2f}s)"
+       if crew_pool.import_seconds is not None else "deferred)"))
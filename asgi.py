@@ -0,0 +1,394 @@
+"""
+Asyncio serving mode.
+
+The /api, /apis, /openapi and /version routes are handled natively here:
+cache hits are answered on the event loop, database lookups and LLM
+generations are awaited on thread pools, so a slow Crew kickoff never pins a
+worker. Everything else is passed through to the Flask app.
+
+Run with e.g.:
+    uvicorn asgi:application --workers 3
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+"""
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, logger
+from cache import response_cache, load_cached_response, cache_control_for, etag_matches
+from models import rate_limiter
+from metrics import rejected_requests
+from deadline import Deadline, DeadlineExceeded
+from simulator import llm_flight, prefetcher, start_generation
+from store import object_store, parse_resource_path
+from selector import SELECTOR_PARAMS, SelectorError, list_selector, without_selectors
+from discovery import AGGREGATED_MEDIA_TYPE, negotiate, get_aggregated_discovery
+from watch import is_watch, can_watch, async_watch_events, WatchParams
+from utils import parse_bearer_token, client_ip
+
+flask_application = WsgiToAsgi(app)
+
+# Sized like the SQLAlchemy pool (pool_size + max_overflow) so lookups queue
+# here instead of on the pool
+db_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('ASGI_DB_THREADS', 15)),
+    thread_name_prefix='db')
+
+READ_ONLY_EXACT = ('/api', '/apis', '/version')
+READ_ONLY_PREFIXES = ('/openapi/', )
+ALL_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'PATCH')
+
+
+def allowed_methods(path):
+    """Methods served natively for a path, or None to fall back to Flask"""
+    if path.startswith(('/api/', '/apis/')):
+        return ALL_METHODS
+    if path in READ_ONLY_EXACT or path.startswith(READ_ONLY_PREFIXES):
+        return ('GET', )
+    return None
+
+
+async def send_body(send, body, status=200, headers=(),
+                    content_type='application/json'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()),
+                    (b'content-length', str(len(body)).encode()), *headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, payload, status=200):
+    await send_body(send, json.dumps(payload).encode(), status)
+
+
+async def send_cached(send, cached, api_path, headers,
+                      content_type='application/json'):
+    """
+    Send a cached body as stored, precompressed if the client accepts it,
+    or a 304 if the client's copy is still current
+    """
+    encoding, body, etag = cached.encode_for(headers.get('accept-encoding'))
+    response_headers = [
+        (b'etag', etag.encode()),
+        (b'cache-control', cache_control_for(api_path).encode()),
+        (b'vary', b'Accept, Accept-Encoding')
+    ]
+    if etag_matches(headers.get('if-none-match'), etag):
+        await send({
+            'type': 'http.response.start',
+            'status': 304,
+            'headers': response_headers
+        })
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    if encoding:
+        response_headers.append((b'content-encoding', encoding.encode()))
+    await send_body(send, body, headers=response_headers,
+                    content_type=content_type)
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def rate_limit_payload():
+    return {
+        'error':
+        'Rate limit exceeded',
+        'message':
+        f'Please try again later. Limit is {rate_limiter.requests_per_minute} requests per minute to non-cached endpoints.'
+    }
+
+
+async def check_rate_limit(auth_token, ip_address, deadline):
+    deadline.check('rate limit check')
+    if not rate_limiter.blocking:
+        return rate_limiter.check(auth_token, ip_address)
+    return await asyncio.wait_for(
+        asyncio.get_running_loop().run_in_executor(
+            db_executor, rate_limiter.check, auth_token, ip_address),
+        deadline.remaining())
+
+
+async def wait_for_generation(generation, deadline):
+    """Await a generation future until the request deadline"""
+    try:
+        return await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(generation)),
+            deadline.remaining())
+    except asyncio.TimeoutError:
+        if generation.done():
+            raise
+        llm_flight.abandon(generation)
+        raise DeadlineExceeded('Deadline exceeded waiting for generation')
+
+
+async def stream_watch(scope, receive, send, auth_token, query_args,
+                       ip_address, deadline):
+    """
+    Stream WatchEvents as NDJSON. The watch only holds an asyncio queue
+    while idle and ends when the client disconnects.
+    """
+    api_path = scope['path']
+    ref = parse_resource_path(api_path)
+    if ref is None or ref.subresource is not None:
+        return await send_json(
+            send, {'error': 'Watch is only supported on resources'}, 400)
+    if not can_watch():
+        rejected_requests.inc('watches')
+        return await send_json(send, {'error': 'Too many open watches'}, 429)
+
+    try:
+        params = WatchParams(query_args, deadline)
+    except SelectorError as e:
+        return await send_json(send, {'error': 'Invalid selector',
+                                      'message': str(e)}, 400)
+    except ValueError:
+        return await send_json(send,
+                               {'error': 'Invalid timeoutSeconds value'}, 400)
+
+    # A watch without a resourceVersion starts with the current objects, so
+    # make sure the collection was listed at least once
+    loop = asyncio.get_running_loop()
+    list_path = api_path.rsplit('/', 1)[0] if ref.name else api_path
+    if params.resource_version in (None, '', '0'):
+        has_collection = await loop.run_in_executor(
+            db_executor, object_store.has_collection, auth_token, list_path)
+        if not has_collection:
+            cached_response = await asyncio.wait_for(
+                loop.run_in_executor(db_executor, lookup_cached_response,
+                                     auth_token, list_path, deadline),
+                deadline.remaining())
+            if cached_response is not None:
+                await loop.run_in_executor(db_executor, object_store.ingest,
+                                           auth_token, list_path,
+                                           cached_response.json())
+            elif not await check_rate_limit(auth_token, ip_address, deadline):
+                return await send_json(send, rate_limit_payload(), 429)
+            else:
+                await wait_for_generation(
+                    start_generation(auth_token, 'GET', list_path, '', {}),
+                    deadline)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/json')]
+    })
+
+    async def stream():
+        async for chunk in async_watch_events(auth_token, api_path, params,
+                                              db_executor):
+            await send({
+                'type': 'http.response.body',
+                'body': chunk,
+                'more_body': True
+            })
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    streaming = asyncio.ensure_future(stream())
+    watching = asyncio.ensure_future(disconnected())
+    await asyncio.wait([streaming, watching],
+                       return_when=asyncio.FIRST_COMPLETED)
+    for task in (streaming, watching):
+        task.cancel()
+    await asyncio.gather(streaming, watching, return_exceptions=True)
+    if watching.cancelled():
+        # The watch ended on our side, close the response
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def lookup_cached_response(auth_token, api_path, deadline):
+    with app.app_context():
+        return load_cached_response(auth_token, api_path, deadline)
+
+
+def lookup_aggregated_discovery(auth_token, api_path, version):
+    with app.app_context():
+        return get_aggregated_discovery(auth_token, api_path, version)
+
+
+async def handle_dynamic_path(scope, receive, send):
+    method = scope['method']
+    api_path = scope['path']
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+               for k, v in scope['headers']}
+
+    if method not in allowed_methods(api_path):
+        return await send_json(send, {'error': 'Method not allowed'}, 405)
+
+    auth_token, error = parse_bearer_token(headers.get('authorization'))
+    if error:
+        return await send_json(send, {'error': error}, 401)
+
+    query_string = scope.get('query_string', b'').decode()
+    query_args = {k: v[0] for k, v in parse_qs(query_string).items()}
+
+    # Get timeout from query parameter (e.g., ?timeout=30s)
+    try:
+        deadline = Deadline.from_param(query_args.get('timeout', ''))
+    except ValueError:
+        return await send_json(
+            send, {
+                'error':
+                'Invalid timeout value',
+                'message':
+                'Timeout must be a positive duration (e.g., 30, 30s, 1m30s or 500ms)'
+            }, 400)
+
+    body = await read_body(receive)
+    content_type = headers.get('content-type', '')
+    json_body = None
+    if method in ('POST', 'PUT', 'PATCH'):
+        mimetype = content_type.split(';')[0].strip()
+        if not (mimetype == 'application/json' or mimetype.endswith('+json')):
+            return await send_json(
+                send, {
+                    'error': 'Invalid request',
+                    'details': 'Content-Type must be application/json'
+                }, 400)
+        try:
+            json_body = json.loads(body or b'null')
+        except ValueError:
+            return await send_json(send, {
+                'error': 'Invalid request',
+                'details': 'Invalid JSON body'
+            }, 400)
+
+    # Label and field selectors filter the collection's full list locally,
+    # wherever it comes from
+    selector = None
+    if method == 'GET' and not is_watch(query_args):
+        try:
+            selector = list_selector(api_path, query_args)
+        except SelectorError as e:
+            return await send_json(send, {'error': 'Invalid selector',
+                                          'message': str(e)}, 400)
+
+    logger.debug(f"Received async {method} request for path: {api_path}")
+
+    try:
+        loop = asyncio.get_running_loop()
+
+        ip_address = client_ip(headers.get('x-forwarded-for'),
+                               scope['client'][0] if scope.get('client') else None)
+        prefetcher.touch(auth_token)
+
+        if method == 'GET' and is_watch(query_args):
+            return await stream_watch(scope, receive, send, auth_token,
+                                      query_args, ip_address, deadline)
+
+        # kubectl asks /api and /apis for everything in one document
+        discovery_version = (negotiate(headers.get('accept'))
+                             if api_path in ('/api', '/apis') else None)
+        if discovery_version:
+            aggregated = await asyncio.wait_for(
+                loop.run_in_executor(db_executor, lookup_aggregated_discovery,
+                                     auth_token, api_path, discovery_version),
+                deadline.remaining())
+            if aggregated is not None:
+                return await send_cached(
+                    send, aggregated, api_path, headers,
+                    AGGREGATED_MEDIA_TYPE.format(discovery_version))
+
+        # Objects this token already has are answered (or changed) by the
+        # store, which checks the database for other workers' changes
+        if method == 'GET':
+            local_response = await asyncio.wait_for(
+                loop.run_in_executor(db_executor, object_store.lookup,
+                                     auth_token, api_path),
+                deadline.remaining())
+        else:
+            local_response = await asyncio.wait_for(
+                loop.run_in_executor(db_executor, object_store.mutate,
+                                     auth_token, method, api_path, json_body,
+                                     content_type), deadline.remaining())
+        if local_response is not None:
+            if selector is not None:
+                return await send_json(send, selector.filter_list(local_response[0]),
+                                       local_response[1])
+            return await send_json(send, *local_response)
+
+        # Hot entries are answered straight from memory on the event loop
+        cached_response = response_cache.get(auth_token, api_path)
+        if cached_response is None:
+            cached_response = await asyncio.wait_for(
+                loop.run_in_executor(db_executor, lookup_cached_response,
+                                     auth_token, api_path, deadline),
+                deadline.remaining())
+        if cached_response is not None:
+            if method == 'GET' and parse_resource_path(api_path):
+                await loop.run_in_executor(db_executor, object_store.ingest,
+                                           auth_token, api_path,
+                                           cached_response.json())
+            if selector is not None:
+                return await send_json(
+                    send, selector.filter_list(cached_response.json()))
+            return await send_cached(send, cached_response, api_path,
+                                     headers)
+
+        # Check rate limit for both token and IP
+        if not await check_rate_limit(auth_token, ip_address, deadline):
+            return await send_json(send, rate_limit_payload(), 429)
+
+        # If not in cache, generate response (the unfiltered list, if
+        # selected). The generation keeps running for other waiters even if
+        # this request gives up on it.
+        if selector is not None:
+            query_string = without_selectors(query_string)
+            query_args = {k: v for k, v in query_args.items()
+                          if k not in SELECTOR_PARAMS}
+        generation = start_generation(auth_token, method, api_path,
+                                      query_string, query_args)
+        simulated_response = await wait_for_generation(generation, deadline)
+        if selector is not None:
+            simulated_response = selector.filter_list(simulated_response)
+        return await send_json(send, simulated_response)
+
+    except (DeadlineExceeded, asyncio.TimeoutError) as e:
+        logger.info(f"Request for {api_path} timed out: {str(e)}")
+        return await send_json(send, {
+            'error': 'Timeout',
+            'message': f'Request timed out after {deadline.timeout} seconds'
+        }, 408)
+
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}")
+        return await send_json(send, {
+            'error': 'Internal server error',
+            'message': str(e)
+        }, 500)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and allowed_methods(scope['path']):
+        return await handle_dynamic_path(scope, receive, send)
+
+    return await flask_application(scope, receive, send)
@@ -0,0 +1,360 @@
+"""
+Replay kubectl-like traffic against KAISim and report latency per route.
+
+By default a local copy of the app is started in a child process on a
+throwaway SQLite database (or --database), with the LLM replaced by a stub
+that sleeps for --llm-latency seconds, so no LLM calls are paid for.
+--url benchmarks an already running instance instead.
+
+Every simulated kubectl session uses its own token and starts with the
+discovery sweep of fetch_predefined_api.py, then runs --requests gets,
+lists and creates. --concurrency sessions run at once.
+
+    python benchmark.py --sessions 50 --concurrency 10 --json results.json
+    python benchmark.py --baseline results.json   # exits 1 on a p95 regression
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+import requests
+
+from fetch_predefined_api import discover_paths, make_session
+
+AGGREGATED_ACCEPT = ('application/json;g=apidiscovery.k8s.io;v=v2;as=APIGroupDiscoveryList,'
+                     'application/json;g=apidiscovery.k8s.io;v=v2beta1;as=APIGroupDiscoveryList,'
+                     'application/json')
+
+# (group, version, resource, kind) the replayed sessions work with; jobs
+# have no local template, so they always go to the (stub) LLM
+RESOURCES = [
+    ('', 'v1', 'pods', 'Pod'),
+    ('', 'v1', 'services', 'Service'),
+    ('', 'v1', 'configmaps', 'ConfigMap'),
+    ('apps', 'v1', 'deployments', 'Deployment'),
+    ('batch', 'v1', 'jobs', 'Job'),
+]
+NAMESPACES = ['default', 'kube-system', 'staging', 'production']
+PERCENTILES = (50, 95, 99)
+
+
+def api_version(group, version):
+    return f'{group}/{version}' if group else version
+
+
+def group_version_path(group, version):
+    return f'/apis/{group}/{version}' if group else f'/api/{version}'
+
+
+def stub_response(method, path):
+    """A minimal but well-formed answer for the stub LLM"""
+    groups = {}
+    for group, version, resource, kind in RESOURCES:
+        groups.setdefault((group, version), []).append((resource, kind))
+
+    if path == '/api':
+        return {'kind': 'APIVersions', 'versions': ['v1'],
+                'serverAddressByClientCIDRs': []}
+    if path == '/apis':
+        return {'kind': 'APIGroupList', 'apiVersion': 'v1', 'groups': [{
+            'name': group,
+            'versions': [{'groupVersion': f'{group}/{version}', 'version': version}],
+            'preferredVersion': {'groupVersion': f'{group}/{version}', 'version': version}
+        } for group, version in groups if group]}
+    for (group, version), resources in groups.items():
+        if path == group_version_path(group, version):
+            return {'kind': 'APIResourceList', 'apiVersion': 'v1',
+                    'groupVersion': api_version(group, version),
+                    'resources': [{
+                        'name': resource, 'singularName': kind.lower(),
+                        'namespaced': True, 'kind': kind,
+                        'verbs': ['create', 'delete', 'get', 'list', 'patch', 'update', 'watch']
+                    } for resource, kind in resources]}
+    if path.startswith('/openapi'):
+        return {'paths': {}} if path == '/openapi/v3' else {}
+
+    parts = [p for p in path.split('?')[0].split('/') if p]
+    kinds = {resource: kind for _, _, resource, kind in RESOURCES}
+    if parts and parts[-1] in kinds:
+        return {'kind': f'{kinds[parts[-1]]}List', 'apiVersion': 'v1',
+                'metadata': {'resourceVersion': '1'}, 'items': []}
+    if len(parts) >= 2 and parts[-2] in kinds:
+        namespace = parts[parts.index('namespaces') + 1] if 'namespaces' in parts else None
+        return {'kind': kinds[parts[-2]], 'apiVersion': 'v1',
+                'metadata': {'name': parts[-1], 'namespace': namespace,
+                             'resourceVersion': '1'}}
+    return {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success'}
+
+
+class StubCrew:
+    """Stands in for a pooled crewai Crew: sleeps like an LLM call, then answers"""
+
+    def __init__(self, latency, jitter):
+        self.latency = latency
+        self.jitter = jitter
+
+    def kickoff(self, inputs):
+        sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        body = stub_response(inputs['request_type'], inputs['api_endpoint'])
+        return SimpleNamespace(raw='```json\n' + json.dumps(body) + '\n```',
+                               token_usage=None)
+
+
+def serve(args):
+    """Child process: run the app with the stub LLM and print its URL"""
+    os.environ['DATABASE_URL'] = args.database
+    os.environ['RATE_LIMIT_PER_MINUTE'] = str(args.rate_limit)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if args.no_templates:
+        os.environ['TEMPLATE_GENERATOR'] = 'false'
+
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+    from crew_pool import crew_pool
+    from database import bulk_upsert_cache
+
+    crew_pool._build = lambda: StubCrew(args.llm_latency, args.llm_jitter)
+    if args.predefined:
+        with open(args.predefined) as f:
+            entries = json.load(f)['entries']
+        with app.app_context():
+            bulk_upsert_cache({'api_path': entry['api_path'],
+                               'response': json.dumps(entry['response']),
+                               'is_predefined': True} for entry in entries)
+
+    # Per-request access logs would dominate the measurement
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    print(f'http://127.0.0.1:{server.server_port}', flush=True)
+    # Nobody reads our stdout from here on
+    sys.stdout = sys.stderr
+    server.serve_forever()
+
+
+def start_local_app(args):
+    """Start the app in a child process so it does not share our GIL"""
+    command = [sys.executable, os.path.abspath(__file__), '--serve',
+               '--database', args.database,
+               '--rate-limit', str(args.rate_limit),
+               '--llm-latency', str(args.llm_latency),
+               '--llm-jitter', str(args.llm_jitter)]
+    if args.predefined:
+        command += ['--predefined', os.path.abspath(args.predefined)]
+    if args.no_templates:
+        command.append('--no-templates')
+    child = subprocess.Popen(command, stdout=subprocess.PIPE, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in child.stdout:
+        if line.startswith('http'):
+            return line.strip(), child
+    child.wait()
+    raise RuntimeError('Local app failed to start')
+
+
+class Recorder:
+    """Latencies and statuses per route, shared by the session threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            counts = self.statuses.setdefault(route, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def summary(self, elapsed):
+        routes = {}
+        with self.lock:
+            items = [(route, sorted(values), dict(self.statuses[route]))
+                     for route, values in self.latencies.items()]
+        for route, values, statuses in sorted(items):
+            errors = sum(count for status, count in statuses.items()
+                         if status == 'error' or int(status) >= 500)
+            routes[route] = {
+                'requests': len(values),
+                'errors': errors,
+                'rps': len(values) / elapsed,
+                **{f'p{p}': percentile(values, p) * 1000 for p in PERCENTILES},
+                'max': values[-1] * 1000,
+                'statuses': {str(status): count for status, count in statuses.items()}
+            }
+        return routes
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))]
+
+
+def timed(session, recorder, route, method, url, **kwargs):
+    started = perf_counter()
+    try:
+        response = session.request(method, url, timeout=120, **kwargs)
+        status = response.status_code
+    except requests.exceptions.RequestException:
+        response, status = None, 'error'
+    recorder.record(route, perf_counter() - started, status)
+    return response
+
+
+def manifest(kind, group, version, name):
+    body = {'apiVersion': api_version(group, version), 'kind': kind,
+            'metadata': {'name': name, 'labels': {'app': name}}}
+    if kind == 'ConfigMap':
+        body['data'] = {'key': 'value'}
+    return body
+
+
+def run_session(base_url, args, recorder, seed):
+    """One kubectl user: discovery sweep, then gets, lists and creates"""
+    rng = random.Random(seed)
+    session = make_session(str(uuid.uuid4()), workers=1, retries=0)
+
+    for path in ('/api', '/apis'):
+        timed(session, recorder, 'discovery', 'GET', base_url + path,
+              headers={'Accept': AGGREGATED_ACCEPT})
+    try:
+        paths = discover_paths(session, base_url)
+    except (requests.exceptions.RequestException, ValueError):
+        paths = []
+    for path in paths:
+        route = 'openapi' if path.startswith('/openapi') else 'discovery'
+        timed(session, recorder, route, 'GET', base_url + path)
+
+    operations = ['get', 'list', 'create']
+    weights = [args.get_weight, args.list_weight, args.create_weight]
+    created = {}
+    for _ in range(args.requests):
+        group, version, resource, kind = rng.choice(RESOURCES)
+        namespace = rng.choice(NAMESPACES)
+        collection = f'{group_version_path(group, version)}/namespaces/{namespace}/{resource}'
+        operation = rng.choices(operations, weights)[0]
+        if operation == 'list':
+            timed(session, recorder, 'list', 'GET', base_url + collection)
+        elif operation == 'create':
+            name = f'bench-{rng.randrange(1 << 32):08x}'
+            response = timed(session, recorder, 'create', 'POST', base_url + collection,
+                             json=manifest(kind, group, version, name))
+            if response is not None and response.status_code < 300:
+                created.setdefault(collection, []).append(name)
+        else:
+            names = created.get(collection) or [f'web-{rng.randrange(5)}']
+            timed(session, recorder, 'get', 'GET',
+                  f'{base_url}{collection}/{rng.choice(names)}')
+
+
+def print_report(routes, elapsed, out=sys.stdout):
+    total = sum(r['requests'] for r in routes.values())
+    print(f"{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)", file=out)
+    print(f"{'route':<10} {'requests':>8} {'errors':>6} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}", file=out)
+    for route, r in routes.items():
+        print(f"{route:<10} {r['requests']:>8} {r['errors']:>6} {r['rps']:>8.1f} "
+              f"{r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f} {r['max']:>8.1f}",
+              file=out)
+
+
+def regressions(routes, baseline, tolerance):
+    """Routes whose p95 grew by more than tolerance over the baseline"""
+    found = []
+    for route, r in routes.items():
+        before = baseline.get('routes', {}).get(route)
+        if before and r['p95'] > before['p95'] * (1 + tolerance):
+            found.append(f"{route}: p95 {r['p95']:.1f}ms, was {before['p95']:.1f}ms")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay kubectl-like traffic against KAISim with a stub LLM "
+                    "and report p50/p95/p99 and requests/second per route")
+    parser.add_argument('--url', help="benchmark a running instance instead of starting one")
+    parser.add_argument('--database', help="database URL for the local app (default: a temporary SQLite file)")
+    parser.add_argument('--predefined', help="predefined_cache.json to load into the local app's database")
+    parser.add_argument('--sessions', type=int, default=20, help="kubectl sessions to replay")
+    parser.add_argument('--concurrency', type=int, default=8, help="sessions running at once")
+    parser.add_argument('--requests', type=int, default=50, help="gets, lists and creates per session after discovery")
+    parser.add_argument('--get-weight', type=float, default=5, help="relative share of gets")
+    parser.add_argument('--list-weight', type=float, default=3, help="relative share of lists")
+    parser.add_argument('--create-weight', type=float, default=1, help="relative share of creates")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="seconds per stub LLM call")
+    parser.add_argument('--llm-jitter', type=float, default=0.1, help="standard deviation of the stub LLM latency")
+    parser.add_argument('--no-templates', action='store_true', help="send every miss to the stub LLM")
+    parser.add_argument('--rate-limit', type=int, default=-1, help="RATE_LIMIT_PER_MINUTE of the local app (-1: unlimited)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the replayed traffic")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare p95 against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 growth over the baseline")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve(args)
+
+    child = None
+    temp_dir = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        if not args.database:
+            temp_dir = tempfile.TemporaryDirectory(prefix='kaisim-bench-')
+            args.database = f"sqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+        base_url, child = start_local_app(args)
+
+    try:
+        recorder = Recorder()
+        started = perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for future in [executor.submit(run_session, base_url, args, recorder, args.seed + i)
+                           for i in range(args.sessions)]:
+                future.result()
+        elapsed = perf_counter() - started
+
+        routes = recorder.summary(elapsed)
+        print_report(routes, elapsed)
+        try:
+            server_stats = requests.get(f'{base_url}/cache/stats', timeout=10).json()
+        except (requests.exceptions.RequestException, ValueError):
+            server_stats = None
+    finally:
+        if child is not None:
+            child.terminate()
+            child.wait()
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    results = {'elapsed': elapsed, 'settings': {
+        k: v for k, v in vars(args).items()
+        if k not in ('json', 'baseline', 'serve', 'database')
+    }, 'routes': routes, 'server': server_stats}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(routes, json.load(f), args.tolerance)
+        for line in found:
+            print(f"Regression: {line}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
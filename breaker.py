@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from sqlalchemy.exc import (DisconnectionError, InterfaceError,
+                            OperationalError, TimeoutError as PoolTimeoutError)
+
+logger = logging.getLogger(__name__)
+
+# Errors that say the database is unhealthy, not that a query was wrong
+DATABASE_ERRORS = (OperationalError, InterfaceError, DisconnectionError,
+                   PoolTimeoutError)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of touching a database the breaker considers down"""
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the database is unhealthy.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    every guarded call raises CircuitOpenError at once instead of waiting
+    on connect or statement timeouts. After `reset_timeout` seconds one
+    probe call is let through (half-open); it closes the breaker again if
+    it succeeds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    def is_open(self):
+        """Whether calls are currently refused (without claiming a probe)"""
+        with self.lock:
+            return self.state != 'closed' and (
+                self.probing or monotonic() - self.opened_at < self.reset_timeout)
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if not self.probing and monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                logger.info(f"Circuit breaker {self.name} closed")
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def release(self):
+        """Give up a probe without judging the database"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'closed' and self.failures < self.failure_threshold:
+                return
+            if self.state == 'closed':
+                logger.warning(f"Circuit breaker {self.name} opened after "
+                               f"{self.failures} failures")
+                self.opened += 1
+            self.state = 'open'
+            self.opened_at = monotonic()
+            self.probing = False
+
+    @contextmanager
+    def guard(self, deadline=None):
+        """
+        Run a block against the database. Failures caused by the caller's
+        own deadline running out do not count against the database.
+        """
+        if getattr(self.local, 'depth', 0):
+            # Already inside a guarded block, which does the accounting
+            yield
+            return
+
+        if not self.allow():
+            raise CircuitOpenError(f'{self.name} is unavailable')
+        self.local.depth = 1
+        try:
+            yield
+        except DATABASE_ERRORS:
+            if deadline is not None and deadline.expired():
+                self.release()
+            else:
+                self.record_failure()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        finally:
+            self.local.depth = 0
+        self.record_success()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'open_for': monotonic() - self.opened_at if self.state != 'closed' else 0.0
+            }
+
+
+db_breaker = CircuitBreaker(
+    'database',
+    failure_threshold=int(os.getenv('DB_BREAKER_THRESHOLD', 5)),
+    reset_timeout=float(os.getenv('DB_BREAKER_RESET', 30)))
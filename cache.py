@@ -0,0 +1,550 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter, sleep
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from breaker import CircuitOpenError, db_breaker
+from deadline import DeadlineExceeded
+from metrics import cache_lookup_seconds, cache_lookups, path_prefix
+from database import execute_read, note_write, read_engine
+from models import db, APICache, CacheInvalidation
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_MIN_BYTES = int(os.getenv('CACHE_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.getenv('CACHE_GZIP_LEVEL', 6))
+# Preferred first when a client accepts several
+ENCODINGS = ('zstd', 'gzip')
+# How long clients may reuse discovery and OpenAPI documents unrevalidated
+DISCOVERY_MAX_AGE = int(os.getenv('DISCOVERY_MAX_AGE', 60))
+
+
+def accepted_encodings(accept_encoding):
+    """The content codings an Accept-Encoding header allows (q > 0)"""
+    accepted = set()
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    if '*' in accepted:
+        accepted.update(ENCODINGS)
+    return accepted
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def cache_control_for(api_path):
+    """
+    Discovery and OpenAPI documents rarely change, so clients may keep them
+    for a while; cached resource responses must be revalidated.
+    """
+    parts = [p for p in api_path.split('/') if p]
+    discovery = (parts[:1] in (['openapi'], ['version']) or
+                 (parts[:1] == ['api'] and len(parts) <= 2) or
+                 (parts[:1] == ['apis'] and len(parts) <= 3))
+    if discovery and DISCOVERY_MAX_AGE > 0:
+        return f'private, max-age={DISCOVERY_MAX_AGE}'
+    return 'private, no-cache'
+
+
+class CachedBody:
+    """
+    A cached JSON response, serialized once. Bodies large enough to be
+    worth it also keep gzip (and, with zstandard installed, zstd) variants
+    so hits are served without re-encoding or compressing. The content hash
+    ETag is computed once along with them; compressed variants add their
+    coding to it.
+    """
+
+    __slots__ = ('body', 'variants', 'etag', '__weakref__')
+
+    def __init__(self, text):
+        self.body = text.encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.variants = {}
+        if len(self.body) >= COMPRESS_MIN_BYTES:
+            self.variants['gzip'] = gzip.compress(self.body,
+                                                  compresslevel=GZIP_LEVEL)
+            if zstandard is not None:
+                self.variants['zstd'] = zstandard.ZstdCompressor().compress(
+                    self.body)
+
+    def json(self):
+        return json.loads(self.body)
+
+    def encode_for(self, accept_encoding):
+        """
+        Pick the smallest variant the client accepts: (coding, bytes, ETag).
+        Compressed variants are different bytes, so each has its own ETag.
+        """
+        if self.variants:
+            accepted = accepted_encodings(accept_encoding)
+            for coding in ENCODINGS:
+                if coding in accepted and coding in self.variants:
+                    return (coding, self.variants[coding],
+                            f'{self.etag[:-1]}-{coding}"')
+        return None, self.body, self.etag
+
+    def size(self):
+        return len(self.body) + sum(len(v) for v in self.variants.values())
+
+
+class ResponseCache:
+    """
+    Bounded in-process LRU cache with per-entry TTL for APICache responses.
+
+    Entries are keyed on (user_token, api_path) so a user's own entries keep
+    shadowing predefined ones exactly like the database lookup does.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def get(self, token, api_path):
+        key = (str(token), api_path)
+        started = perf_counter()
+        now = monotonic()
+
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                self.misses += 1
+                value = None
+            elif item[0] <= now:
+                # Kept until evicted, to be served stale if the database is down
+                self.misses += 1
+                value = None
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                value = item[1]
+
+        cache_lookup_seconds.observe(perf_counter() - started, 'memory')
+        if value is not None:
+            cache_lookups.inc(path_prefix(api_path), 'memory')
+        return value
+
+    def get_stale(self, token, api_path):
+        """Return an entry even if it expired; for degraded mode only"""
+        with self.lock:
+            item = self.entries.get((str(token), api_path))
+            if item is None:
+                return None
+            self.stale_hits += 1
+            return item[1]
+
+    def contains(self, token, api_path):
+        """Check for a live entry without touching the LRU order or counters"""
+        with self.lock:
+            item = self.entries.get((str(token), api_path))
+            return item is not None and item[0] > monotonic()
+
+    def set(self, token, api_path, value):
+        if self.max_entries <= 0:
+            return
+
+        key = (str(token), api_path)
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, token, api_path):
+        with self.lock:
+            self.entries.pop((str(token), api_path), None)
+
+    def invalidate_path(self, api_path):
+        """Drop an api_path for every token, e.g. after a predefined change"""
+        with self.lock:
+            for key in [k for k in self.entries if k[1] == api_path]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', 300)))
+
+
+# Predefined entries are shared by every token; keep one CachedBody per
+# APICache row so e.g. the OpenAPI documents are only compressed once
+predefined_bodies = weakref.WeakValueDictionary()
+predefined_lock = threading.Lock()
+
+
+def cached_body_for(cache_entry):
+    if not cache_entry.is_predefined:
+        return CachedBody(cache_entry.response)
+    with predefined_lock:
+        body = predefined_bodies.get(cache_entry.cache_id)
+        if body is None:
+            body = predefined_bodies[cache_entry.cache_id] = CachedBody(
+                cache_entry.response)
+        return body
+
+
+class PredefinedSnapshot:
+    """
+    In-memory copy of the newest predefined APICache entry per path.
+
+    A daemon thread reloads it every `refresh_interval` seconds while the
+    database is healthy, so discovery and OpenAPI requests are still
+    answered when it is not.
+    """
+
+    def __init__(self, refresh_interval=600, retry_interval=30):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.bodies = {}
+        self.app = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.refreshed_at = None
+        self.hits = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def ensure_worker(self):
+        # Started lazily so every forked gunicorn worker gets its own thread
+        if self.refresh_interval <= 0 or self.app is None:
+            return
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run,
+                                           name='predefined-snapshot',
+                                           daemon=True)
+            self.thread.start()
+
+    def refresh(self):
+        with self.app.app_context():
+            entries = execute_read(
+                db.select(APICache).filter_by(is_predefined=True).order_by(
+                    APICache.created_at.desc())).scalars()
+            bodies = {}
+            for entry in entries:
+                if entry.api_path not in bodies:
+                    bodies[entry.api_path] = cached_body_for(entry)
+        self.bodies = bodies
+        self.refreshed_at = monotonic()
+        logger.debug(f"Refreshed {len(bodies)} predefined entries in memory")
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+                sleep(self.refresh_interval)
+            except Exception as e:
+                logger.warning(f"Could not refresh predefined entries: {str(e)}")
+                sleep(self.retry_interval)
+
+    def get(self, api_path):
+        body = self.bodies.get(api_path)
+        if body is not None:
+            self.hits += 1
+        return body
+
+    def stats(self):
+        return {
+            'size': len(self.bodies),
+            'hits': self.hits,
+            'age': monotonic() - self.refreshed_at
+                   if self.refreshed_at is not None else None
+        }
+
+
+predefined_snapshot = PredefinedSnapshot(
+    refresh_interval=float(os.getenv('DB_SNAPSHOT_REFRESH', 600)))
+
+
+class InvalidationFeed:
+    """
+    Applies the cache_invalidations log to this worker's response cache.
+
+    Every APICache write records its paths in the log. A daemon thread reads
+    the new rows every `poll_interval` seconds and drops the matching
+    in-memory responses, so a change made through one gunicorn worker
+    reaches the others within about that long rather than after
+    RESPONSE_CACHE_TTL. Callbacks added with subscribe() are called with
+    every (user_token, api_path); user_token is None for predefined paths.
+
+    Ids are taken when a row is inserted, not when it commits, so ids
+    skipped over are looked for again for `gap_timeout` seconds.
+    """
+
+    def __init__(self, poll_interval=1.0, retention=600, gap_timeout=30,
+                 max_gaps=1000):
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.gap_timeout = gap_timeout
+        self.max_gaps = max_gaps
+        self.app = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.last_id = None
+        self.gaps = {}
+        self.pruned_at = 0.0
+        self.applied = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def ensure_worker(self):
+        # Started lazily so every forked gunicorn worker gets its own thread
+        if self.poll_interval <= 0 or self.app is None:
+            return
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.last_id = None
+            self.gaps = {}
+            self.thread = threading.Thread(target=self._run,
+                                           name='cache-invalidations',
+                                           daemon=True)
+            self.thread.start()
+
+    def poll(self):
+        """Apply the rows written since the last poll"""
+        with self.app.app_context(), db_breaker.guard():
+            if self.last_id is None:
+                # Whatever happened before this worker cached anything
+                # does not concern it
+                self.last_id = db.session.execute(
+                    db.select(db.func.max(CacheInvalidation.id))).scalar() or 0
+                return
+
+            newer = CacheInvalidation.id > self.last_id
+            if self.gaps:
+                newer = db.or_(newer, CacheInvalidation.id.in_(list(self.gaps)))
+            rows = db.session.execute(
+                db.select(CacheInvalidation.id, CacheInvalidation.user_token,
+                          CacheInvalidation.api_path).where(newer).order_by(
+                              CacheInvalidation.id)).all()
+
+            now = monotonic()
+            for row in rows:
+                self.gaps.pop(row.id, None)
+                if row.id > self.last_id:
+                    for skipped in range(max(self.last_id + 1,
+                                             row.id - self.max_gaps), row.id):
+                        self.gaps[skipped] = now
+                    self.last_id = row.id
+                self.apply(row.user_token, row.api_path)
+            for gap in [g for g, seen in self.gaps.items()
+                        if now - seen > self.gap_timeout]:
+                del self.gaps[gap]
+
+            if now - self.pruned_at > self.retention / 10:
+                self.pruned_at = now
+                self._prune()
+
+    def _prune(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        # SQLite would hand out the newest id again once the table is empty
+        newest = db.select(db.func.max(CacheInvalidation.id)).scalar_subquery()
+        db.session.execute(db.delete(CacheInvalidation).where(
+            CacheInvalidation.created_at < cutoff,
+            CacheInvalidation.id < newest))
+        db.session.commit()
+
+    def apply(self, user_token, api_path):
+        if user_token is None:
+            response_cache.invalidate_path(api_path)
+        else:
+            # Until the replicas have the change too
+            note_write(user_token)
+            response_cache.invalidate(user_token, api_path)
+        for callback in self.callbacks:
+            callback(user_token, api_path)
+        self.applied += 1
+
+    def _run(self):
+        while True:
+            try:
+                if not db_breaker.is_open():
+                    self.poll()
+            except CircuitOpenError:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not read cache invalidations: {str(e)}")
+            sleep(self.poll_interval)
+
+    def stats(self):
+        return {
+            'poll_interval': self.poll_interval,
+            'last_id': self.last_id,
+            'gaps': len(self.gaps),
+            'applied': self.applied
+        }
+
+
+invalidation_feed = InvalidationFeed(
+    poll_interval=float(os.getenv('CACHE_INVALIDATION_INTERVAL', 1)))
+
+
+def degraded_response(user_token, api_path):
+    """
+    What to serve while the database is down: the last in-memory response
+    for the path, even if it expired, or the predefined snapshot
+    """
+    response = response_cache.get_stale(user_token, api_path)
+    if response is None:
+        response = predefined_snapshot.get(api_path)
+    return response
+
+
+def get_cached_response(user_token, api_path, deadline=None):
+    """
+    Return the CachedBody for a path, checking memory first, then the
+    user's APICache entries and finally the predefined ones.
+    """
+    response = response_cache.get(user_token, api_path)
+    if response is not None:
+        return response
+    return load_cached_response(user_token, api_path, deadline)
+
+
+def apply_statement_timeout(deadline, bind=None):
+    """Bound the queries of the current transaction by the request deadline"""
+    remaining = deadline.remaining()
+    bind = bind or db.engine
+    if remaining is None or bind.dialect.name != 'postgresql':
+        return
+    db.session.execute(
+        text(f"SET LOCAL statement_timeout = {max(1, int(remaining * 1000))}"),
+        bind_arguments={'bind': bind})
+
+
+def find_cache_entry(user_token, api_path, bind, deadline=None):
+    """The user's newest APICache entry for a path, else the predefined one"""
+    if deadline is not None:
+        apply_statement_timeout(deadline, bind)
+
+    # First try to find user's cache entry
+    cache_entry = execute_read(
+        db.select(APICache).filter_by(
+            api_path=api_path,
+            user_token=uuid.UUID(str(user_token))).order_by(
+                APICache.created_at.desc()).limit(1), bind,
+        deadline).scalars().first()
+
+    # If no user cache found, look for predefined entry
+    if not cache_entry:
+        cache_entry = execute_read(
+            db.select(APICache).filter_by(
+                api_path=api_path, is_predefined=True).order_by(
+                    APICache.created_at.desc()).limit(1), bind,
+            deadline).scalars().first()
+    return cache_entry
+
+
+def load_cached_response(user_token, api_path, deadline=None):
+    """
+    Look a path up in APICache and remember the result in memory. While the
+    database circuit is open, serve degraded_response() instead.
+    """
+    predefined_snapshot.ensure_worker()
+    invalidation_feed.ensure_worker()
+    started = perf_counter()
+    bind = read_engine(user_token)
+    if deadline is not None:
+        deadline.check('cache lookup')
+
+    try:
+        with db_breaker.guard(deadline):
+            cache_entry = find_cache_entry(user_token, api_path, bind, deadline)
+            if cache_entry is None and bind is not db.engine:
+                # The replica may not have the entry yet; a miss means an
+                # LLM generation, so make sure on the primary first
+                cache_entry = find_cache_entry(user_token, api_path,
+                                               db.engine, deadline)
+    except CircuitOpenError:
+        response = degraded_response(user_token, api_path)
+        cache_lookups.inc(path_prefix(api_path),
+                          'degraded' if response is not None else 'miss')
+        return response
+    except OperationalError:
+        db.session.rollback()
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded('Deadline exceeded during cache lookup')
+        raise
+    finally:
+        cache_lookup_seconds.observe(perf_counter() - started, 'database')
+
+    cache_lookups.inc(path_prefix(api_path),
+                      'database' if cache_entry else 'miss')
+    if not cache_entry:
+        return None
+
+    body = cached_body_for(cache_entry)
+    response_cache.set(user_token, api_path, body)
+    return body
@@ -0,0 +1,169 @@
+import logging
+import os
+import queue
+import threading
+from time import perf_counter
+
+from metrics import (Gauge, crew_kickoff_seconds, crew_queue_wait_seconds,
+                     llm_tokens)
+
+logger = logging.getLogger(__name__)
+
+
+class CrewPool:
+    """
+    Thread-safe pool of prebuilt Kubernetes API crews.
+
+    Each crew has its own agent, task and LLM client, so concurrent
+    generations never share mutable crewai state, and a crew is reused for
+    later misses instead of being built per request. At most `size` crews
+    run at once; the time a generation waits for a free crew is reported
+    separately from the time the LLM takes.
+
+    crewai and the agent/task/LLM modules are only imported on first use,
+    so cache-only and admin processes never pay for them.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.stack = None
+        self.import_seconds = None
+        self.built = 0
+        self.busy = 0
+        self.calls = 0
+        self.failures = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.generation_total = 0.0
+        self.generation_max = 0.0
+        # Token totals per crew; crewai's usage counts are cumulative
+        self.token_totals = {}
+
+    def load(self):
+        """Import crewai and the crew factories; returns them as a tuple"""
+        if self.stack is not None:
+            return self.stack
+
+        with self.lock:
+            if self.stack is None:
+                started = perf_counter()
+                from crewai import Crew
+                from llms import create_llm
+                from agents import create_kubernetes_api_agent
+                from tasks import create_kubernetes_api_task
+                self._share_http_session()
+                self.import_seconds = perf_counter() - started
+                logger.info(f"Loaded LLM stack in {self.import_seconds:.2f}s")
+                self.stack = (Crew, create_llm, create_kubernetes_api_agent,
+                              create_kubernetes_api_task)
+        return self.stack
+
+    def _share_http_session(self):
+        # One keep-alive connection pool for every crew's LLM calls
+        try:
+            import httpx
+            import litellm
+        except ImportError:
+            return
+        if getattr(litellm, 'client_session', None) is None:
+            litellm.client_session = httpx.Client(
+                limits=httpx.Limits(max_connections=self.size,
+                                    max_keepalive_connections=self.size),
+                timeout=float(os.getenv('LLM_TIMEOUT', 120)))
+
+    def _build(self):
+        Crew, create_llm, create_agent, create_task = self.load()
+        agent = create_agent(create_llm())
+        crew = Crew(agents=[agent], tasks=[create_task(agent)], verbose=False)
+        with self.lock:
+            self.built += 1
+        return crew
+
+    def preload(self):
+        """Import the stack and build one crew ahead of the first miss"""
+        self.idle.put(self._build())
+
+    def kickoff(self, inputs):
+        """Run a pooled crew, waiting for a free one if all are busy"""
+        queued_at = perf_counter()
+        self.slots.acquire()
+        queue_wait = perf_counter() - queued_at
+        with self.lock:
+            self.busy += 1
+        try:
+            try:
+                crew = self.idle.get_nowait()
+            except queue.Empty:
+                crew = self._build()
+
+            started = perf_counter()
+            try:
+                result = crew.kickoff(inputs=inputs)
+            except Exception:
+                with self.lock:
+                    self.failures += 1
+                crew_kickoff_seconds.observe(perf_counter() - started, 'error')
+                raise
+            finally:
+                self.idle.put(crew)
+            generation = perf_counter() - started
+            self._count_tokens(crew, result)
+        finally:
+            with self.lock:
+                self.busy -= 1
+            self.slots.release()
+
+        crew_queue_wait_seconds.observe(queue_wait)
+        crew_kickoff_seconds.observe(generation, 'ok')
+
+        with self.lock:
+            self.calls += 1
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+            self.generation_total += generation
+            self.generation_max = max(self.generation_max, generation)
+        logger.debug(f"Crew kickoff waited {queue_wait:.3f}s for a crew, "
+                     f"generated in {generation:.3f}s")
+        return result
+
+    def _count_tokens(self, crew, result):
+        usage = getattr(result, 'token_usage', None)
+        if usage is None:
+            return
+        totals = (usage.prompt_tokens, usage.completion_tokens)
+        with self.lock:
+            previous = self.token_totals.get(id(crew), (0, 0))
+            self.token_totals[id(crew)] = totals
+        if totals[0] < previous[0] or totals[1] < previous[1]:
+            previous = (0, 0)
+        llm_tokens.inc('prompt', amount=totals[0] - previous[0])
+        llm_tokens.inc('completion', amount=totals[1] - previous[1])
+
+    def stats(self):
+        prompt_cache = None
+        if self.stack is not None:
+            from llms import prompt_cache
+        with self.lock:
+            return {
+                'size': self.size,
+                'built': self.built,
+                'busy': self.busy,
+                'calls': self.calls,
+                'failures': self.failures,
+                'queue_wait_avg': self.queue_wait_total / self.calls if self.calls else 0.0,
+                'queue_wait_max': self.queue_wait_max,
+                'generation_avg': self.generation_total / self.calls if self.calls else 0.0,
+                'generation_max': self.generation_max,
+                'prompt_cache': prompt_cache.stats() if prompt_cache else None
+            }
+
+
+crew_pool = CrewPool(size=int(os.getenv('CREW_POOL_SIZE', 16)))
+
+Gauge('kaisim_crew_pool_busy', 'Crews generating right now',
+      collect=lambda: {(): crew_pool.busy})
+Gauge('kaisim_crew_pool_size', 'Max concurrent crews',
+      collect=lambda: {(): crew_pool.size})
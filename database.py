@@ -1,29 +1,116 @@
-
 from flask_sqlalchemy import SQLAlchemy
+from collections import OrderedDict
 from datetime import datetime
+import itertools
+import logging
+import os
+import threading
 import uuid
-from models import db, APICache
-from sqlalchemy import create_engine
-from sqlalchemy.pool import QueuePool
+from time import monotonic
+from models import db, APICache, CacheInvalidation
+from sqlalchemy.exc import OperationalError
 from app import app
+from breaker import db_breaker
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Replica binds in round-robin order (see DATABASE_REPLICA_URLS in app.py)
+replica_binds = sorted(key for key in app.config.get('SQLALCHEMY_BINDS', {})
+                       if key.startswith('replica'))
+replica_keys = itertools.cycle(replica_binds)
+
+# Seconds a token's reads stay on the primary after it changed a cache entry
+READ_AFTER_WRITE_SECONDS = float(os.getenv('REPLICA_READ_AFTER_WRITE', 5))
+# {user_token: until}, oldest first
+recent_writers = OrderedDict()
+recent_writers_lock = threading.Lock()
+
 
 def get_db():
-    """Get database connection with pooling"""
-    engine = create_engine(
-        app.config['SQLALCHEMY_DATABASE_URI'],
-        poolclass=QueuePool,
-        pool_size=5,
-        max_overflow=10,
-        pool_timeout=30,
-        pool_recycle=1800,  # Recycle connections after 30 minutes
-        pool_pre_ping=True  # Enable automatic reconnection
-    )
-    return engine.connect()
+    """Get a connection from the shared primary engine's pool"""
+    with app.app_context():
+        return db.engine.connect()
+
+
+def note_write(user_token):
+    """
+    Read the token's entries from the primary for a while, until the
+    replicas have caught up with what it just wrote
+    """
+    if not replica_binds or READ_AFTER_WRITE_SECONDS <= 0:
+        return
+    now = monotonic()
+    with recent_writers_lock:
+        recent_writers.pop(str(user_token), None)
+        recent_writers[str(user_token)] = now + READ_AFTER_WRITE_SECONDS
+        while next(iter(recent_writers.values())) <= now:
+            recent_writers.popitem(last=False)
+
+
+def wrote_recently(user_token):
+    with recent_writers_lock:
+        until = recent_writers.get(str(user_token))
+    return until is not None and until > monotonic()
+
+
+def read_engine(user_token=None):
+    """
+    The engine to run cache lookups on: the next read replica if any are
+    configured, otherwise the primary. A token that recently wrote (see
+    note_write) reads from the primary. Writes always use db.session's
+    default bind, the primary. Needs an app context.
+    """
+    if user_token is not None and wrote_recently(user_token):
+        return db.engine
+    key = next(replica_keys, None)
+    return db.engines[key] if key is not None else db.engine
+
+
+def execute_read(statement, bind=None, deadline=None):
+    """
+    Run a read-only statement on a replica. If the replica fails, the
+    statement is retried on the primary unless the request deadline passed.
+    Raises CircuitOpenError at once while the database is known to be down.
+    """
+    bind = bind or read_engine()
+    with db_breaker.guard(deadline):
+        try:
+            return db.session.execute(statement, bind_arguments={'bind': bind})
+        except OperationalError as e:
+            if bind is db.engine or (deadline is not None and deadline.expired()):
+                raise
+            logger.warning(f"Read replica failed, using the primary: {str(e)}")
+            db.session.rollback()
+            return db.session.execute(statement)
+
+
+def pool_usage():
+    """Connections of each engine's pool: {(bind, state): count}"""
+    usage = {}
+    with app.app_context():
+        for key, engine in db.engines.items():
+            pool = engine.pool
+            if not hasattr(pool, 'checkedout'):
+                continue  # e.g. SQLite's static pools
+            bind = key or 'primary'
+            usage[(bind, 'size')] = pool.size()
+            usage[(bind, 'checked_out')] = pool.checkedout()
+            usage[(bind, 'overflow')] = max(pool.overflow(), 0)
+            usage[(bind, 'max')] = pool.size() + max(pool._max_overflow, 0)
+    return usage
+
+
+Gauge('kaisim_db_pool_connections',
+      'Database pool connections per bind: pool size, checked out, '
+      'overflow in use, and the max the pool can hand out',
+      ['bind', 'state'], collect=pool_usage)
+
 
 def init_db():
     """Initialize database tables"""
     try:
-        db.create_all()
+        db.create_all(bind_key=None)
     except Exception as e:
         print(f"Error initializing database: {str(e)}")
         raise
@@ -46,13 +133,97 @@ def store_cache(user_token: str, api_path: str, response: str, is_predefined: bo
         print(f"Error storing cache: {str(e)}")
         raise
 
+def bulk_upsert_cache(entries, batch_size: int = 500):
+    """
+    Store many cache entries, replacing an owner's existing entries for the
+    same paths. Each entry is a dict with api_path, response, user_token and
+    is_predefined. Every batch is one DELETE and one multi-row INSERT, plus
+    the paths' rows in the cache invalidation log.
+    Returns the number of entries written.
+    """
+    written = 0
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            written += _upsert_batch(batch)
+            batch = []
+    if batch:
+        written += _upsert_batch(batch)
+    return written
+
+
+def _upsert_batch(batch):
+    # The last entry for an owner and path wins, as with single stores
+    rows = {}
+    for entry in batch:
+        owner = None if entry.get('is_predefined') else entry['user_token']
+        rows[(owner, entry['api_path'])] = {
+            'cache_id': uuid.uuid4(),
+            'user_token': entry.get('user_token'),
+            'api_path': entry['api_path'],
+            'response': entry['response'],
+            'is_predefined': bool(entry.get('is_predefined')),
+            'created_at': datetime.utcnow()
+        }
+
+    paths_by_owner = {}
+    for owner, api_path in rows:
+        paths_by_owner.setdefault(owner, []).append(api_path)
+    try:
+        with db_breaker.guard():
+            for owner, paths in paths_by_owner.items():
+                if owner is None:
+                    owned = APICache.is_predefined == True
+                else:
+                    owned = db.and_(APICache.user_token == owner,
+                                    APICache.is_predefined == False)
+                db.session.execute(db.delete(APICache).where(
+                    owned, APICache.api_path.in_(paths)))
+            db.session.execute(db.insert(APICache), list(rows.values()))
+            db.session.execute(db.insert(CacheInvalidation), [
+                {'user_token': owner, 'api_path': api_path,
+                 'created_at': datetime.utcnow()}
+                for owner, api_path in rows])
+            db.session.commit()
+        return len(batch)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def iter_cache_entries(user_token: str, include_predefined: bool = True,
+                       after_id: int = None, columns=None,
+                       batch_size: int = 500, newest_first: bool = False):
+    """
+    Yield a user's (and predefined) cache rows in id order, fetching them
+    in keyset-paginated batches so memory use does not grow with the cache.
+    Rows start with the id, followed by the requested columns.
+    """
+    owned = APICache.user_token == user_token
+    if include_predefined:
+        owned = db.or_(owned, APICache.is_predefined == True)
+    order = APICache.id.desc() if newest_first else APICache.id
+    while True:
+        query = db.select(APICache.id, *(columns or [APICache])).where(owned)
+        if after_id is not None:
+            query = query.where(APICache.id < after_id if newest_first
+                                else APICache.id > after_id)
+        rows = execute_read(query.order_by(order).limit(batch_size)).all()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1].id
+
+
 def get_cache(user_token: str, api_path: str):
     """Get cache entry"""
     try:
-        cache_entry = APICache.query.filter(
+        cache_entry = execute_read(db.select(APICache).where(
             (APICache.user_token == user_token) | (APICache.is_predefined == True),
             APICache.api_path == api_path
-        ).order_by(APICache.created_at.desc()).first()
+        ).order_by(APICache.created_at.desc()).limit(1)).scalars().first()
 
         return cache_entry.response if cache_entry else None
     except Exception as e:
@@ -0,0 +1,71 @@
+import re
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from time import monotonic
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def parse_duration(value):
+    """
+    Parse a timeout such as kubectl sends it (e.g. 30, 30s, 1m30s, 500ms)
+    into seconds. Raises ValueError for anything else.
+    """
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        parts = DURATION_PART.findall(value)
+        if not parts or ''.join(n + u for n, u in parts) != value:
+            raise ValueError(f"Invalid duration: {value}")
+        seconds = sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+
+    if seconds <= 0:
+        raise ValueError("Timeout must be positive")
+    return seconds
+
+
+class Deadline:
+    """
+    Per-request deadline carried through the cache lookup, the rate-limit
+    check and the wait on the LLM generation. A deadline without a timeout
+    never expires.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.expires_at = monotonic() + timeout if timeout else None
+
+    @classmethod
+    def from_param(cls, value):
+        """Build a deadline from the ?timeout= query parameter"""
+        return cls(parse_duration(value) if value else None)
+
+    def remaining(self):
+        """Seconds left, or None when there is no deadline"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and monotonic() >= self.expires_at
+
+    def check(self, stage='request'):
+        if self.expired():
+            raise DeadlineExceeded(
+                f'Deadline exceeded before {stage} ({self.timeout}s)')
+
+    def wait(self, future):
+        """Wait for a concurrent future until the deadline"""
+        try:
+            return future.result(timeout=self.remaining())
+        except FutureTimeoutError:
+            if future.done():
+                # The generation itself timed out, not this request
+                raise
+            raise DeadlineExceeded(
+                f'Deadline exceeded waiting for generation ({self.timeout}s)')
@@ -0,0 +1,254 @@
+import json
+import logging
+import re
+import threading
+import uuid
+
+from breaker import CircuitOpenError
+from cache import response_cache, invalidation_feed, CachedBody
+from database import execute_read, read_engine
+from models import db, APICache
+
+logger = logging.getLogger(__name__)
+
+# Aggregated discovery versions we can serve, preferred first
+DISCOVERY_VERSIONS = ('v2', 'v2beta1')
+AGGREGATED_MEDIA_TYPE = 'application/json;g=apidiscovery.k8s.io;v={};as=APIGroupDiscoveryList'
+VERSION_PATTERN = re.compile(r'^v(\d+)(?:(alpha|beta)(\d+))?$')
+
+# Documents built from predefined entries only are the same for every token
+shared_documents = {}
+shared_lock = threading.Lock()
+
+
+def negotiate(accept):
+    """
+    Return the aggregated discovery version an Accept header asks for, or
+    None if the client wants the plain APIVersions/APIGroupList document
+    """
+    for media_range in (accept or '').split(','):
+        media_type, *params = [p.strip() for p in media_range.split(';')]
+        if media_type not in ('application/json', '*/*'):
+            continue
+        params = dict(p.partition('=')[::2] for p in params)
+        if (params.get('g') == 'apidiscovery.k8s.io'
+                and params.get('as') == 'APIGroupDiscoveryList'
+                and params.get('v') in DISCOVERY_VERSIONS):
+            return params['v']
+        if not params.get('g'):
+            # Plain JSON is acceptable, stop at the client's preference
+            return None
+    return None
+
+
+def cache_key(api_path, version):
+    return f'{api_path};as=APIGroupDiscoveryList;v={version}'
+
+
+def version_priority(version):
+    """Sort key putting GA before beta before alpha, newest first"""
+    match = VERSION_PATTERN.match(version)
+    if not match:
+        return (3, 0, 0, version)
+    major, stage, minor = match.groups()
+    rank = {None: 0, 'beta': 1, 'alpha': 2}[stage]
+    return (rank, -int(major), -int(minor or 0), version)
+
+
+def is_discovery_source(api_path):
+    """Whether a cached path feeds the aggregated documents"""
+    parts = [p for p in api_path.split('/') if p]
+    return ((parts[:1] == ['api'] and len(parts) <= 2) or
+            (parts[:1] == ['apis'] and len(parts) in (1, 3)))
+
+
+def load_entries(user_token, api_path):
+    """
+    The newest APICache response for each discovery path under api_path,
+    the user's own entries (e.g. CRD groups) shadowing predefined ones.
+    Returns ({path: response}, predefined cache ids or None if any user
+    entry was used).
+    """
+    if api_path == '/api':
+        paths = APICache.api_path.in_(['/api', '/api/v1'])
+    else:
+        paths = db.or_(
+            APICache.api_path == '/apis',
+            db.and_(APICache.api_path.like('/apis/%/%'),
+                    ~APICache.api_path.like('/apis/%/%/%')))
+    rows = execute_read(db.select(
+        APICache.cache_id, APICache.api_path, APICache.response,
+        APICache.is_predefined).where(
+            paths,
+            db.or_(APICache.user_token == uuid.UUID(str(user_token)),
+                   APICache.is_predefined == True)).order_by(
+                       APICache.is_predefined, APICache.created_at.desc()),
+        read_engine(user_token)).all()
+
+    entries, predefined_ids = {}, []
+    for cache_id, path, response, is_predefined in rows:
+        if path in entries:
+            continue
+        entries[path] = response
+        predefined_ids.append(cache_id if is_predefined else None)
+    if None in predefined_ids:
+        return entries, None
+    return entries, tuple(sorted(str(i) for i in predefined_ids))
+
+
+def parse_json(text):
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def discovery_resources(resource_list, group, version):
+    """Turn an APIResourceList into APIVersionDiscovery resources"""
+    resources, subresources = {}, []
+    for resource in resource_list.get('resources', []):
+        name = resource.get('name', '')
+        if '/' in name:
+            subresources.append(resource)
+            continue
+        entry = {
+            'resource': name,
+            'responseKind': {
+                'group': group,
+                'version': version,
+                'kind': resource.get('kind', '')
+            },
+            'scope': 'Namespaced' if resource.get('namespaced') else 'Cluster',
+            'singularResource': resource.get('singularName') or name,
+            'verbs': resource.get('verbs', [])
+        }
+        for field in ('shortNames', 'categories'):
+            if resource.get(field):
+                entry[field] = resource[field]
+        resources[name] = entry
+
+    for resource in subresources:
+        parent, _, subresource = resource['name'].partition('/')
+        if parent not in resources:
+            continue
+        resources[parent].setdefault('subresources', []).append({
+            'subresource': subresource,
+            'responseKind': {
+                'group': resource.get('group', group),
+                'version': resource.get('version', version),
+                'kind': resource.get('kind', '')
+            },
+            'verbs': resource.get('verbs', [])
+        })
+    return list(resources.values())
+
+
+def group_order(group_list):
+    """Group names and their version order from an APIGroupList"""
+    order = {}
+    for group in (group_list or {}).get('groups', []):
+        versions = [v.get('version') for v in group.get('versions', [])]
+        preferred = group.get('preferredVersion', {}).get('version')
+        if preferred in versions:
+            versions.remove(preferred)
+            versions.insert(0, preferred)
+        order[group.get('name')] = versions
+    return order
+
+
+def build_document(api_path, entries, version):
+    """Assemble an APIGroupDiscoveryList from cached discovery responses"""
+    groups = {}
+    for path, response in entries.items():
+        parts = [p for p in path.split('/') if p]
+        if (parts[0] == 'api' and len(parts) == 2) or len(parts) == 3:
+            group = '' if parts[0] == 'api' else parts[1]
+            resource_list = parse_json(response)
+            if isinstance(resource_list, dict):
+                groups.setdefault(group, {})[parts[-1]] = discovery_resources(
+                    resource_list, group, parts[-1])
+
+    order = {}
+    if api_path == '/apis':
+        order = group_order(parse_json(entries.get('/apis')))
+    names = [g for g in order if g in groups]
+    names += sorted(g for g in groups if g not in order)
+
+    items = []
+    for name in names:
+        known = order.get(name, [])
+        versions = sorted(
+            groups[name],
+            key=lambda v: (known.index(v) if v in known else len(known),
+                           version_priority(v)))
+        items.append({
+            'metadata': {'name': name} if name else {},
+            'versions': [{
+                'version': v,
+                'resources': groups[name][v],
+                'freshness': 'Current'
+            } for v in versions]
+        })
+
+    return {
+        'kind': 'APIGroupDiscoveryList',
+        'apiVersion': f'apidiscovery.k8s.io/{version}',
+        'metadata': {},
+        'items': items
+    }
+
+
+def get_aggregated_discovery(user_token, api_path, version):
+    """
+    Return the aggregated discovery document for /api or /apis as a
+    CachedBody, or None if there is nothing cached to build it from.
+    Needs an app context when the document is not in memory. While the
+    database is down the last document built is served, even if expired.
+    """
+    key = cache_key(api_path, version)
+    cached = response_cache.get(user_token, key)
+    if cached is not None:
+        return cached
+
+    invalidation_feed.ensure_worker()
+    try:
+        entries, predefined_ids = load_entries(user_token, api_path)
+    except CircuitOpenError:
+        return response_cache.get_stale(user_token, key)
+    if not entries:
+        return None
+
+    shared_key = (api_path, version, predefined_ids)
+    with shared_lock:
+        cached = shared_documents.get(shared_key) if predefined_ids else None
+    if cached is None:
+        document = build_document(api_path, entries, version)
+        if not document['items']:
+            return None
+        cached = CachedBody(json.dumps(document))
+        logger.debug(f"Built aggregated discovery for {api_path} from "
+                     f"{len(entries)} cached entries")
+        if predefined_ids:
+            with shared_lock:
+                # Older predefined sets are gone after an init_cache run
+                if len(shared_documents) >= 8:
+                    shared_documents.clear()
+                shared_documents[shared_key] = cached
+
+    response_cache.set(user_token, key, cached)
+    return cached
+
+
+def invalidate(user_token, api_path):
+    """
+    Drop the aggregated documents a changed cache entry feeds into; every
+    token's if user_token is None (a predefined entry)
+    """
+    if not is_discovery_source(api_path):
+        return
+    root = '/api' if api_path.startswith('/api/') or api_path == '/api' else '/apis'
+    for version in DISCOVERY_VERSIONS:
+        if user_token is None:
+            response_cache.invalidate_path(cache_key(root, version))
+        else:
+            response_cache.invalidate(user_token, cache_key(root, version))
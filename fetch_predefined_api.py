@@ -1,95 +1,200 @@
-import requests
+import argparse
+import hashlib
 import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Paths kubectl reads besides the discovered group versions
+OPENAPI_PATHS = ['/openapi/v3', '/openapi/v2']
+
+
+def make_session(bearer_token, workers=8, retries=3, backoff=0.5):
+    """
+    A pooled session that ignores TLS certificate validation and retries
+    connection errors and 429/5xx responses with exponential backoff.
+    """
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # Disable insecure request warnings
+
+    session = requests.Session()
+    session.verify = False
+    session.headers.update({
+        "Authorization": f"Bearer {bearer_token}",
+        "Content-Type": "application/json"
+    })
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'], respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def discover_paths(session, api_endpoint, timeout=30):
+    """
+    List the discovery paths of a cluster: /api and /apis, every served
+    group version, the OpenAPI v3 index with its documents and OpenAPI v2
+    """
+    paths = ['/api']
+    response = session.get(f"{api_endpoint}/api", timeout=timeout)
+    response.raise_for_status()
+    paths += [f"/api/{version}" for version in response.json().get('versions', [])]
+
+    paths.append('/apis')
+    response = session.get(f"{api_endpoint}/apis", timeout=timeout)
+    response.raise_for_status()
+    for group in response.json().get('groups', []):
+        paths += [f"/apis/{version['groupVersion']}"
+                  for version in group.get('versions', [])]
+
+    paths.append(OPENAPI_PATHS[0])
+    try:
+        response = session.get(f"{api_endpoint}{OPENAPI_PATHS[0]}", timeout=timeout)
+        response.raise_for_status()
+        paths += [f"/openapi/v3/{path}" for path in response.json().get('paths', {})]
+    except requests.exceptions.RequestException:
+        print("api {} failed, skipping OpenAPI v3 documents".format(OPENAPI_PATHS[0]), file=sys.stderr)
+    paths += OPENAPI_PATHS[1:]
+    return paths
+
+
+def content_hash(response_json):
+    return hashlib.sha256(json.dumps(response_json, sort_keys=True).encode()).hexdigest()
+
+
+def fetch_one(session, api_endpoint, api_path, previous=None, timeout=30):
+    """
+    Fetch one path. With a previous entry the request is conditional on
+    its ETag. Returns (entry, status) where status is fetched, unchanged or
+    not-modified.
+    """
+    headers = {}
+    if previous and previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+
+    response = session.get("{}{}".format(api_endpoint, api_path), headers=headers, timeout=timeout)
+    if response.status_code == 304 and previous:
+        return previous, 'not-modified'
+    response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+    try:
+        response_json = response.json()
+    except json.JSONDecodeError:
+        response_json = {"text": response.text} #if the response is not json, saves it as text.
+
+    entry = {
+        "api_path": api_path,
+        "response": response_json,
+        "sha256": content_hash(response_json)
+    }
+    if response.headers.get('ETag'):
+        entry['etag'] = response.headers['ETag']
+    if previous and previous.get('sha256') == entry['sha256']:
+        return entry, 'unchanged'
+    return entry, 'fetched'
+
+
+def iter_api_responses(session, api_endpoint, api_paths, previous=None,
+                       workers=8, timeout=30):
+    """
+    Fetch paths concurrently and yield (entry, status) as they complete.
+    Failed paths are reported on stderr; with previous entries the old
+    response is kept instead.
+    """
+    previous = previous or {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_one, session, api_endpoint, api_path,
+                            previous.get(api_path), timeout): api_path
+            for api_path in api_paths
+        }
+        for future in as_completed(futures):
+            api_path = futures[future]
+            try:
+                yield future.result()
+            except requests.exceptions.RequestException as e:
+                print("api {} failed: {}".format(api_path, e), file=sys.stderr)
+                if api_path in previous:
+                    yield previous[api_path], 'failed'
+
 
-def fetch_api_responses(api_endpoint, api_paths, bearer_token):
+def fetch_api_responses(api_endpoint, api_paths, bearer_token, workers=8, retries=3):
     """
     Fetches responses from specified API endpoints, ignoring TLS certificate validation.
 
     Returns:
         dict: A dictionary containing API paths and their corresponding responses.
     """
+    session = make_session(bearer_token, workers, retries)
+    return {"entries": [entry for entry, _ in iter_api_responses(
+        session, api_endpoint, api_paths, workers=workers)]}
 
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # Disable insecure request warnings
 
-    results = {"entries": []}
+def load_previous(path):
+    """Entries of an earlier capture by api_path, for incremental runs"""
+    try:
+        with open(path) as f:
+            return {entry['api_path']: entry for entry in json.load(f).get('entries', [])}
+    except FileNotFoundError:
+        return {}
+
+
+def write_entries(results, out, total):
+    """Stream {"entries": [...]} to out, one entry at a time"""
+    counts = {}
+    out.write('{"entries": [\n')
+    for done, (entry, status) in enumerate(results, 1):
+        out.write((',\n' if done > 1 else '') + json.dumps(entry))
+        counts[status] = counts.get(status, 0) + 1
+        print("[{}/{}] {} {}".format(done, total, status, entry['api_path']), file=sys.stderr)
+    out.write('\n]}\n')
+    return counts
 
-    headers = {
-        "Authorization": f"Bearer {bearer_token}",
-        "Content-Type": "application/json"
-    }
 
-    for api_path in api_paths:
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Capture discovery and OpenAPI responses from a Kubernetes cluster "
+                    "into a predefined_cache.json file for init_cache.py")
+    parser.add_argument('--server', required=True, help="cluster API endpoint, e.g. https://1.2.3.4")
+    parser.add_argument('--token', default=os.getenv('KUBE_TOKEN', ''), help="bearer token (default: $KUBE_TOKEN)")
+    parser.add_argument('--output', '-o', default='-', help="output file, '-' for stdout")
+    parser.add_argument('--incremental', action='store_true',
+                        help="re-fetch only paths whose ETag or content changed since the output file was written")
+    parser.add_argument('--paths', nargs='*', help="paths to fetch instead of discovering them from /api and /apis")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent requests")
+    parser.add_argument('--retries', type=int, default=3, help="retries per path on connection errors, 429 and 5xx")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds per request")
+    args = parser.parse_args(argv)
+
+    api_endpoint = args.server.rstrip('/')
+    session = make_session(args.token, args.workers, args.retries)
+    api_paths = args.paths or discover_paths(session, api_endpoint, args.timeout)
+    previous = load_previous(args.output) if args.incremental and args.output != '-' else {}
+
+    results = iter_api_responses(session, api_endpoint, api_paths, previous,
+                                 args.workers, args.timeout)
+    if args.output == '-':
+        counts = write_entries(results, sys.stdout, len(api_paths))
+    else:
+        # Write next to the target and swap it in, so a failed run keeps the old file
+        directory = os.path.dirname(os.path.abspath(args.output))
+        out = tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False)
         try:
-            response = requests.get("{}{}".format(api_endpoint, api_path), headers=headers, verify=False) # verify=False ignores TLS validation
-            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-            try:
-                response_json = response.json()
-            except json.JSONDecodeError:
-                response_json = {"text": response.text} #if the response is not json, saves it as text.
-
-            results["entries"].append({
-                "api_path": api_path,
-                "response": response_json
-            })
-
-        except requests.exceptions.RequestException as e:
-            print("api {} failed".format(api_path))
-
-    return results
-
-# Example usage:
-api_paths = [
-    "/api",
-    "/api/v1",
-    "/apis",
-    "/apis/admissionregistration.k8s.io/v1",
-    "/apis/apiextensions.k8s.io/v1",
-    "/apis/apiregistration.k8s.io/v1",
-    "/apis/apps/v1",
-    "/apis/authentication.k8s.io/v1",
-    "/apis/authorization.k8s.io/v1",
-    "/apis/auto.gke.io/v1",
-    "/apis/auto.gke.io/v1alpha1",
-    "/apis/autoscaling.x-k8s.io/v1",
-    "/apis/autoscaling.x-k8s.io/v1beta1",
-    "/apis/autoscaling/v1",
-    "/apis/autoscaling/v2",
-    "/apis/batch/v1",
-    "/apis/certificates.k8s.io/v1",
-    "/apis/cloud.google.com/v1",
-    "/apis/cloud.google.com/v1beta1",
-    "/apis/coordination.k8s.io/v1",
-    "/apis/datalayer.gke.io/v1",
-    "/apis/discovery.k8s.io/v1",
-    "/apis/events.k8s.io/v1",
-    "/apis/flowcontrol.apiserver.k8s.io/v1",
-    "/apis/flowcontrol.apiserver.k8s.io/v1beta3",
-    "/apis/hub.gke.io/v1",
-    "/apis/internal.autoscaling.gke.io/v1",
-    "/apis/metrics.k8s.io/v1beta1",
-    "/apis/monitoring.googleapis.com/v1",
-    "/apis/monitoring.googleapis.com/v1alpha1",
-    "/apis/networking.gke.io/v1",
-    "/apis/networking.gke.io/v1beta1",
-    "/apis/networking.gke.io/v1beta2",
-    "/apis/networking.k8s.io/v1",
-    "/apis/node.gke.io/v1",
-    "/apis/node.k8s.io/v1",
-    "/apis/nodemanagement.gke.io/v1alpha1",
-    "/apis/policy/v1",
-    "/apis/rbac.authorization.k8s.io/v1",
-    "/apis/scheduling.k8s.io/v1",
-    "/apis/snapshot.storage.k8s.io/v1",
-    "/apis/snapshot.storage.k8s.io/v1beta1",
-    "/apis/storage.k8s.io/v1",
-    "/apis/warden.gke.io/v1",
-    '/openapi/v3',
-    '/openapi/v3/api/v1',
-    '/openapi/v2'
-]
-api_endpoint = '' # Replace with your k8s cluster endpoint
-bearer_token = ""  # Replace with your actual bearer token
-
-api_responses = fetch_api_responses(api_endpoint, api_paths, bearer_token)
-print(json.dumps(api_responses, indent=4))
+            with out:
+                counts = write_entries(results, out, len(api_paths))
+            os.replace(out.name, args.output)
+        except BaseException:
+            os.unlink(out.name)
+            raise
+    print(", ".join("{} {}".format(count, status) for status, count in sorted(counts.items())), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
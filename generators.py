@@ -0,0 +1,306 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from metrics import template_generations
+from store import parse_resource_path
+
+logger = logging.getLogger(__name__)
+
+APPS = [
+    'web', 'api', 'frontend', 'backend', 'worker', 'redis', 'postgres',
+    'nginx', 'auth', 'payments', 'catalog', 'checkout', 'search', 'notifier',
+    'scheduler', 'gateway', 'metrics', 'ingest', 'billing', 'inventory'
+]
+NAMESPACES = ['default', 'kube-system', 'kube-public', 'kube-node-lease']
+EXTRA_NAMESPACES = [
+    'production', 'staging', 'monitoring', 'ingress-nginx', 'cert-manager',
+    'data', 'team-a', 'team-b'
+]
+IMAGES = {
+    'redis': 'redis:7.2-alpine',
+    'postgres': 'postgres:16.2',
+    'nginx': 'nginx:1.25.4',
+}
+NODES = ['node-pool-1-7f6d9', 'node-pool-1-b2k4x', 'node-pool-2-q8z1m']
+HASH_CHARS = 'bcdfghjklmnpqrstvwxz2456789'
+
+
+def pod_hash(rng, length):
+    return ''.join(rng.choice(HASH_CHARS) for _ in range(length))
+
+
+def timestamp(rng, max_days=30):
+    created = datetime.utcnow() - timedelta(minutes=rng.randint(5, max_days * 1440))
+    return created.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def metadata(rng, name, namespace=None, labels=None):
+    meta = {
+        'name': name,
+        'uid': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        'resourceVersion': str(rng.randint(1000, 999999)),
+        'creationTimestamp': timestamp(rng)
+    }
+    if namespace is not None:
+        meta['namespace'] = namespace
+    if labels:
+        meta['labels'] = labels
+    return meta
+
+
+def container(rng, app):
+    return {
+        'name': app,
+        'image': IMAGES.get(app, f'registry.example.com/{app}:1.{rng.randint(0, 9)}.{rng.randint(0, 20)}'),
+        'ports': [{'containerPort': rng.choice([80, 3000, 5432, 6379, 8080, 9090]), 'protocol': 'TCP'}],
+        'resources': {
+            'requests': {'cpu': rng.choice(['50m', '100m', '250m']), 'memory': rng.choice(['64Mi', '128Mi', '256Mi'])},
+            'limits': {'cpu': rng.choice(['500m', '1']), 'memory': rng.choice(['256Mi', '512Mi', '1Gi'])}
+        },
+        'imagePullPolicy': 'IfNotPresent',
+        'terminationMessagePath': '/dev/termination-log',
+        'terminationMessagePolicy': 'File'
+    }
+
+
+def app_for(rng, name):
+    """Keep a requested object's app label consistent with its name"""
+    if name:
+        for app in APPS:
+            if name.startswith(app):
+                return app
+    return rng.choice(APPS)
+
+
+def pod(rng, namespace, name=None):
+    app = app_for(rng, name)
+    template_hash = pod_hash(rng, 10)
+    name = name or f'{app}-{template_hash}-{pod_hash(rng, 5)}'
+    spec_container = container(rng, app)
+    started = timestamp(rng)
+    phase = rng.choices(['Running', 'Pending', 'Succeeded'], [90, 7, 3])[0]
+    ready = phase == 'Running'
+    restarts = rng.choices([0, 1, 2, 5], [80, 12, 5, 3])[0]
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Pod',
+        'metadata': metadata(rng, name, namespace, {'app': app, 'pod-template-hash': template_hash}),
+        'spec': {
+            'containers': [spec_container],
+            'restartPolicy': 'Always',
+            'dnsPolicy': 'ClusterFirst',
+            'schedulerName': 'default-scheduler',
+            'serviceAccountName': 'default',
+            'nodeName': rng.choice(NODES),
+            'terminationGracePeriodSeconds': 30
+        },
+        'status': {
+            'phase': phase,
+            'conditions': [{'type': t, 'status': 'True' if ready or t == 'PodScheduled' else 'False', 'lastTransitionTime': started}
+                           for t in ('Initialized', 'Ready', 'ContainersReady', 'PodScheduled')],
+            'hostIP': f'10.128.0.{rng.randint(2, 250)}',
+            'podIP': f'10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(2, 250)}',
+            'startTime': started,
+            'qosClass': 'Burstable',
+            'containerStatuses': [{
+                'name': app,
+                'image': spec_container['image'],
+                'imageID': f"{spec_container['image']}@sha256:{hashlib.sha256(spec_container['image'].encode()).hexdigest()}",
+                'ready': ready,
+                'started': ready,
+                'restartCount': restarts,
+                'state': {'running': {'startedAt': started}} if ready else {'waiting': {'reason': 'ContainerCreating'}}
+            }]
+        }
+    }
+
+
+def deployment(rng, namespace, name=None):
+    app = name or rng.choice(APPS)
+    replicas = rng.randint(1, 5)
+    available = replicas if rng.random() < 0.9 else replicas - 1
+    labels = {'app': app}
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': dict(metadata(rng, app, namespace, labels), generation=rng.randint(1, 6),
+                         annotations={'deployment.kubernetes.io/revision': str(rng.randint(1, 6))}),
+        'spec': {
+            'replicas': replicas,
+            'selector': {'matchLabels': labels},
+            'template': {
+                'metadata': {'labels': labels},
+                'spec': {'containers': [container(rng, app)], 'restartPolicy': 'Always'}
+            },
+            'strategy': {'type': 'RollingUpdate', 'rollingUpdate': {'maxSurge': '25%', 'maxUnavailable': '25%'}},
+            'revisionHistoryLimit': 10,
+            'progressDeadlineSeconds': 600
+        },
+        'status': {
+            'observedGeneration': 1,
+            'replicas': replicas,
+            'updatedReplicas': replicas,
+            'readyReplicas': available,
+            'availableReplicas': available,
+            'conditions': [
+                {'type': 'Available', 'status': 'True' if available == replicas else 'False', 'reason': 'MinimumReplicasAvailable'},
+                {'type': 'Progressing', 'status': 'True', 'reason': 'NewReplicaSetAvailable'}
+            ]
+        }
+    }
+
+
+def service(rng, namespace, name=None):
+    app = name or rng.choice(APPS)
+    port = rng.choice([80, 443, 5432, 6379, 8080])
+    service_type = rng.choices(['ClusterIP', 'NodePort', 'LoadBalancer'], [80, 10, 10])[0]
+    cluster_ip = f'10.96.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+    spec_port = {'name': 'http' if port in (80, 8080) else 'tcp', 'port': port, 'targetPort': port, 'protocol': 'TCP'}
+    if service_type != 'ClusterIP':
+        spec_port['nodePort'] = rng.randint(30000, 32767)
+    status = {'loadBalancer': {}}
+    if service_type == 'LoadBalancer':
+        status['loadBalancer'] = {'ingress': [{'ip': f'34.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'}]}
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': metadata(rng, app, namespace, {'app': app}),
+        'spec': {
+            'type': service_type,
+            'selector': {'app': app},
+            'ports': [spec_port],
+            'clusterIP': cluster_ip,
+            'clusterIPs': [cluster_ip],
+            'sessionAffinity': 'None',
+            'ipFamilies': ['IPv4'],
+            'ipFamilyPolicy': 'SingleStack'
+        },
+        'status': status
+    }
+
+
+def configmap(rng, namespace, name=None):
+    app = app_for(rng, name)
+    name = name or rng.choice([f'{app}-config', f'{app}-settings', 'kube-root-ca.crt'])
+    if name == 'kube-root-ca.crt':
+        data = {'ca.crt': '-----BEGIN CERTIFICATE-----\nMIIC5zCCAc+gAwIBAgIBADANBgkqhkiG9w0BAQsFADAVMRMwEQYDVQQDEwprdWJl\n-----END CERTIFICATE-----\n'}
+    else:
+        data = {
+            'LOG_LEVEL': rng.choice(['info', 'debug', 'warn']),
+            'PORT': str(rng.choice([3000, 8080])),
+            'FEATURE_FLAGS': ','.join(rng.sample(['beta-ui', 'fast-checkout', 'new-search', 'dark-mode'], 2))
+        }
+    return {
+        'apiVersion': 'v1',
+        'kind': 'ConfigMap',
+        'metadata': metadata(rng, name, namespace),
+        'data': data
+    }
+
+
+def namespace_object(rng, namespace, name=None):
+    name = name or rng.choice(EXTRA_NAMESPACES)
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Namespace',
+        'metadata': metadata(rng, name, labels={'kubernetes.io/metadata.name': name}),
+        'spec': {'finalizers': ['kubernetes']},
+        'status': {'phase': 'Active'}
+    }
+
+
+# (group, resource) -> (kind, object factory, namespaced)
+TEMPLATES = {
+    ('', 'pods'): ('Pod', pod, True),
+    ('', 'services'): ('Service', service, True),
+    ('', 'configmaps'): ('ConfigMap', configmap, True),
+    ('', 'namespaces'): ('Namespace', namespace_object, False),
+    ('apps', 'deployments'): ('Deployment', deployment, True),
+}
+
+
+class TemplateGenerator:
+    """
+    Produce realistic objects for well-known kinds from templates and seeded
+    randomness, so the LLM is only needed for unknown kinds and CRDs. The
+    same path always yields the same objects (apart from timestamps).
+    """
+
+    def __init__(self, enabled=True, seed=''):
+        self.enabled = enabled
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.template_hits = 0
+        self.llm_fallbacks = 0
+
+    def _rng(self, path):
+        digest = hashlib.sha256(f'{self.seed}:{path}'.encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def _list(self, rng, ref, kind, factory, namespaced):
+        if ref.resource == 'namespaces':
+            names = NAMESPACES + rng.sample(EXTRA_NAMESPACES, rng.randint(1, 4))
+            items = [factory(rng, None, name) for name in names]
+        else:
+            items, seen = [], set()
+            for _ in range(rng.randint(1, 5)):
+                namespace = ref.namespace or rng.choice(['default'] + EXTRA_NAMESPACES[:3])
+                item = factory(rng, namespace if namespaced else None)
+                key = (namespace, item['metadata']['name'])
+                if key not in seen:
+                    seen.add(key)
+                    items.append(item)
+        return {
+            'kind': f'{kind}List',
+            'apiVersion': f'{ref.group}/{ref.version}' if ref.group else ref.version,
+            'metadata': {'resourceVersion': str(rng.randint(1000, 999999))},
+            'items': items
+        }
+
+    def generate(self, method, path):
+        """Return a response dict for the path, or None to use the LLM"""
+        ref = parse_resource_path(path) if self.enabled else None
+        template = None
+        if (ref is not None and method == 'GET' and ref.subresource is None
+                and ref.version == 'v1'):
+            template = TEMPLATES.get((ref.group, ref.resource))
+
+        if template is None:
+            with self.lock:
+                self.llm_fallbacks += 1
+            template_generations.inc('llm')
+            logger.debug(f"Generator routing {method} {path}: llm")
+            return None
+
+        kind, factory, namespaced = template
+        rng = self._rng(path)
+        if ref.name is None:
+            response = self._list(rng, ref, kind, factory, namespaced)
+        else:
+            response = factory(rng, ref.namespace if namespaced else None, ref.name)
+
+        with self.lock:
+            self.template_hits += 1
+        template_generations.inc('template')
+        logger.debug(f"Generator routing {method} {path}: template ({kind})")
+        return response
+
+    def stats(self):
+        with self.lock:
+            total = self.template_hits + self.llm_fallbacks
+            return {
+                'enabled': self.enabled,
+                'template_hits': self.template_hits,
+                'llm_fallbacks': self.llm_fallbacks,
+                'hit_ratio': self.template_hits / total if total else 0.0
+            }
+
+
+template_generator = TemplateGenerator(
+    enabled=os.getenv('TEMPLATE_GENERATOR', 'true').lower() in ('true', '1'),
+    seed=os.getenv('TEMPLATE_GENERATOR_SEED', ''))
@@ -1,7 +1,6 @@
 
 from app import app
-from models import db, APICache
-import uuid
+from database import bulk_upsert_cache
 import json
 
 def init_predefined_cache():
@@ -15,23 +14,10 @@ def init_predefined_cache():
             } for entry in config["entries"]]
 
         with app.app_context():
-            for entry in predefined_entries:
-                # Check if entry already exists
-                existing = APICache.query.filter_by(
-                    api_path=entry["api_path"],
-                    is_predefined=True
-                ).first()
-                
-                if not existing:
-                    cache_entry = APICache(
-                        cache_id=uuid.uuid4(),
-                        api_path=entry["api_path"],
-                        response=entry["response"],
-                        is_predefined=True
-                    )
-                    db.session.add(cache_entry)
-            
-            db.session.commit()
+            # Replaces older predefined entries for the same paths in
+            # batched multi-row writes instead of a query per entry
+            bulk_upsert_cache(dict(entry, is_predefined=True)
+                              for entry in predefined_entries)
             print("Predefined cache entries initialized successfully")
 
     except FileNotFoundError:
@@ -1,7 +1,156 @@
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+from time import time
+
 from crewai import LLM
 
-llm = LLM(model=os.getenv("MODEL_NAME", "gemini/gemini-2.0-flash"),
-          api_key=os.getenv("LLM_API_KEY"),
-          temperature=os.getenv("LLM_TEMPERATURE", 0.5),
-          verbose=False)
+
+class PromptCacheMiss(Exception):
+    """Raised in replay mode for a prompt that was never recorded"""
+
+
+class PromptCache:
+    """
+    Disk-backed cache of LLM answers keyed by model, temperature and the
+    rendered prompt, so requests that render to the same prompt share one
+    provider call.
+
+    Modes: `off`; `on` serves hits, stores misses and evicts the least
+    recently used answers beyond `max_entries`; `record` always calls the
+    LLM and stores every answer; `replay` only serves stored answers and
+    raises PromptCacheMiss otherwise, for deterministic runs without LLM
+    calls. Answers are kept in SQLite, shared by every worker on a host.
+    """
+
+    MODES = ('off', 'on', 'record', 'replay')
+
+    def __init__(self, path, mode='off', max_entries=10000):
+        if mode not in self.MODES:
+            raise ValueError(f"LLM cache mode must be one of {', '.join(self.MODES)}")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def _connection(self):
+        # One connection per thread and process
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS llm_responses ('
+                'key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, '
+                'created_at REAL, used_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS llm_responses_used_at '
+                               'ON llm_responses (used_at)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    @staticmethod
+    def key(model, temperature, messages):
+        prompt = json.dumps([model, temperature, messages], sort_keys=True,
+                            default=str)
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    def get(self, key):
+        connection = self._connection()
+        with connection:
+            row = connection.execute(
+                'SELECT response FROM llm_responses WHERE key = ?',
+                (key, )).fetchone()
+            if row is not None and self.mode == 'on':
+                connection.execute(
+                    'UPDATE llm_responses SET used_at = ? WHERE key = ?',
+                    (time(), key))
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, model, response):
+        connection = self._connection()
+        now = time()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO llm_responses VALUES (?, ?, ?, ?, ?)',
+                (key, model, response, now, now))
+        with self.lock:
+            self.writes += 1
+            evict = self.mode == 'on' and self.writes % 100 == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used answers beyond max_entries"""
+        connection = self._connection()
+        with connection:
+            deleted = connection.execute(
+                'DELETE FROM llm_responses WHERE key IN ('
+                'SELECT key FROM llm_responses ORDER BY used_at DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_entries, )).rowcount
+        with self.lock:
+            self.evictions += deleted
+
+    def wrap(self, llm):
+        """Route an LLM's calls through the cache; a no-op when off"""
+        if self.mode == 'off':
+            return llm
+        call = llm.call
+
+        def cached_call(messages, *args, **kwargs):
+            if kwargs.get('tools'):
+                return call(messages, *args, **kwargs)
+            key = self.key(llm.model, llm.temperature, messages)
+            if self.mode != 'record':
+                response = self.get(key)
+                if response is not None:
+                    return response
+                if self.mode == 'replay':
+                    raise PromptCacheMiss(f"No recorded LLM answer for prompt {key[:16]}")
+            response = call(messages, *args, **kwargs)
+            if isinstance(response, str):
+                self.put(key, llm.model, response)
+            return response
+
+        # crewai lets plain attributes shadow an LLM's methods
+        llm.call = cached_call
+        return llm
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'mode': self.mode,
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+prompt_cache = PromptCache(
+    os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'),
+    mode=os.getenv('LLM_CACHE_MODE', 'off').lower(),
+    max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', 10000)))
+
+
+def create_llm():
+    """Build an LLM client; every pooled crew gets its own"""
+    return prompt_cache.wrap(
+        LLM(model=os.getenv("MODEL_NAME", "gemini/gemini-2.0-flash"),
+            api_key=os.getenv("LLM_API_KEY"),
+            temperature=os.getenv("LLM_TEMPERATURE", 0.5),
+            timeout=float(os.getenv("LLM_TIMEOUT", 120)),
+            verbose=False))
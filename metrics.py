@@ -0,0 +1,174 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from in-memory cache hits up to slow LLM calls
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    return f'{value:g}' if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base of the in-process metrics. Values are kept per tuple of label
+    values and rendered in the Prometheus text format.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value)"""
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in sorted(items):
+            yield '', labels, (), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{format_labels(self.labels, labels, extra)} '
+                         f'{format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A gauge read at scrape time from collect(), a {labels: value} dict"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self):
+        try:
+            values = self.collect()
+        except Exception:
+            return
+        for labels, value in sorted(values.items()):
+            yield '', labels, (), value
+
+
+class Histogram(Metric):
+    """
+    Fixed-bucket histogram. An observation is one bisect and one locked
+    increment, cheap enough for every request.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # Per bucket counts (the last one is +Inf), then the sum
+                state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(state)) for labels, state in self.values.items()]
+        for labels, state in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state):
+                cumulative += count
+                le = bound if isinstance(bound, str) else format_value(float(bound))
+                yield '_bucket', labels, (('le', le),), cumulative
+            yield '_sum', labels, (), state[-1]
+            yield '_count', labels, (), cumulative
+
+
+def path_prefix(api_path):
+    """Group request paths for per-prefix metrics"""
+    parts = [p for p in api_path.split(';')[0].split('/') if p]
+    if parts[:1] == ['openapi']:
+        return 'openapi'
+    if (parts[:1] in ([], ['version']) or
+            (parts[:1] == ['api'] and len(parts) <= 2) or
+            (parts[:1] == ['apis'] and len(parts) <= 3)):
+        return 'discovery'
+    if parts[:1] == ['api']:
+        return 'core'
+    if parts[:1] == ['apis']:
+        return 'apis'
+    return 'other'
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+cache_lookup_seconds = Histogram(
+    'kaisim_cache_lookup_seconds',
+    'Cached response lookups by layer (memory or database)', ['layer'])
+cache_lookups = Counter(
+    'kaisim_cache_lookups_total',
+    'Cached response lookups by path prefix and where they were answered '
+    '(memory, database or miss)', ['prefix', 'result'])
+rate_limit_seconds = Histogram(
+    'kaisim_rate_limit_check_seconds', 'Rate limiter checks')
+rejected_requests = Counter(
+    'kaisim_rejected_requests_total',
+    'Requests answered with 429 Too Many Requests', ['reason'])
+crew_queue_wait_seconds = Histogram(
+    'kaisim_crew_queue_wait_seconds', 'Time generations waited for a free crew')
+crew_kickoff_seconds = Histogram(
+    'kaisim_crew_kickoff_seconds', 'Crew kickoffs, i.e. LLM generations',
+    ['result'])
+llm_tokens = Counter(
+    'kaisim_llm_tokens_total', 'LLM tokens used by crew kickoffs', ['type'])
+template_generations = Counter(
+    'kaisim_template_generations_total',
+    'Generations by where they were routed (template or llm)', ['result'])
+json_extract_seconds = Histogram(
+    'kaisim_json_extract_seconds',
+    'Extracting JSON from generated markdown', ['result'])
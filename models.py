@@ -3,41 +3,12 @@ from datetime import datetime
 import uuid
 from sqlalchemy import event
 from sqlalchemy.exc import OperationalError
-from time import sleep, time
-from collections import defaultdict
-import threading
-
-
-class RateLimiter:
-
-    def __init__(self, requests_per_minute=60):
-        self.requests_per_minute = requests_per_minute
-        self.tokens = defaultdict(list)
-        self.ips = defaultdict(list)
-        self.lock = threading.Lock()
-
-    def is_allowed(self, token, ip_address):
-        now = time()
-        minute_ago = now - 60
-
-        with self.lock:
-            # Clean old requests for both token and IP
-            self.tokens[token] = [t for t in self.tokens[token] if t > minute_ago]
-            self.ips[ip_address] = [t for t in self.ips[ip_address] if t > minute_ago]
-
-            # Check if either token or IP is over limit
-            if (len(self.tokens[token]) >= self.requests_per_minute or 
-                len(self.ips[ip_address]) >= self.requests_per_minute):
-                return False
-
-            # If under limit, record the request for both
-            self.tokens[token].append(now)
-            self.ips[ip_address].append(now)
-            return True
+from time import sleep
+from ratelimit import create_rate_limiter
 
 
 db = SQLAlchemy()
-rate_limiter = RateLimiter(requests_per_minute=5)
+rate_limiter = create_rate_limiter(requests_per_minute=5)
 
 
 # Add retry logic for handling dropped connections
@@ -92,3 +63,78 @@ class APICache(db.Model):
     response = db.Column(db.Text, nullable=False)
     is_predefined = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class RateLimitCounter(db.Model):
+    """Per-window request counters for RATE_LIMIT_BACKEND=postgres"""
+    __tablename__ = 'rate_limit_counters'
+
+    key = db.Column(db.String, primary_key=True)
+    window_index = db.Column(db.BigInteger, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ClusterSnapshot(db.Model):
+    """
+    A token's simulated cluster: its current resourceVersion, which every
+    write compares and bumps, and the kinds and fully listed collections
+    it knows (the objects are in cluster_objects)
+    """
+    __tablename__ = 'cluster_snapshots'
+
+    user_token = db.Column(db.UUID, primary_key=True)
+    resource_version = db.Column(db.BigInteger, nullable=False, default=0)
+    snapshot = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+
+class ClusterObject(db.Model):
+    """One object of a token's simulated cluster"""
+    __tablename__ = 'cluster_objects'
+
+    user_token = db.Column(db.UUID, primary_key=True)
+    api_group = db.Column(db.String, primary_key=True)
+    version = db.Column(db.String, primary_key=True)
+    resource = db.Column(db.String, primary_key=True)
+    # '' for cluster-scoped objects
+    namespace = db.Column(db.String, primary_key=True)
+    name = db.Column(db.String, primary_key=True)
+    resource_version = db.Column(db.BigInteger, nullable=False)
+    object = db.Column(db.Text, nullable=False)
+
+
+class ClusterEvent(db.Model):
+    """
+    Changes to a token's objects, one per resourceVersion, so workers can
+    catch up with each other and watches can resume
+    """
+    __tablename__ = 'cluster_events'
+    __table_args__ = (db.UniqueConstraint('user_token', 'resource_version'), )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_token = db.Column(db.UUID, nullable=False)
+    resource_version = db.Column(db.BigInteger, nullable=False)
+    # ADDED, MODIFIED or DELETED; META when only the snapshot changed and
+    # RESET when workers have to read the token's objects again
+    event_type = db.Column(db.String, nullable=False)
+    api_group = db.Column(db.String, nullable=True)
+    version = db.Column(db.String, nullable=True)
+    resource = db.Column(db.String, nullable=True)
+    object = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class CacheInvalidation(db.Model):
+    """
+    Paths whose APICache entries changed, polled by every worker to drop
+    the responses it holds in memory (see cache.InvalidationFeed)
+    """
+    __tablename__ = 'cache_invalidations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # None for predefined paths, which every token sees
+    user_token = db.Column(db.UUID, nullable=True)
+    api_path = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
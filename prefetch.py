@@ -0,0 +1,185 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from cache import response_cache
+from store import object_store, parse_resource_path
+
+logger = logging.getLogger(__name__)
+
+# Collections kubectl reads right after listing a resource, mostly for
+# `kubectl describe` (group, version, resource)
+EVENTS = ('', 'v1', 'events')
+FOLLOW_UPS = {
+    'pods': [EVENTS],
+    'deployments': [('apps', 'v1', 'replicasets'), EVENTS],
+    'replicasets': [EVENTS],
+    'statefulsets': [EVENTS],
+    'daemonsets': [EVENTS],
+    'services': [('', 'v1', 'endpoints'), EVENTS],
+    'jobs': [EVENTS],
+}
+
+
+def collection_path(group, version, resource, namespace):
+    prefix = f'/apis/{group}/{version}' if group else f'/api/{version}'
+    return f'{prefix}/namespaces/{namespace}/{resource}'
+
+
+class TokenPrefetch:
+
+    def __init__(self):
+        self.last_seen = monotonic()
+        self.spent = 0
+        self.pending = set()
+
+
+class Prefetcher:
+    """
+    Speculatively generate the collections a user is likely to ask for next
+    after a generated list response, e.g. the events of the namespace whose
+    pods were just listed. Single objects need no prefetch: every item of a
+    list already lands in the object store.
+
+    Prefetches run on a small dedicated pool, go through the same
+    SingleFlight key as a real request (so a request arriving mid-prefetch
+    joins it), spend at most `budget` generations per token and are
+    cancelled once the token has been idle for `idle_timeout` seconds.
+    Each prefetched generation is charged to the token's rate limit, and
+    skipped once the token is over it.
+    """
+
+    def __init__(self, flight, generate, rate_limiter=None, workers=4,
+                 budget=20, idle_timeout=120, max_namespaces=3):
+        self.flight = flight
+        self.generate = generate
+        self.rate_limiter = rate_limiter
+        self.enabled = workers > 0 and budget > 0
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1),
+                                           thread_name_prefix='prefetch')
+        self.budget = budget
+        self.idle_timeout = idle_timeout
+        self.max_namespaces = max_namespaces
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.over_budget = 0
+        self.rate_limited = 0
+
+    def touch(self, token):
+        """Record activity of a token; called for every real request"""
+        if not self.enabled:
+            return
+        with self.lock:
+            state = self.tokens.get(token)
+            if state is None:
+                state = self.tokens[token] = TokenPrefetch()
+            state.last_seen = monotonic()
+
+    def follow_ups(self, api_path, payload):
+        ref = parse_resource_path(api_path)
+        if (ref is None or ref.name is not None or ref.subresource is not None
+                or not isinstance(payload, dict)
+                or not isinstance(payload.get('items'), list)):
+            return []
+
+        namespaces = []
+        for item in payload['items']:
+            namespace = item.get('metadata', {}).get('namespace') if isinstance(
+                item, dict) else None
+            namespace = namespace or ref.namespace
+            if namespace and namespace not in namespaces:
+                namespaces.append(namespace)
+        return [
+            collection_path(group, version, resource, namespace)
+            for namespace in namespaces[:self.max_namespaces]
+            for group, version, resource in FOLLOW_UPS.get(ref.resource, [])
+        ]
+
+    def observe(self, token, api_path, payload):
+        """Schedule prefetches for the follow-ups of a generated list"""
+        if not self.enabled:
+            return
+        # A generation can outlast the idle timeout, the token is not idle
+        self.touch(token)
+        self._sweep()
+        for path in self.follow_ups(api_path, payload):
+            if (object_store.has_collection(token, path)
+                    or response_cache.contains(token, path)):
+                continue
+            with self.lock:
+                state = self.tokens.get(token)
+                if state is None:
+                    return
+                if state.spent >= self.budget:
+                    self.over_budget += 1
+                    return
+                state.spent += 1
+                self.scheduled += 1
+                job = self.executor.submit(self._prefetch, token, path)
+                state.pending.add(job)
+            job.add_done_callback(
+                lambda job, state=state: self._discard(state, job))
+
+    def _discard(self, state, job):
+        with self.lock:
+            state.pending.discard(job)
+
+    def _idle(self, state, now):
+        return now - state.last_seen > self.idle_timeout
+
+    def _sweep(self):
+        """Forget idle tokens and cancel the prefetches still queued for them"""
+        now = monotonic()
+        jobs = []
+        with self.lock:
+            idle = [t for t, s in self.tokens.items() if self._idle(s, now)]
+            for token in idle:
+                jobs.extend(self.tokens.pop(token).pending)
+        cancelled = sum(1 for job in jobs if job.cancel())
+        with self.lock:
+            self.cancelled += cancelled
+
+    def _prefetch(self, token, path):
+        with self.lock:
+            state = self.tokens.get(token)
+            if state is None or self._idle(state, monotonic()):
+                self.cancelled += 1
+                return
+        if (object_store.has_collection(token, path)
+                or response_cache.contains(token, path)):
+            return
+        if (self.rate_limiter is not None
+                and not self.rate_limiter.is_allowed(token, None)):
+            with self.lock:
+                self.rate_limited += 1
+            return
+
+        logger.debug(f"Prefetching {path}")
+        try:
+            self.flight.do((token, 'GET', path, ''), self.generate, token,
+                           'GET', path, {})
+            with self.lock:
+                self.completed += 1
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            logger.warning(f"Prefetch of {path} failed: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'tokens': len(self.tokens),
+                'pending': sum(len(s.pending) for s in self.tokens.values()),
+                'scheduled': self.scheduled,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'over_budget': self.over_budget,
+                'rate_limited': self.rate_limited
+            }
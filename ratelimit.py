@@ -0,0 +1,442 @@
+import fcntl
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from time import time
+
+from metrics import rate_limit_seconds, rejected_requests
+
+# Least recently used keys considered when a full shard must evict one
+EVICTION_CANDIDATES = 32
+
+
+def parse_overrides(spec):
+    """
+    Parse per-key limits such as "token:<uuid>=100,ip:10.0.0.1=20" into
+    {('token', '<uuid>'): 100, ('ip', '10.0.0.1'): 20}. A negative limit
+    means the key is not limited at all.
+    """
+    overrides = {}
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            key, limit = item.rsplit('=', 1)
+            kind, value = key.split(':', 1)
+        except ValueError:
+            raise ValueError(f"Invalid rate limit override: {item}")
+        if kind not in ('token', 'ip'):
+            raise ValueError(f"Invalid rate limit override kind: {kind}")
+        overrides[(kind, value.strip())] = int(limit)
+    return overrides
+
+
+def roll(counter, window_index):
+    """Move a [window, previous, current] counter forward to window_index"""
+    if counter[0] == window_index - 1:
+        counter[0:3] = [window_index, counter[2], 0]
+    elif counter[0] != window_index:
+        counter[0:3] = [window_index, 0, 0]
+
+
+class Shard:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [window index, previous window count, current window count]
+        self.counters = OrderedDict()
+        self.last_sweep = 0
+
+
+class RateLimiter:
+    """
+    Sliding-window-counter rate limiter for tokens and IPs.
+
+    Each key keeps only the counts of the current and previous fixed windows,
+    and the previous one is weighted by how much of it still overlaps the
+    sliding window, so memory per key is constant. Keys live in sharded LRU
+    maps: idle keys are swept once their windows have passed, and each shard
+    is capped so a scan from many IPs cannot grow memory or contend on a
+    single lock.
+    """
+
+    # Whether is_allowed does I/O and should be kept off an event loop
+    blocking = False
+
+    def __init__(self, requests_per_minute=60, window=60, shards=16,
+                 max_keys=100000, overrides=None):
+        self.requests_per_minute = requests_per_minute
+        self.window = window
+        self.shards = [Shard() for _ in range(shards)]
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        self.overrides = dict(overrides or {})
+
+    def set_limit(self, kind, key, requests_per_minute):
+        """Override the limit for one token or IP (kind is 'token' or 'ip')"""
+        self.overrides[(kind, key)] = requests_per_minute
+
+    def limit_for(self, kind, key):
+        return self.overrides.get((kind, key), self.requests_per_minute)
+
+    def keys(self, token, ip_address):
+        """The keys a request is counted under; no IP for internal work"""
+        keys = [('token', token)]
+        if ip_address is not None:
+            keys.append(('ip', ip_address))
+        return keys
+
+    def _shard(self, key):
+        return self.shards[zlib.crc32(repr(key).encode()) % len(self.shards)]
+
+    def _counter(self, shard, key, window_index):
+        """
+        The counter of a key. A key without one gets a fresh counter that is
+        only added to the shard by _record, so rejected requests never take
+        (or evict) a place.
+        """
+        counter = shard.counters.get(key)
+        if counter is None:
+            return [window_index, 0, 0]
+        shard.counters.move_to_end(key)
+        roll(counter, window_index)
+        return counter
+
+    def _record(self, shard, key, counter, window_index):
+        counter[2] += 1
+        if key in shard.counters:
+            return
+        if len(shard.counters) >= self.max_keys_per_shard:
+            # Evict among the least recently used keys: an idle one if
+            # there is one, otherwise the one that weighs the least, so a
+            # limited key is never the first to go
+            victim, rank = None, None
+            for candidate, (window, previous, current) in itertools.islice(
+                    shard.counters.items(), EVICTION_CANDIDATES):
+                if window < window_index - 1:
+                    victim = candidate
+                    break
+                if rank is None or (window, previous + current) < rank:
+                    victim, rank = candidate, (window, previous + current)
+            del shard.counters[victim]
+        shard.counters[key] = counter
+
+    def _sweep(self, shard, window_index):
+        # Counters from before the previous window no longer weigh anything.
+        # The map is in LRU order, so stop at the first key still in use.
+        if shard.last_sweep == window_index:
+            return
+        shard.last_sweep = window_index
+        while shard.counters:
+            key, counter = next(iter(shard.counters.items()))
+            if counter[0] >= window_index - 1:
+                break
+            del shard.counters[key]
+
+    def _estimate(self, counter, now):
+        elapsed = (now % self.window) / self.window
+        return counter[1] * (1 - elapsed) + counter[2]
+
+    def is_allowed(self, token, ip_address):
+        now = time()
+        window_index = int(now // self.window)
+        keys = self.keys(token, ip_address)
+        limits = [self.limit_for(kind, key) for kind, key in keys]
+
+        # Lock the shards in a fixed order so a token and an IP are checked
+        # and recorded together without deadlocking
+        shards = sorted({id(s): s for s in map(self._shard, keys)}.values(),
+                        key=self.shards.index)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            counters = []
+            for key, limit in zip(keys, limits):
+                shard = self._shard(key)
+                self._sweep(shard, window_index)
+                counter = self._counter(shard, key, window_index)
+                # Check if either token or IP is over limit
+                if limit >= 0 and self._estimate(counter, now) >= limit:
+                    return False
+                counters.append((shard, key, counter))
+
+            # If under limit, record the request for both
+            for shard, key, counter in counters:
+                self._record(shard, key, counter, window_index)
+            return True
+        finally:
+            for shard in shards:
+                shard.lock.release()
+
+    def check(self, token, ip_address):
+        """is_allowed, recorded in the rate limit metrics"""
+        with rate_limit_seconds.time():
+            allowed = self.is_allowed(token, ip_address)
+        if not allowed:
+            rejected_requests.inc('rate_limit')
+        return allowed
+
+    def init_app(self, app):
+        pass
+
+    def stats(self):
+        return {
+            'backend': 'memory',
+            'requests_per_minute': self.requests_per_minute,
+            'overrides': len(self.overrides),
+            'keys': sum(len(s.counters) for s in self.shards)
+        }
+
+
+class SharedMemoryRateLimiter(RateLimiter):
+    """
+    Rate limiter whose counters live in a memory-mapped file (under /dev/shm
+    by default), so every worker process on the host shares one limit.
+
+    The file is a fixed-size open-addressing table split into stripes. Each
+    slot holds a 64-bit key hash and the same window/previous/current
+    counters as the in-process limiter. Stripes are guarded by a thread lock
+    plus an fcntl byte-range lock for other processes, so a check is a
+    couple of struct reads and writes under two uncontended locks.
+    """
+
+    MAGIC = b'KAISIMRL'
+    HEADER = struct.Struct('<8sII')
+    SLOT = struct.Struct('<QqII')
+    MAX_PROBES = 32
+
+    def __init__(self, path, requests_per_minute=60, window=60, shards=16,
+                 max_keys=100000, overrides=None):
+        super().__init__(requests_per_minute=requests_per_minute,
+                         window=window, shards=shards, max_keys=max_keys,
+                         overrides=overrides)
+        self.path = path
+        self.stripes = shards
+        self.slots_per_stripe = self.max_keys_per_shard
+        self.stripe_size = self.slots_per_stripe * self.SLOT.size
+        self.size = self.HEADER.size + self.stripes * self.stripe_size
+        self.thread_locks = [threading.Lock() for _ in range(self.stripes)]
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != self.size:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+            self.mm = mmap.mmap(self.fd, self.size)
+            header = self.HEADER.unpack_from(self.mm, 0)
+            expected = (self.MAGIC, self.stripes, self.slots_per_stripe)
+            if header != expected:
+                # Fresh file or another layout: start from empty counters
+                self.mm[:] = bytes(self.size)
+                self.HEADER.pack_into(self.mm, 0, *expected)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _key_hash(self, key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, 'little') or 1
+
+    def _stripe(self, key_hash):
+        return key_hash % self.stripes
+
+    def _lock(self, stripe):
+        self.thread_locks[stripe].acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripe_size,
+                    self.HEADER.size + stripe * self.stripe_size)
+
+    def _unlock(self, stripe):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripe_size,
+                    self.HEADER.size + stripe * self.stripe_size)
+        self.thread_locks[stripe].release()
+
+    def _slot_counter(self, key_hash, window_index):
+        """
+        Find the slot of a key and return its counter. A key without a slot
+        gets a fresh counter whose offset is None; _claim gives it a slot
+        once a request is actually recorded for it.
+        """
+        for offset in self._probe(key_hash):
+            slot_hash, window, previous, current = self.SLOT.unpack_from(
+                self.mm, offset)
+            if slot_hash == key_hash:
+                counter = [window, previous, current, offset]
+                roll(counter, window_index)
+                return counter
+        return [window_index, 0, 0, None]
+
+    def _probe(self, key_hash):
+        """Offsets of the slots a key may live in, in probe order"""
+        stripe = self._stripe(key_hash)
+        base = self.HEADER.size + stripe * self.stripe_size
+        start = (key_hash // self.stripes) % self.slots_per_stripe
+        for probe in range(min(self.MAX_PROBES, self.slots_per_stripe)):
+            yield base + ((start + probe) % self.slots_per_stripe) * \
+                self.SLOT.size
+
+    def _claim(self, key_hash, window_index):
+        """
+        Pick the slot for a new key: an empty or idle one, otherwise the one
+        with the oldest window and then the lowest count, so busy (and
+        limited) keys are the last to be evicted
+        """
+        victim = None
+        for offset in self._probe(key_hash):
+            slot_hash, window, previous, current = self.SLOT.unpack_from(
+                self.mm, offset)
+            if slot_hash == 0 or window < window_index - 1:
+                return offset
+            rank = (window, previous + current)
+            if victim is None or rank < victim[1]:
+                victim = (offset, rank)
+        return victim[0]
+
+    def is_allowed(self, token, ip_address):
+        now = time()
+        window_index = int(now // self.window)
+        keys = self.keys(token, ip_address)
+        limits = [self.limit_for(kind, key) for kind, key in keys]
+        hashes = [self._key_hash(key) for key in keys]
+
+        stripes = sorted({self._stripe(h) for h in hashes})
+        for stripe in stripes:
+            self._lock(stripe)
+        try:
+            counters = []
+            for key_hash, limit in zip(hashes, limits):
+                counter = self._slot_counter(key_hash, window_index)
+                if limit >= 0 and self._estimate(counter, now) >= limit:
+                    return False
+                counters.append((key_hash, counter))
+
+            # Only recorded requests take (or evict) a slot
+            for key_hash, counter in counters:
+                offset = counter[3]
+                if offset is None:
+                    offset = self._claim(key_hash, window_index)
+                self.SLOT.pack_into(self.mm, offset, key_hash,
+                                    counter[0], counter[1], counter[2] + 1)
+            return True
+        finally:
+            for stripe in reversed(stripes):
+                self._unlock(stripe)
+
+    def stats(self):
+        used = 0
+        for offset in range(self.HEADER.size, self.size, self.SLOT.size):
+            if self.SLOT.unpack_from(self.mm, offset)[0]:
+                used += 1
+        return {
+            'backend': 'shm',
+            'requests_per_minute': self.requests_per_minute,
+            'overrides': len(self.overrides),
+            'keys': used
+        }
+
+
+class PostgresRateLimiter(RateLimiter):
+    """
+    Rate limiter backed by a rate_limit_counters table, for deployments that
+    spread workers over several hosts.
+
+    One statement upserts the request's counters for the current window and
+    returns them with the previous window's counts. The upsert's row locks make the
+    check-and-record atomic across hosts, and a rejected request is rolled
+    back so it is not counted.
+    """
+
+    blocking = True
+
+    CHECK = """
+        WITH hits AS (
+            INSERT INTO rate_limit_counters (key, window_index, count)
+            VALUES {values}
+            ON CONFLICT (key, window_index)
+            DO UPDATE SET count = rate_limit_counters.count + 1
+            RETURNING key, count)
+        SELECT hits.key, hits.count - 1, COALESCE(previous.count, 0)
+        FROM hits LEFT JOIN rate_limit_counters previous
+            ON previous.key = hits.key
+            AND previous.window_index = :window_index - 1
+    """
+    SWEEP = "DELETE FROM rate_limit_counters WHERE window_index < :window_index - 1"
+
+    def __init__(self, requests_per_minute=60, window=60, overrides=None):
+        super().__init__(requests_per_minute=requests_per_minute,
+                         window=window, shards=1, overrides=overrides)
+        self.engine = None
+        self.last_sweep = 0
+
+    def init_app(self, app):
+        from models import db
+        with app.app_context():
+            self.engine = db.engine
+
+    def is_allowed(self, token, ip_address):
+        from sqlalchemy import text
+
+        now = time()
+        window_index = int(now // self.window)
+        keys = {f'{kind}:{key}': self.limit_for(kind, key)
+                for kind, key in self.keys(token, ip_address)}
+        params = {f'key_{i}': key for i, key in enumerate(keys)}
+        values = ', '.join(f'(:{param}, :window_index, 1)' for param in params)
+
+        with self.engine.connect() as connection:
+            if self.last_sweep != window_index:
+                self.last_sweep = window_index
+                connection.execute(text(self.SWEEP),
+                                   {'window_index': window_index})
+                connection.commit()
+
+            rows = connection.execute(
+                text(self.CHECK.format(values=values)),
+                dict(params, window_index=window_index)).all()
+            for key, current, previous in rows:
+                limit = keys[key]
+                counter = [window_index, previous, current]
+                if limit >= 0 and self._estimate(counter, now) >= limit:
+                    connection.rollback()
+                    return False
+            connection.commit()
+            return True
+
+    def stats(self):
+        return {
+            'backend': 'postgres',
+            'requests_per_minute': self.requests_per_minute,
+            'overrides': len(self.overrides)
+        }
+
+
+def create_rate_limiter(requests_per_minute=5):
+    """
+    Build the rate limiter selected by RATE_LIMIT_BACKEND: 'memory' (per
+    process), 'shm' (shared by the workers on one host) or 'postgres'
+    (shared by every host using the database)
+    """
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'memory').lower()
+    options = {
+        'requests_per_minute':
+        int(os.getenv('RATE_LIMIT_PER_MINUTE', requests_per_minute)),
+        'overrides': parse_overrides(os.getenv('RATE_LIMIT_OVERRIDES', ''))
+    }
+    max_keys = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+
+    if backend == 'memory':
+        return RateLimiter(max_keys=max_keys, **options)
+    if backend == 'shm':
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        path = os.getenv('RATE_LIMIT_SHM_PATH',
+                         os.path.join(shm_dir, 'kaisim-ratelimit'))
+        return SharedMemoryRateLimiter(path, max_keys=max_keys, **options)
+    if backend == 'postgres':
+        return PostgresRateLimiter(**options)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
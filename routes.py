@@ -1,29 +1,59 @@
-from flask import request, jsonify, render_template
+from flask import request, jsonify, render_template, Response, stream_with_context
+import base64
+import binascii
+import itertools
 import json
+import os
 from datetime import datetime
-import signal
 import uuid
 from functools import wraps
 from app import app, logger
-from utils import validate_request, create_response, simulate_kubernetes_api, markdown_json_to_dict
-from models import db, APICache, retry_on_disconnect, rate_limiter
+from utils import validate_request, parse_bearer_token, client_ip
+from models import db, APICache, CacheInvalidation, retry_on_disconnect, rate_limiter
+from database import bulk_upsert_cache, execute_read, iter_cache_entries, note_write
+from cache import response_cache, predefined_snapshot, invalidation_feed, get_cached_response, cache_control_for, etag_matches, CachedBody
+from breaker import DATABASE_ERRORS, CircuitOpenError, db_breaker
+from simulator import llm_flight, prefetcher, start_generation, wait_for_generation
+from deadline import Deadline, DeadlineExceeded
+from writebehind import persist_queue
+from store import object_store, parse_resource_path, status_response
+from selector import SELECTOR_PARAMS, SelectorError, list_selector, without_selectors
+from generators import template_generator
+from discovery import AGGREGATED_MEDIA_TYPE, negotiate, get_aggregated_discovery, invalidate as invalidate_discovery
+from crew_pool import crew_pool
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, rejected_requests, render as render_metrics
+from watch import WATCH_THREADED, is_watch, can_watch, watch_events, WatchParams
+
+CACHE_BULK_BATCH_SIZE = int(os.getenv('CACHE_BULK_BATCH_SIZE', 500))
+
+persist_queue.init_app(app)
+rate_limiter.init_app(app)
+object_store.init_app(app)
+predefined_snapshot.init_app(app)
+invalidation_feed.init_app(app)
+invalidation_feed.subscribe(invalidate_discovery)
 
 
 def require_token(f):
 
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify(
-                {'error': 'Missing or invalid Authorization header'}), 401
+        token, error = parse_bearer_token(
+            request.headers.get('Authorization'))
+        if error:
+            return jsonify({'error': error}), 401
 
-        token = auth_header.split(' ')[1]
-        try:
-            uuid.UUID(token)
-        except ValueError:
-            return jsonify({'error':
-                            'Invalid token format - must be UUID'}), 401
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def require_database(f):
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if db_breaker.is_open():
+            return database_unavailable()
 
         return f(*args, **kwargs)
 
@@ -48,7 +78,9 @@ def root():
             "simulate kubernetes api requests and get responses generated with AI",
             "/details":
             "the endpoint to share all request details, for testing purposes",
-            "/cache": "provide cached responses to API requests"
+            "/cache": "provide cached responses to API requests",
+            "/cache/bulk": "store many cache entries from an NDJSON body",
+            "/cache/export": "download your cache entries as NDJSON"
         })
     ])
 
@@ -89,106 +121,203 @@ def request_details():
     return jsonify(details), 200
 
 
+def rate_limit_exceeded():
+    return jsonify({
+        'error':
+        'Rate limit exceeded',
+        'message':
+        f'Please try again later. Limit is {rate_limiter.requests_per_minute} requests per minute to non-cached endpoints.'
+    }), 429
+
+
+def database_unavailable():
+    response = jsonify({
+        'error': 'Database unavailable',
+        'message': 'Cache management is disabled until the database recovers. Please try again later.'
+    })
+    response.headers['Retry-After'] = str(int(db_breaker.reset_timeout))
+    return response, 503
+
+
+def cached_body_response(cached, content_type='application/json'):
+    """
+    Send a cached body as stored, precompressed if the client accepts it,
+    or a 304 if the client's copy is still current
+    """
+    encoding, body, etag = cached.encode_for(
+        request.headers.get('Accept-Encoding'))
+    headers = {
+        'ETag': etag,
+        'Cache-Control': cache_control_for(request.path),
+        'Vary': 'Accept, Accept-Encoding'
+    }
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return Response(status=304, headers=headers)
+
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(body, content_type=content_type, headers=headers)
+
+
+def stream_watch(auth_token, api_path, ip_address, deadline):
+    """Answer a ?watch=true request with a stream of WatchEvents"""
+    ref = parse_resource_path(api_path)
+    if ref is None or ref.subresource is not None:
+        return jsonify({'error': 'Watch is only supported on resources'}), 400
+    if not WATCH_THREADED:
+        return jsonify(status_response(
+            405, 'MethodNotAllowed',
+            'watch is served by the asyncio mode (asgi.py); set '
+            'WATCH_THREADED=true to serve it from worker threads', ref)), 405
+    if not can_watch():
+        rejected_requests.inc('watches')
+        return jsonify({'error': 'Too many open watches'}), 429
+
+    try:
+        params = WatchParams(request.args, deadline)
+    except SelectorError as e:
+        return jsonify({'error': 'Invalid selector', 'message': str(e)}), 400
+    except ValueError:
+        return jsonify({'error': 'Invalid timeoutSeconds value'}), 400
+
+    # A watch without a resourceVersion starts with the current objects, so
+    # make sure the collection was listed at least once
+    list_path = api_path.rsplit('/', 1)[0] if ref.name else api_path
+    if (params.resource_version in (None, '', '0') and
+            not object_store.has_collection(auth_token, list_path)):
+        cached_response = get_cached_response(auth_token, list_path, deadline)
+        if cached_response is not None:
+            object_store.ingest(auth_token, list_path, cached_response.json())
+        else:
+            deadline.check('rate limit check')
+            if not rate_limiter.check(auth_token, ip_address):
+                return rate_limit_exceeded()
+            generation = start_generation(auth_token, 'GET', list_path, '', {})
+            wait_for_generation(generation, deadline)
+
+    return Response(watch_events(auth_token, api_path, params),
+                    mimetype='application/json')
+
+
 @app.route('/openapi/<path:dynamic_path>', methods=['GET'])
 @app.route('/api', methods=['GET'])
 @app.route('/apis', methods=['GET'])
 @app.route('/version', methods=['GET'])
 @app.route('/api/<path:dynamic_path>',
            methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
-@app.route('/apis/<path:dynamic_path>', methods=['GET'])
+@app.route('/apis/<path:dynamic_path>',
+           methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
 @require_token
 def handle_dynamic_path(dynamic_path=""):
 
+    # Get timeout from query parameter (e.g., ?timeout=30s, as kubectl
+    # sends for --request-timeout)
     try:
-        # Get timeout from query parameter (e.g., ?timeout=30s)
-        timeout_str = request.args.get('timeout', '')
-        timeout = None
-        if timeout_str:
-            try:
-                # Remove 's' suffix if present and convert to float
-                timeout = float(timeout_str.rstrip('s'))
-                if timeout <= 0:
-                    raise ValueError("Timeout must be positive")
-            except ValueError:
-                return jsonify({
-                    'error':
-                    'Invalid timeout value',
-                    'message':
-                    'Timeout must be a positive number in seconds (e.g., 30 or 30s)'
-                }), 400
-
-        from functools import partial
-        from flask import copy_current_request_context
+        deadline = Deadline.from_param(request.args.get('timeout', ''))
+    except ValueError:
+        return jsonify({
+            'error':
+            'Invalid timeout value',
+            'message':
+            'Timeout must be a positive duration (e.g., 30, 30s, 1m30s or 500ms)'
+        }), 400
 
-        try:
-            if timeout:
-                signal.alarm(int(timeout))
-            # Validate the request
-            validation_result = validate_request(request)
-            if not validation_result['valid']:
-                return jsonify({
-                    'error': 'Invalid request',
-                    'details': validation_result['message']
-                }), 400
-
-            # Log the incoming request
-            logger.debug(
-                f"Received {request.method} request for path: {dynamic_path}")
-            logger.debug(f"Request headers: {dict(request.headers)}")
-            logger.debug(f"Request data: {request.get_json(silent=True)}")
-
-            api_path = request.path
-            auth_token = request.headers.get('Authorization').split(' ')[1]
-
-            # First try to find user's cache entry
-            cache_entry = APICache.query.filter_by(
-                api_path=api_path, user_token=uuid.UUID(auth_token)).order_by(
-                    APICache.created_at.desc()).first()
-
-            # If no user cache found, look for predefined entry
-            if not cache_entry:
-                cache_entry = APICache.query.filter_by(
-                    api_path=api_path, is_predefined=True).order_by(
-                        APICache.created_at.desc()).first()
-
-            if cache_entry:
-                return jsonify(json.loads(cache_entry.response)), 200
-
-            # Get IP from X-Forwarded-For or fallback to remote_addr
-            ip_address = request.headers.get('X-Forwarded-For',
-                                             request.remote_addr)
-            if ip_address and ',' in ip_address:
-                ip_address = ip_address.split(',')[0].strip()
-
-            # Check rate limit for both token and IP
-            if not rate_limiter.is_allowed(auth_token, ip_address):
-                return jsonify({
-                    'error':
-                    'Rate limit exceeded',
-                    'message':
-                    'Please try again later. Limit is 5 requests per minute to non-cached endpoints.'
-                }), 429
-
-            # If not in cache, generate response
-            raw_simulated_response = simulate_kubernetes_api(request)
-            return jsonify(markdown_json_to_dict(raw_simulated_response))
-        except Exception as e:
-            logger.error(f"Error processing request: {str(e)}")
+    try:
+        # Validate the request
+        validation_result = validate_request(request)
+        if not validation_result['valid']:
             return jsonify({
-                'error': 'Internal server error',
-                'message': str(e)
-            }), 500
-
-    except TimeoutError:
-        signal.alarm(0)  # Disable the alarm
+                'error': 'Invalid request',
+                'details': validation_result['message']
+            }), 400
+
+        # Log the incoming request
+        logger.debug(
+            f"Received {request.method} request for path: {dynamic_path}")
+        logger.debug(f"Request headers: {dict(request.headers)}")
+        logger.debug(f"Request data: {request.get_json(silent=True)}")
+
+        api_path = request.path
+        auth_token = request.headers.get('Authorization').split(' ')[1]
+
+        ip_address = client_ip(request.headers.get('X-Forwarded-For'),
+                               request.remote_addr)
+        prefetcher.touch(auth_token)
+
+        if request.method == 'GET' and is_watch(request.args):
+            return stream_watch(auth_token, api_path, ip_address, deadline)
+
+        # kubectl asks /api and /apis for everything in one document
+        discovery_version = (negotiate(request.headers.get('Accept'))
+                             if api_path in ('/api', '/apis') else None)
+        if discovery_version:
+            deadline.check('discovery lookup')
+            aggregated = get_aggregated_discovery(auth_token, api_path,
+                                                  discovery_version)
+            if aggregated is not None:
+                return cached_body_response(
+                    aggregated,
+                    AGGREGATED_MEDIA_TYPE.format(discovery_version))
+
+        # Label and field selectors filter the collection's full list
+        # locally, wherever it comes from
+        selector = None
+        if request.method == 'GET':
+            try:
+                selector = list_selector(api_path, request.args)
+            except SelectorError as e:
+                return jsonify({'error': 'Invalid selector', 'message': str(e)}), 400
+
+        # Objects this token already has are answered (or changed) locally
+        if request.method == 'GET':
+            local_response = object_store.lookup(auth_token, api_path)
+        else:
+            local_response = object_store.mutate(auth_token, request.method,
+                                                 api_path,
+                                                 request.get_json(silent=True),
+                                                 request.content_type or '')
+        if local_response is not None:
+            if selector is not None:
+                return jsonify(selector.filter_list(local_response[0])), local_response[1]
+            return jsonify(local_response[0]), local_response[1]
+
+        cached_response = get_cached_response(auth_token, api_path, deadline)
+        if cached_response is not None:
+            if request.method == 'GET' and parse_resource_path(api_path):
+                object_store.ingest(auth_token, api_path,
+                                    cached_response.json())
+            if selector is not None:
+                return jsonify(selector.filter_list(cached_response.json()))
+            return cached_body_response(cached_response)
+
+        # Check rate limit for both token and IP
+        deadline.check('rate limit check')
+        if not rate_limiter.check(auth_token, ip_address):
+            return rate_limit_exceeded()
+
+        # If not in cache, generate response (the unfiltered list, if
+        # selected, so it is cached and stored for every selector)
+        query_string = request.query_string.decode()
+        query_args = request.args.to_dict()
+        if selector is not None:
+            query_string = without_selectors(query_string)
+            query_args = {k: v for k, v in query_args.items()
+                          if k not in SELECTOR_PARAMS}
+        generation = start_generation(auth_token, request.method, api_path,
+                                      query_string, query_args)
+        simulated_response = wait_for_generation(generation, deadline)
+        if selector is not None:
+            return jsonify(selector.filter_list(simulated_response))
+        return jsonify(simulated_response)
+
+    except DeadlineExceeded as e:
+        logger.info(f"Request for {request.path} timed out: {str(e)}")
         return jsonify({
             'error': 'Timeout',
-            'message': f'Request timed out after {timeout} seconds'
+            'message': f'Request timed out after {deadline.timeout} seconds'
         }), 408
 
     except Exception as e:
-        if timeout:
-            signal.alarm(0)  # Disable the alarm
         logger.error(f"Error processing request: {str(e)}")
         return jsonify({
             'error': 'Internal server error',
@@ -220,8 +349,19 @@ def store_cache_entry():
             response=data['response'],
             is_predefined=False  # Explicitly set to False
         )
-        db.session.add(cache_entry)
-        db.session.commit()
+        try:
+            with db_breaker.guard():
+                db.session.add(cache_entry)
+                db.session.add(CacheInvalidation(user_token=cache_entry.user_token,
+                                                 api_path=cache_entry.api_path))
+                db.session.commit()
+        except (CircuitOpenError,) + DATABASE_ERRORS:
+            db.session.rollback()
+            return queue_cache_entry(auth_token, data['api_path'], data['response'])
+        note_write(auth_token)
+        response_cache.invalidate(auth_token, data['api_path'])
+        invalidate_discovery(auth_token, data['api_path'])
+        object_store.forget(auth_token, data['api_path'])
         return jsonify({
             'message': 'Cache entry stored successfully',
             'cache_id': str(cache_entry.cache_id)
@@ -231,42 +371,280 @@ def store_cache_entry():
         return jsonify({'error': 'Failed to store cache entry'}), 500
 
 
+def queue_cache_entry(auth_token, api_path, response):
+    """
+    Accept a cache entry while the database is down: serve it from memory
+    and let the write-behind queue store it once the database is back
+    """
+    cache_id = persist_queue.enqueue(auth_token, api_path, response,
+                                     invalidate=True)
+    if cache_id is None:
+        return database_unavailable()
+    serve_queued_entry(auth_token, api_path, response)
+    return jsonify({
+        'message': 'Database unavailable, cache entry queued for storing',
+        'cache_id': str(cache_id)
+    }), 202
+
+
+def serve_queued_entry(auth_token, api_path, response):
+    """Answer from a queued entry until the database has it"""
+    response_cache.set(auth_token, api_path, CachedBody(response))
+    invalidate_discovery(auth_token, api_path)
+    object_store.forget(auth_token, api_path)
+
+
+@app.route('/cache/bulk', methods=['POST'])
+@require_token
+def bulk_store_cache_entries():
+    """
+    Store cache entries from an NDJSON body (one POST /cache payload per
+    line) and stream back one result per line. Lines are read and written
+    in batches, so the payload is never held in memory as a whole. While
+    the database is down entries are queued for storing, like POST /cache
+    does, and reported as queued.
+    """
+    auth_token = request.headers.get('Authorization').split(' ')[1]
+
+    def parse(line):
+        data = json.loads(line)
+        if (not isinstance(data, dict) or 'api_path' not in data
+                or 'response' not in data):
+            raise ValueError('Missing required fields')
+        if data.get('is_predefined', False):
+            return None
+        response = data['response']
+        return {
+            'user_token': uuid.UUID(auth_token),
+            'api_path': data['api_path'],
+            'response': response if isinstance(response, str) else json.dumps(response),
+            'is_predefined': False
+        }
+
+    def queue(entry):
+        if not persist_queue.enqueue_upsert(auth_token, entry['api_path'],
+                                            entry['response']):
+            return 'error'
+        serve_queued_entry(auth_token, entry['api_path'], entry['response'])
+        return 'queued'
+
+    def store_row(entry):
+        try:
+            bulk_upsert_cache([entry], batch_size=1)
+            return 'stored'
+        except (CircuitOpenError,) + DATABASE_ERRORS:
+            return queue(entry)
+        except Exception as e:
+            logger.error(f"Error storing cache entry: {str(e)}")
+            return 'error'
+
+    def store(batch):
+        try:
+            bulk_upsert_cache([entry for _, entry in batch],
+                              batch_size=len(batch))
+            stored = [(number, entry, 'stored') for number, entry in batch]
+        except (CircuitOpenError,) + DATABASE_ERRORS as e:
+            logger.warning(f"Database unavailable, queueing {len(batch)} "
+                           f"cache entries: {str(e)}")
+            stored = [(number, entry, queue(entry)) for number, entry in batch]
+        except Exception as e:
+            # One bad row fails the whole batch; find out which rows it was
+            logger.error(f"Error storing cache batch, retrying row by row: {str(e)}")
+            stored = [(number, entry, store_row(entry)) for number, entry in batch]
+        for number, entry, status in stored:
+            if status == 'stored':
+                result = {'status': 'stored'}
+                note_write(auth_token)
+                response_cache.invalidate(auth_token, entry['api_path'])
+                invalidate_discovery(auth_token, entry['api_path'])
+                object_store.forget(auth_token, entry['api_path'])
+            elif status == 'queued':
+                result = {'status': 'queued'}
+            else:
+                result = {'status': 'error', 'error': 'Failed to store cache entry'}
+            yield json.dumps(dict(result, line=number,
+                                  api_path=entry['api_path'])) + '\n'
+
+    def results():
+        batch = []
+        for number, line in enumerate(request.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = parse(line)
+            except ValueError as e:
+                yield json.dumps({'line': number, 'status': 'error',
+                                  'error': str(e)}) + '\n'
+                continue
+            if entry is None:
+                # Predefined entries in an export already exist for
+                # everyone; only init_cache.py stores them
+                yield json.dumps({'line': number, 'status': 'skipped',
+                                  'reason': 'predefined entry'}) + '\n'
+                continue
+            batch.append((number, entry))
+            if len(batch) >= CACHE_BULK_BATCH_SIZE:
+                yield from store(batch)
+                batch = []
+        if batch:
+            yield from store(batch)
+
+    return Response(stream_with_context(results()),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/cache/export', methods=['GET'])
+@require_token
+@require_database
+def export_cache_entries():
+    """
+    Stream the user's cache entries as NDJSON that POST /cache/bulk accepts.
+    ?predefined=true includes the predefined entries, marked is_predefined;
+    /cache/bulk reports those lines as skipped rather than storing them.
+    """
+    auth_token = request.headers.get('Authorization').split(' ')[1]
+    include_predefined = request.args.get('predefined',
+                                          '').lower() in ('true', '1')
+
+    def lines():
+        for row in iter_cache_entries(
+                uuid.UUID(auth_token), include_predefined,
+                columns=[APICache.api_path, APICache.response,
+                         APICache.is_predefined, APICache.created_at],
+                batch_size=CACHE_BULK_BATCH_SIZE):
+            yield json.dumps({
+                'api_path': row.api_path,
+                'response': row.response,
+                'is_predefined': row.is_predefined,
+                'created_at': row.created_at.isoformat()
+            }) + '\n'
+
+    return Response(stream_with_context(lines()),
+                    mimetype='application/x-ndjson')
+
+
+CACHE_LIST_FIELDS = ('cache_id', 'api_path', 'response', 'created_at',
+                     'is_predefined')
+
+
+def encode_continue(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_continue(token):
+    return int(base64.urlsafe_b64decode(token.encode()).decode())
+
+
 @app.route('/cache', methods=['GET'])
 @require_token
+@require_database
 def get_all_cache_entries():
-    """Get all cache entries for a user"""
+    """
+    Get the cache entries of a user, newest first, as a streamed list.
+    ?limit=N pages the list; pass the returned `continue` value to get the
+    next page. ?fields= picks the fields to return and ?truncate=N cuts
+    each response to N characters.
+    """
     auth_token = request.headers.get('Authorization').split(' ')[1]
     try:
-        cache_entries = APICache.query.filter(
-            db.or_(APICache.user_token == uuid.UUID(auth_token),
-                   APICache.is_predefined == True)).order_by(
-                       APICache.created_at.desc()).all()
-
-        entries = [{
-            'cache_id': str(entry.cache_id),
-            'api_path': entry.api_path,
-            'response': entry.response,
-            'created_at': entry.created_at.isoformat(),
-            'is_predefined': entry.is_predefined
-        } for entry in cache_entries]
-
-        return jsonify({'entries': entries}), 200
+        limit = int(request.args.get('limit', 0))
+        truncate = int(request.args.get('truncate', 0))
+        after_id = (decode_continue(request.args['continue'])
+                    if request.args.get('continue') else None)
+        if limit < 0 or truncate < 0:
+            raise ValueError
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return jsonify({'error': 'Invalid limit, truncate or continue value'}), 400
+
+    fields = [f.strip() for f in request.args.get('fields', '').split(',')
+              if f.strip()] or list(CACHE_LIST_FIELDS)
+    unknown = set(fields) - set(CACHE_LIST_FIELDS)
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+
+    # Only read the columns we return, and only the part of the response
+    columns = [getattr(APICache, f) for f in fields if f != 'response']
+    if 'response' in fields and truncate:
+        columns += [db.func.substr(APICache.response, 1, truncate).label('response'),
+                    db.func.length(APICache.response).label('response_length')]
+    elif 'response' in fields:
+        columns.append(APICache.response)
+
+    def entry(row):
+        data = {}
+        for field in fields:
+            value = getattr(row, field)
+            if field == 'cache_id':
+                value = str(value)
+            elif field == 'created_at':
+                value = value.isoformat()
+            data[field] = value
+        if 'response' in fields and truncate and row.response_length > truncate:
+            data['response_truncated'] = True
+        return json.dumps(data)
+
+    rows = iter_cache_entries(uuid.UUID(auth_token), columns=columns,
+                              after_id=after_id, newest_first=True,
+                              batch_size=min(limit + 1, CACHE_BULK_BATCH_SIZE)
+                              if limit else CACHE_BULK_BATCH_SIZE)
+    try:
+        # Run the first query before the response starts, so a database
+        # error still gets a proper status code
+        first = next(rows, None)
     except Exception as e:
         logger.error(f"Error retrieving cache entries: {str(e)}")
         return jsonify({'error': 'Failed to retrieve cache entries'}), 500
 
+    def stream():
+        yield '{"entries": ['
+        last_id = None
+        for count, row in enumerate(itertools.chain([first], rows) if first else []):
+            if limit and count == limit:
+                yield '], "continue": ' + json.dumps(encode_continue(last_id)) + '}'
+                return
+            yield (',' if count else '') + entry(row)
+            last_id = row.id
+        yield ']}'
+
+    return Response(stream_with_context(stream()), mimetype='application/json')
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Show in-process response cache counters"""
+    return jsonify({
+        'response_cache': response_cache.stats(),
+        'llm_flight': llm_flight.stats(),
+        'write_behind': persist_queue.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'object_store': object_store.stats(),
+        'template_generator': template_generator.stats(),
+        'prefetch': prefetcher.stats(),
+        'crew_pool': crew_pool.stats(),
+        'db_breaker': db_breaker.stats(),
+        'predefined_snapshot': predefined_snapshot.stats(),
+        'invalidations': invalidation_feed.stats()
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Latency histograms and counters of this process for Prometheus"""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 
 @app.route('/cache/<uuid:cache_id>', methods=['GET'])
 @require_token
+@require_database
 def get_cache_entry(cache_id):
     """Get a cache entry by its ID"""
     auth_token = request.headers.get('Authorization').split(' ')[1]
     try:
-        cache_entry = APICache.query.filter(
+        cache_entry = execute_read(db.select(APICache).where(
             db.and_(
                 APICache.cache_id == cache_id,
                 db.or_(APICache.user_token == uuid.UUID(auth_token),
-                       APICache.is_predefined == True))).first()
+                       APICache.is_predefined == True))).limit(1)).scalars().first()
 
         if cache_entry:
             cache_response = {
@@ -288,21 +666,33 @@ def delete_cache_entry(cache_id):
     """Delete a cache entry by its ID"""
     auth_token = request.headers.get('Authorization').split(' ')[1]
     try:
-        cache_entry = APICache.query.filter_by(cache_id=cache_id).first()
-
-        if not cache_entry:
-            return jsonify({'error': 'Cache entry not found'}), 404
-
-        if cache_entry.is_predefined:
-            return jsonify({'error':
-                            'Cannot delete predefined cache entries'}), 403
-
-        if cache_entry.user_token != uuid.UUID(auth_token):
-            return jsonify(
-                {'error': 'Unauthorized to delete this cache entry'}), 403
-
-        db.session.delete(cache_entry)
-        db.session.commit()
+        try:
+            with db_breaker.guard():
+                cache_entry = APICache.query.filter_by(cache_id=cache_id).first()
+
+                if not cache_entry:
+                    return jsonify({'error': 'Cache entry not found'}), 404
+
+                if cache_entry.is_predefined:
+                    return jsonify({'error':
+                                    'Cannot delete predefined cache entries'}), 403
+
+                if cache_entry.user_token != uuid.UUID(auth_token):
+                    return jsonify(
+                        {'error': 'Unauthorized to delete this cache entry'}), 403
+
+                api_path = cache_entry.api_path
+                db.session.delete(cache_entry)
+                db.session.add(CacheInvalidation(user_token=cache_entry.user_token,
+                                                 api_path=api_path))
+                db.session.commit()
+        except (CircuitOpenError,) + DATABASE_ERRORS:
+            db.session.rollback()
+            return queue_cache_deletion(auth_token, cache_id)
+        note_write(auth_token)
+        response_cache.invalidate(auth_token, api_path)
+        invalidate_discovery(auth_token, api_path)
+        object_store.forget(auth_token, api_path)
 
         return jsonify({'message': 'Cache entry deleted successfully'}), 200
     except Exception as e:
@@ -310,6 +700,20 @@ def delete_cache_entry(cache_id):
         return jsonify({'error': 'Failed to delete cache entry'}), 500
 
 
+def queue_cache_deletion(auth_token, cache_id):
+    """
+    Accept a deletion while the database is down; the write-behind queue
+    deletes the entry once the database is back, if it is one of the
+    user's. Its path is not known until then, so workers may keep serving
+    the entry from memory until the deletion is written.
+    """
+    if not persist_queue.enqueue_delete(auth_token, cache_id):
+        return database_unavailable()
+    return jsonify({
+        'message': 'Database unavailable, cache entry deletion queued'
+    }), 202
+
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Not found'}), 404
@@ -0,0 +1,148 @@
+import re
+from urllib.parse import parse_qsl, urlencode
+
+from store import parse_resource_path
+
+SELECTOR_PARAMS = ('labelSelector', 'fieldSelector')
+
+# Label keys may have a DNS prefix, e.g. app.kubernetes.io/name
+LABEL_KEY = r'[A-Za-z0-9](?:[-A-Za-z0-9_./]*[A-Za-z0-9])?'
+LABEL_VALUE = r'[-A-Za-z0-9_.]*'
+EXISTS = re.compile(rf'^(!?)\s*({LABEL_KEY})$')
+EQUALITY = re.compile(rf'^({LABEL_KEY})\s*(==|=|!=)\s*({LABEL_VALUE})$')
+SET = re.compile(rf'^({LABEL_KEY})\s+(in|notin)\s*\(([^()]*)\)$')
+FIELD = re.compile(r'^([A-Za-z0-9_.]+)\s*(==|=|!=)\s*(.*)$')
+
+
+class SelectorError(ValueError):
+    """An unparsable labelSelector or fieldSelector"""
+
+
+def split_requirements(selector):
+    """Split on the commas that are not inside an in/notin value set"""
+    requirements, depth, current = [], 0, ''
+    for char in selector:
+        if char == ',' and depth == 0:
+            requirements.append(current.strip())
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current += char
+    requirements.append(current.strip())
+    return [r for r in requirements if r]
+
+
+def parse_label_selector(selector):
+    """
+    Parse a label selector into (key, operator, values) requirements.
+    Operators are =, != (== means =), in, notin, exists and !exists.
+    """
+    requirements = []
+    for requirement in split_requirements(selector):
+        match = SET.match(requirement)
+        if match:
+            key, operator, values = match.groups()
+            values = {v.strip() for v in values.split(',') if v.strip()}
+            requirements.append((key, operator, values))
+            continue
+        match = EQUALITY.match(requirement)
+        if match:
+            key, operator, value = match.groups()
+            requirements.append((key, '!=' if operator == '!=' else '=', {value}))
+            continue
+        match = EXISTS.match(requirement)
+        if match:
+            negated, key = match.groups()
+            requirements.append((key, '!exists' if negated else 'exists', set()))
+            continue
+        raise SelectorError(f'unable to parse requirement: "{requirement}"')
+    return requirements
+
+
+def parse_field_selector(selector):
+    """Parse a field selector into (field path, operator, value) requirements"""
+    requirements = []
+    for requirement in split_requirements(selector):
+        match = FIELD.match(requirement)
+        if not match:
+            raise SelectorError(f'invalid field selector: "{requirement}"')
+        field, operator, value = match.groups()
+        requirements.append((field.split('.'), '!=' if operator == '!=' else '=',
+                             value.strip()))
+    return requirements
+
+
+def field_value(obj, path):
+    """An object's field as the API server compares it: a string, '' if unset"""
+    for part in path:
+        if not isinstance(obj, dict):
+            return ''
+        obj = obj.get(part)
+    if obj is None:
+        return ''
+    if isinstance(obj, bool):
+        return 'true' if obj else 'false'
+    return str(obj)
+
+
+class Selector:
+    """
+    The labelSelector and fieldSelector of a list or watch request,
+    evaluated locally against objects.
+    """
+
+    def __init__(self, label_selector='', field_selector=''):
+        self.labels = parse_label_selector(label_selector or '')
+        self.fields = parse_field_selector(field_selector or '')
+
+    @classmethod
+    def from_args(cls, query_args):
+        """The selector of a request's query, or None if it has none"""
+        if not any(query_args.get(param) for param in SELECTOR_PARAMS):
+            return None
+        return cls(query_args.get('labelSelector'), query_args.get('fieldSelector'))
+
+    def matches(self, obj):
+        metadata = obj.get('metadata') or {}
+        labels = metadata.get('labels') or {}
+        for key, operator, values in self.labels:
+            if operator == 'exists':
+                matched = key in labels
+            elif operator == '!exists':
+                matched = key not in labels
+            elif operator in ('=', 'in'):
+                matched = key in labels and labels[key] in values
+            else:
+                # != and notin also match objects without the label
+                matched = labels.get(key) not in values
+            if not matched:
+                return False
+        for path, operator, value in self.fields:
+            if (field_value(obj, path) == value) != (operator == '='):
+                return False
+        return True
+
+    def filter_list(self, payload):
+        """A copy of a list response with only the matching items"""
+        if not isinstance(payload, dict) or not isinstance(payload.get('items'), list):
+            return payload
+        return dict(payload, items=[item for item in payload['items']
+                                    if isinstance(item, dict) and self.matches(item)])
+
+
+def list_selector(api_path, query_args):
+    """
+    The selector of a request for a collection, or None. Raises
+    SelectorError for a malformed selector.
+    """
+    ref = parse_resource_path(api_path)
+    if ref is None or ref.name is not None or ref.subresource is not None:
+        return None
+    return Selector.from_args(query_args)
+
+
+def without_selectors(query_string):
+    """A query string minus its selectors, the key of the unfiltered list"""
+    params = [(k, v) for k, v in parse_qsl(query_string, keep_blank_values=True)
+              if k not in SELECTOR_PARAMS]
+    return urlencode(params)
@@ -0,0 +1,77 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import response_cache, CachedBody
+from deadline import DeadlineExceeded
+from models import rate_limiter
+from prefetch import Prefetcher
+from singleflight import SingleFlight
+from store import object_store
+from utils import simulate_kubernetes_api, markdown_json_to_dict
+from writebehind import persist_policy, persist_queue
+
+# LLM generations run here rather than in the request thread, so both the
+# threaded Flask views and the asyncio handlers in asgi.py can wait on them.
+llm_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('LLM_MAX_INFLIGHT', 256)),
+    thread_name_prefix='llm')
+llm_flight = SingleFlight(llm_executor)
+
+
+def generate_response(auth_token, method, api_path, query_args):
+    """
+    Generate a response with the LLM and, if the persist policy allows it,
+    keep it in the response cache and queue it for APICache storage
+    """
+    raw_simulated_response = simulate_kubernetes_api(method, api_path)
+    simulated_response = markdown_json_to_dict(raw_simulated_response)
+
+    if simulated_response is not None and method == 'GET':
+        object_store.ingest(auth_token, api_path, simulated_response)
+        prefetcher.observe(auth_token, api_path, simulated_response)
+
+    if (simulated_response is not None and
+            persist_policy.should_persist(method, api_path, query_args)):
+        response_text = json.dumps(simulated_response)
+        response_cache.set(auth_token, api_path, CachedBody(response_text))
+        persist_queue.enqueue(auth_token, api_path, response_text)
+
+    return simulated_response
+
+
+prefetcher = Prefetcher(
+    llm_flight, generate_response, rate_limiter,
+    workers=int(os.getenv('PREFETCH_WORKERS', 4)),
+    budget=int(os.getenv('PREFETCH_BUDGET', 20)),
+    idle_timeout=float(os.getenv('PREFETCH_IDLE_TIMEOUT', 120)))
+
+
+def start_generation(auth_token, method, api_path, query_string, query_args):
+    """
+    Start (or join) the generation for a request and return its future.
+    Identical requests that arrive while a generation is in flight share it.
+    """
+    if method == 'GET' and query_string:
+        # The LLM never sees the query, so a prefetch of the bare path (see
+        # prefetch.py) answers a filtered request just as well
+        prefetched = llm_flight.join((auth_token, method, api_path, ''))
+        if prefetched is not None:
+            return prefetched
+
+    flight_key = (auth_token, method, api_path, query_string)
+    return llm_flight.submit(flight_key, generate_response, auth_token,
+                             method, api_path, query_args)
+
+
+def wait_for_generation(generation, deadline):
+    """
+    Block until the generation finishes or the request deadline passes.
+    A request that gives up releases its claim, so a generation nobody is
+    waiting for any more is cancelled before it reaches the LLM.
+    """
+    try:
+        return deadline.wait(generation)
+    except DeadlineExceeded:
+        llm_flight.abandon(generation)
+        raise
@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures import Future
+
+
+class Flight:
+
+    def __init__(self):
+        self.future = Future()
+        self.job = None
+        self.waiters = 1
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one execution.
+
+    The first caller for a key submits the function to the executor; callers
+    that arrive while it is still in flight get the same future and share its
+    result (or exception). Returning a future lets threaded views block on it
+    and asyncio handlers await it without pinning a worker.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def submit(self, key, func, *args, **kwargs):
+        with self.lock:
+            flight = self.calls.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self.coalesced += 1
+                return flight.future
+
+            flight = Flight()
+            self.calls[key] = flight
+            self.executions += 1
+
+            try:
+                flight.job = self.executor.submit(self._run, key, flight, func,
+                                                  args, kwargs)
+            except BaseException:
+                self.calls.pop(key, None)
+                raise
+        return flight.future
+
+    def join(self, key):
+        """Return the future of a call in flight for key, or None"""
+        with self.lock:
+            flight = self.calls.get(key)
+            if flight is None:
+                return None
+            flight.waiters += 1
+            self.coalesced += 1
+            return flight.future
+
+    def do(self, key, func, *args, **kwargs):
+        return self.submit(key, func, *args, **kwargs).result()
+
+    def abandon(self, future):
+        """
+        Called by a waiter that gave up on a future (e.g. its deadline
+        passed). Once every waiter is gone, a call that has not started yet
+        is cancelled instead of being run for nobody.
+        """
+        with self.lock:
+            for key, flight in self.calls.items():
+                if flight.future is future:
+                    break
+            else:
+                return
+            flight.waiters -= 1
+            if flight.waiters > 0 or not flight.job.cancel():
+                return
+            self.calls.pop(key, None)
+            self.cancelled += 1
+        flight.future.cancel()
+
+    def _run(self, key, flight, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            with self.lock:
+                self.calls.pop(key, None)
+            flight.future.set_exception(e)
+        else:
+            with self.lock:
+                self.calls.pop(key, None)
+            flight.future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+                'cancelled': self.cancelled
+            }
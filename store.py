@@ -0,0 +1,1030 @@
+import copy
+import json
+import logging
+import os
+import random
+import string
+import threading
+import uuid
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+
+from sqlalchemy.exc import IntegrityError
+
+from breaker import DATABASE_ERRORS, CircuitOpenError, db_breaker
+from models import db, ClusterEvent, ClusterObject, ClusterSnapshot
+
+logger = logging.getLogger(__name__)
+
+ResourcePath = namedtuple(
+    'ResourcePath',
+    ['group', 'version', 'namespace', 'resource', 'name', 'subresource'])
+
+
+def parse_resource_path(path):
+    """
+    Split a resource URL such as /api/v1/namespaces/default/pods/web or
+    /apis/apps/v1/deployments into its parts. Discovery and other non
+    resource paths return None.
+    """
+    parts = [p for p in path.split('/') if p]
+    if len(parts) >= 3 and parts[0] == 'api':
+        group, version, rest = '', parts[1], parts[2:]
+    elif len(parts) >= 4 and parts[0] == 'apis':
+        group, version, rest = parts[1], parts[2], parts[3:]
+    else:
+        return None
+
+    namespace = None
+    if rest[0] == 'namespaces' and len(rest) >= 3:
+        namespace, rest = rest[1], rest[2:]
+
+    name = rest[1] if len(rest) > 1 else None
+    subresource = '/'.join(rest[2:]) or None
+    return ResourcePath(group, version, namespace, rest[0], name, subresource)
+
+
+def api_version(ref):
+    return f'{ref.group}/{ref.version}' if ref.group else ref.version
+
+
+def guess_kind(resource):
+    """Best-effort singular kind for a plural resource name"""
+    if resource.endswith('ies'):
+        singular = resource[:-3] + 'y'
+    elif resource.endswith(('sses', 'ches', 'shes', 'xes')):
+        singular = resource[:-2]
+    elif resource.endswith('s'):
+        singular = resource[:-1]
+    else:
+        singular = resource
+    return singular[:1].upper() + singular[1:]
+
+
+def now_timestamp():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def status_response(code, reason, message, ref=None):
+    """Build a metav1.Status failure payload"""
+    status = {
+        'kind': 'Status',
+        'apiVersion': 'v1',
+        'metadata': {},
+        'status': 'Failure',
+        'message': message,
+        'reason': reason,
+        'code': code
+    }
+    if ref is not None:
+        status['details'] = {'name': ref.name, 'kind': ref.resource}
+        if ref.group:
+            status['details']['group'] = ref.group
+    return status
+
+
+def merge_patch(target, patch):
+    """Apply an RFC 7386 JSON merge patch"""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def json_patch(target, operations):
+    """Apply the add/remove/replace/test operations of an RFC 6902 patch"""
+    result = copy.deepcopy(target)
+    for operation in operations:
+        tokens = [
+            t.replace('~1', '/').replace('~0', '~')
+            for t in operation['path'].split('/')[1:]
+        ]
+        parent = result
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        last = tokens[-1] if tokens else None
+        op = operation['op']
+
+        if isinstance(parent, list) and last is not None:
+            index = len(parent) if last == '-' else int(last)
+            if op == 'add':
+                parent.insert(index, operation['value'])
+            elif op == 'remove':
+                del parent[index]
+            elif op == 'replace':
+                parent[index] = operation['value']
+            elif op == 'test' and parent[index] != operation['value']:
+                raise ValueError(f"Test failed at {operation['path']}")
+        elif op in ('add', 'replace'):
+            parent[last] = operation['value']
+        elif op == 'remove':
+            del parent[last]
+        elif op == 'test' and parent.get(last) != operation['value']:
+            raise ValueError(f"Test failed at {operation['path']}")
+        elif op not in ('test', ):
+            raise ValueError(f"Unsupported JSON patch operation: {op}")
+    return result
+
+
+WATCH_HISTORY = int(os.getenv('WATCH_HISTORY', 1000))
+# Seconds a store may answer from memory before checking for changes made
+# through other workers (0: before every request)
+STORE_SYNC_INTERVAL = float(os.getenv('STORE_SYNC_INTERVAL', 0))
+# Seconds cluster_events are kept for workers catching up and watches
+# resuming; older ones are pruned
+STORE_EVENT_RETENTION = float(os.getenv('STORE_EVENT_RETENTION', 900))
+# Seconds between checks for other workers' changes to watched tokens
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', 1))
+# Markers in cluster_events that do not change an object
+MARKER_EVENTS = ('META', 'RESET')
+
+
+class Watcher:
+    """A watch on one collection; notify must never block"""
+
+    def __init__(self, ref, notify, matches=None):
+        self.key = (ref.group, ref.version, ref.resource)
+        self.namespace = ref.namespace
+        self.notify = notify
+        self.matches = matches
+
+    def wants(self, key, obj):
+        if key != self.key:
+            return False
+        if (self.namespace is not None and
+                obj.get('metadata', {}).get('namespace') != self.namespace):
+            return False
+        return self.matches is None or self.matches(obj)
+
+
+def object_key(obj):
+    metadata = obj.get('metadata', {})
+    return metadata.get('namespace'), metadata.get('name')
+
+
+class TokenStore:
+    """Objects of one token's simulated cluster"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.resource_version = 0
+        # (group, version, resource) -> {(namespace, name): object}
+        self.objects = {}
+        # (group, version, resource) -> kind of its items
+        self.kinds = {}
+        # (group, version, resource, namespace or None) whose full list is
+        # known, so a missing object really does not exist
+        self.loaded = set()
+        # Recent (resourceVersion, watch event) pairs for watch resumption
+        self.history = deque(maxlen=WATCH_HISTORY)
+        self.watchers = set()
+        # Changes made since the last commit, as history entries
+        self.changes = []
+        # monotonic() of the last check for other workers' changes
+        self.synced_at = None
+        # Set when the store could not be read; such a store is neither
+        # kept nor written, so it never overwrites the real one
+        self.detached = False
+
+    def record(self, event_type, ref, obj):
+        """Remember a change; watchers get it once it is committed"""
+        event = {'type': event_type, 'object': obj}
+        key = (ref.group, ref.version, ref.resource)
+        self.changes.append((self.resource_version, key, event))
+
+    def mark(self, event_type):
+        """Record a change that is not one to an object, see MARKER_EVENTS"""
+        self.next_resource_version()
+        self.changes.append((self.resource_version, None,
+                             {'type': event_type}))
+
+    def publish(self):
+        """Hand the committed changes to the watchers interested in them"""
+        changes, self.changes = self.changes, []
+        for resource_version, key, event in changes:
+            self.announce(resource_version, key, event)
+
+    def announce(self, resource_version, key, event):
+        if key is None:
+            return
+        self.history.append((resource_version, key, event))
+        for watcher in list(self.watchers):
+            if watcher.wants(key, event['object']):
+                watcher.notify(event)
+
+    def apply(self, resource_version, key, event):
+        """Apply a change committed through another worker"""
+        if key is not None:
+            collection = self.objects.setdefault(key, {})
+            if event['type'] == 'DELETED':
+                collection.pop(object_key(event['object']), None)
+            else:
+                collection[object_key(event['object'])] = event['object']
+        self.resource_version = resource_version
+        self.announce(resource_version, key, event)
+
+    def checkpoint(self, key):
+        """What restore() needs to undo uncommitted changes to a collection"""
+        collection = self.objects.get(key)
+        return (self.resource_version, dict(self.kinds), set(self.loaded),
+                key, dict(collection) if collection is not None else None)
+
+    def restore(self, checkpoint):
+        self.resource_version, self.kinds, self.loaded, key, collection = \
+            checkpoint
+        if collection is None:
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = collection
+        self.changes = []
+
+    def reset(self, resource_version, objects, meta):
+        """Replace the contents with what was read from the database"""
+        self.resource_version = resource_version
+        self.objects = objects
+        self.kinds = {(g, v, r): kind for g, v, r, kind in meta.get('kinds', [])}
+        # Snapshots of the whole store, written before objects had rows of
+        # their own, do not list anything the objects table has
+        self.loaded = ({tuple(key) for key in meta.get('loaded', [])}
+                       if 'objects' not in meta else set())
+        self.changes = []
+        self.synced_at = monotonic()
+
+    def next_resource_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def collection(self, ref):
+        return self.objects.setdefault((ref.group, ref.version, ref.resource),
+                                       {})
+
+    def is_loaded(self, ref):
+        key = (ref.group, ref.version, ref.resource)
+        return key + (None, ) in self.loaded or (
+            ref.namespace is not None and key + (ref.namespace, ) in self.loaded)
+
+    def count(self):
+        return sum(len(items) for items in self.objects.values())
+
+    def meta(self):
+        return {
+            'kinds': [[g, v, r, kind] for (g, v, r), kind in self.kinds.items()],
+            'loaded': [list(key) for key in self.loaded]
+        }
+
+
+class ObjectStore:
+    """
+    Per-token store of simulated Kubernetes objects.
+
+    Lists and objects that were generated (or served from APICache) are
+    ingested here keyed by group/version/resource/namespace/name. Later GETs
+    of the collection or of individual items are answered from the store,
+    and POST/PUT/PATCH/DELETE mutate it without calling the LLM.
+
+    The database is the source of truth, so every worker sees the same
+    objects: each change is committed as its cluster_objects rows and
+    cluster_events entries, only if the token's resourceVersion in
+    cluster_snapshots is still the one the change was made on. Otherwise
+    the store is read again and the change retried. Before answering from
+    memory, a store applies the events other workers committed since, and
+    a daemon thread does so every `watch_poll_interval` seconds for tokens
+    with open watches.
+    """
+
+    def __init__(self, max_tokens=1000, max_objects=5000, sync_interval=0,
+                 event_retention=900, watch_poll_interval=1, max_attempts=3):
+        self.max_tokens = max_tokens
+        self.max_objects = max_objects
+        self.sync_interval = sync_interval
+        self.event_retention = event_retention
+        self.watch_poll_interval = watch_poll_interval
+        self.max_attempts = max_attempts
+        self.stores = OrderedDict()
+        self.lock = threading.Lock()
+        self.app = None
+        self.poller = None
+        self.poller_pid = None
+        self.pruned_at = 0.0
+        self.hits = 0
+        self.mutations = 0
+        self.watchers = 0
+        self.conflicts = 0
+        self.reloads = 0
+        self.synced = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def _ensure_poller(self):
+        # Started lazily so every forked gunicorn worker gets its own thread
+        if self.poller is not None and self.poller_pid == os.getpid():
+            return
+        with self.lock:
+            if self.poller is not None and self.poller_pid == os.getpid():
+                return
+            self.poller_pid = os.getpid()
+            self.poller = threading.Thread(target=self._poll_watched,
+                                           name='watch-poller', daemon=True)
+            self.poller.start()
+
+    def _poll_watched(self):
+        while True:
+            sleep(self.watch_poll_interval)
+            with self.lock:
+                watched = [(token, store) for token, store in self.stores.items()
+                           if store.watchers]
+            for token, store in watched:
+                try:
+                    self._sync(token, store)
+                except Exception as e:
+                    logger.error(f"Error syncing watched objects of {token}: {str(e)}")
+
+    def load(self, token, sync=True):
+        """
+        Return the token's store, reading it from the database on first use
+        and catching up with other workers' changes otherwise
+        """
+        token = str(token)
+        with self.lock:
+            store = self.stores.get(token)
+            if store is not None:
+                self.stores.move_to_end(token)
+        if store is not None:
+            if sync:
+                self._sync(token, store)
+            return store
+
+        store = TokenStore()
+        try:
+            with self.app.app_context(), db_breaker.guard():
+                self._read(token, store)
+        except (CircuitOpenError,) + DATABASE_ERRORS as e:
+            logger.warning(f"Cluster objects unavailable, serving {token} "
+                           f"without them: {str(e)}")
+            store.detached = True
+            return store
+
+        with self.lock:
+            # Another thread may have loaded it meanwhile
+            store = self.stores.setdefault(token, store)
+            self.stores.move_to_end(token)
+            while len(self.stores) > self.max_tokens:
+                # Stores with open watches stay, their watchers live there
+                for evicted, candidate in self.stores.items():
+                    if not candidate.watchers:
+                        break
+                else:
+                    break
+                del self.stores[evicted]
+        return store
+
+    def _read(self, token, store):
+        """(Re)read a token's objects into store; needs an app context"""
+        token_id = uuid.UUID(str(token))
+        row = db.session.execute(
+            db.select(ClusterSnapshot.resource_version,
+                      ClusterSnapshot.snapshot).where(
+                          ClusterSnapshot.user_token == token_id)).first()
+        objects = {}
+        if row is not None:
+            # Objects committed after the snapshot row was read are applied
+            # again by the next sync, which is harmless
+            for group, version, resource, obj in db.session.execute(
+                    db.select(ClusterObject.api_group, ClusterObject.version,
+                              ClusterObject.resource, ClusterObject.object).where(
+                                  ClusterObject.user_token == token_id)):
+                obj = json.loads(obj)
+                objects.setdefault((group, version, resource), {})[
+                    object_key(obj)] = obj
+        store.reset(row.resource_version if row else 0, objects,
+                    json.loads(row.snapshot) if row else {})
+
+    def _sync(self, token, store, force=False):
+        """
+        Apply the changes other workers committed since the store was read.
+        Returns False if the database could not be reached.
+        """
+        with store.lock:
+            if store.detached:
+                return False
+            if (not force and store.synced_at is not None and
+                    monotonic() - store.synced_at < self.sync_interval):
+                return True
+            token_id = uuid.UUID(str(token))
+            try:
+                with self.app.app_context(), db_breaker.guard():
+                    row = db.session.execute(
+                        db.select(ClusterSnapshot.resource_version,
+                                  ClusterSnapshot.snapshot).where(
+                                      ClusterSnapshot.user_token == token_id)
+                    ).first()
+                    if row is None or (not force and
+                                       row.resource_version == store.resource_version):
+                        store.synced_at = monotonic()
+                        return True
+                    events = []
+                    if row.resource_version > store.resource_version:
+                        events = db.session.execute(
+                            db.select(ClusterEvent).where(
+                                ClusterEvent.user_token == token_id,
+                                ClusterEvent.resource_version > store.resource_version,
+                                ClusterEvent.resource_version <= row.resource_version
+                            ).order_by(ClusterEvent.resource_version)).scalars().all()
+                    expected = list(range(store.resource_version + 1,
+                                          row.resource_version + 1))
+                    # A forced sync after a failed write that finds nothing
+                    # new means the store missed something; read it again
+                    if (row.resource_version <= store.resource_version or
+                            [event.resource_version for event in events] != expected or
+                            any(event.event_type == 'RESET' for event in events)):
+                        # Events were pruned, or the objects changed wholesale
+                        self.reloads += 1
+                        self._read(token, store)
+                        return True
+                    for event in events:
+                        key = None
+                        payload = {'type': event.event_type}
+                        if event.event_type not in MARKER_EVENTS:
+                            key = (event.api_group, event.version, event.resource)
+                            payload['object'] = json.loads(event.object)
+                        store.apply(event.resource_version, key, payload)
+                    meta = json.loads(row.snapshot)
+                    store.kinds = {(g, v, r): kind
+                                   for g, v, r, kind in meta.get('kinds', [])}
+                    store.loaded = {tuple(key) for key in meta.get('loaded', [])}
+                    store.synced_at = monotonic()
+                    self.synced += len(events)
+                    return True
+            except (CircuitOpenError,) + DATABASE_ERRORS as e:
+                # Serve what is in memory; writes fail until the database is back
+                logger.debug(f"Could not sync cluster objects of {token}: {str(e)}")
+                return False
+
+    def _commit(self, token, store, base_version, removed=()):
+        """
+        Write the store's uncommitted changes, made on top of base_version,
+        and the objects in `removed` ((key, (namespace, name)) pairs) that
+        are dropped without an event. Returns True once committed, False if
+        another worker changed the token first and None if the database is
+        unavailable.
+        """
+        if store.detached:
+            return None
+        if not store.changes:
+            store.mark('META')
+        token_id = uuid.UUID(str(token))
+        meta = json.dumps(store.meta())
+        try:
+            with self.app.app_context(), db_breaker.guard():
+                if base_version == 0:
+                    db.session.add(ClusterSnapshot(
+                        user_token=token_id,
+                        resource_version=store.resource_version,
+                        snapshot=meta))
+                    db.session.flush()
+                elif db.session.execute(
+                        db.update(ClusterSnapshot).where(
+                            ClusterSnapshot.user_token == token_id,
+                            ClusterSnapshot.resource_version == base_version
+                        ).values(resource_version=store.resource_version,
+                                 snapshot=meta,
+                                 updated_at=datetime.utcnow())).rowcount != 1:
+                    db.session.rollback()
+                    return False
+
+                for key, item_key in removed:
+                    self._delete_row(token_id, key, item_key)
+                added, events = [], []
+                for resource_version, key, event in store.changes:
+                    event_row = {
+                        'user_token': token_id,
+                        'resource_version': resource_version,
+                        'event_type': event['type'],
+                        'created_at': datetime.utcnow()
+                    }
+                    if key is not None:
+                        obj = event['object']
+                        namespace, name = object_key(obj)
+                        text = json.dumps(obj)
+                        event_row.update(api_group=key[0], version=key[1],
+                                         resource=key[2], object=text)
+                        if event['type'] == 'DELETED':
+                            changed = self._delete_row(token_id, key,
+                                                       (namespace, name))
+                        elif event['type'] == 'ADDED':
+                            added.append({
+                                'user_token': token_id, 'api_group': key[0],
+                                'version': key[1], 'resource': key[2],
+                                'namespace': namespace or '', 'name': name,
+                                'resource_version': resource_version,
+                                'object': text
+                            })
+                            changed = 1
+                        else:
+                            changed = db.session.execute(
+                                db.update(ClusterObject).where(
+                                    *self._row_filter(token_id, key,
+                                                      (namespace, name))
+                                ).values(resource_version=resource_version,
+                                         object=text)).rowcount
+                        if changed != 1:
+                            # The store was missing a change made elsewhere
+                            db.session.rollback()
+                            return False
+                    events.append(event_row)
+                if added:
+                    db.session.execute(db.insert(ClusterObject), added)
+                db.session.execute(db.insert(ClusterEvent), events)
+                db.session.commit()
+        except IntegrityError:
+            # Someone else created the token's snapshot or an object first
+            db.session.rollback()
+            return False
+        except (CircuitOpenError,) + DATABASE_ERRORS as e:
+            db.session.rollback()
+            logger.warning(f"Could not write cluster objects of {token}: {str(e)}")
+            return None
+        self._prune_events()
+        return True
+
+    @staticmethod
+    def _row_filter(token_id, key, item_key):
+        return (ClusterObject.user_token == token_id,
+                ClusterObject.api_group == key[0],
+                ClusterObject.version == key[1],
+                ClusterObject.resource == key[2],
+                ClusterObject.namespace == (item_key[0] or ''),
+                ClusterObject.name == item_key[1])
+
+    def _delete_row(self, token_id, key, item_key):
+        return db.session.execute(db.delete(ClusterObject).where(
+            *self._row_filter(token_id, key, item_key))).rowcount
+
+    def _prune_events(self):
+        now = monotonic()
+        if now - self.pruned_at < self.event_retention / 10:
+            return
+        self.pruned_at = now
+        cutoff = datetime.utcnow() - timedelta(seconds=self.event_retention)
+        try:
+            with self.app.app_context(), db_breaker.guard():
+                db.session.execute(db.delete(ClusterEvent).where(
+                    ClusterEvent.created_at < cutoff))
+                db.session.commit()
+        except (CircuitOpenError,) + DATABASE_ERRORS as e:
+            logger.warning(f"Could not prune cluster events: {str(e)}")
+
+    def _list_payload(self, store, ref):
+        key = (ref.group, ref.version, ref.resource)
+        items = [
+            obj for (namespace, _), obj in store.objects.get(key, {}).items()
+            if ref.namespace is None or namespace == ref.namespace
+        ]
+        items.sort(key=lambda o: (o['metadata'].get('namespace') or '',
+                                  o['metadata'].get('name') or ''))
+        kind = store.kinds.get(key, guess_kind(ref.resource))
+        return {
+            'kind': f'{kind}List',
+            'apiVersion': api_version(ref),
+            'metadata': {
+                'resourceVersion': str(store.resource_version)
+            },
+            'items': items
+        }
+
+    def lookup(self, token, path):
+        """Answer a GET from the store; returns (payload, status) or None"""
+        ref = parse_resource_path(path)
+        if ref is None or ref.subresource is not None:
+            return None
+
+        store = self.load(token)
+        with store.lock:
+            if ref.name is None:
+                if not store.is_loaded(ref):
+                    return None
+                self.hits += 1
+                return self._list_payload(store, ref), 200
+
+            obj = store.collection(ref).get((ref.namespace, ref.name))
+            if obj is not None:
+                self.hits += 1
+                return obj, 200
+            if store.is_loaded(ref):
+                self.hits += 1
+                return status_response(
+                    404, 'NotFound',
+                    f'{ref.resource} "{ref.name}" not found', ref), 404
+        return None
+
+    def _prepare(self, store, ref, obj, existing=None):
+        """Fill in the metadata the API server would own"""
+        obj = copy.deepcopy(obj)
+        metadata = obj.setdefault('metadata', {})
+        key = (ref.group, ref.version, ref.resource)
+        kind = obj.get('kind') or store.kinds.get(key) or guess_kind(
+            ref.resource)
+        obj['kind'] = kind
+        obj.setdefault('apiVersion', api_version(ref))
+        store.kinds.setdefault(key, kind)
+
+        if ref.namespace is not None:
+            metadata['namespace'] = ref.namespace
+        if existing is not None:
+            old_metadata = existing.get('metadata', {})
+            for field in ('uid', 'creationTimestamp', 'namespace'):
+                if field in old_metadata:
+                    metadata[field] = old_metadata[field]
+        else:
+            metadata.setdefault('uid', str(uuid.uuid4()))
+            metadata.setdefault('creationTimestamp', now_timestamp())
+        metadata['resourceVersion'] = store.next_resource_version()
+        return obj
+
+    def ingest(self, token, path, payload):
+        """Remember a generated or cached GET response for later requests"""
+        ref = parse_resource_path(path)
+        if (ref is None or ref.subresource is not None or
+                not isinstance(payload, dict)):
+            return
+
+        store = self.load(token)
+        key = (ref.group, ref.version, ref.resource)
+        with store.lock:
+            if store.is_loaded(ref):
+                return
+            base_version = store.resource_version
+            checkpoint = store.checkpoint(key)
+            if not self._ingest(store, ref, payload):
+                store.restore(checkpoint)
+                return
+            committed = self._commit(token, store, base_version)
+            if committed:
+                store.publish()
+                return
+            # Another worker's version of the objects wins
+            store.restore(checkpoint)
+            if committed is False:
+                self.conflicts += 1
+                self._sync(token, store, force=True)
+
+    def _ingest(self, store, ref, payload):
+        """Add a response's objects to the store; False if there are none"""
+        if ref.name is None:
+            items = payload.get('items')
+            if not isinstance(items, list):
+                return False
+            collection = store.collection(ref)
+            # Items often omit their kind, the list's kind names it
+            list_kind = payload.get('kind', '')
+            if list_kind.endswith('List') and len(list_kind) > 4:
+                store.kinds[(ref.group, ref.version,
+                             ref.resource)] = list_kind[:-4]
+            for item in items:
+                metadata = item.get('metadata') if isinstance(item, dict) else None
+                if not metadata or not metadata.get('name'):
+                    continue
+                if store.count() >= self.max_objects:
+                    break
+                item_ref = ref._replace(
+                    namespace=ref.namespace or metadata.get('namespace'))
+                key = (item_ref.namespace, metadata['name'])
+                # Objects created locally win over generated ones
+                if key not in collection:
+                    collection[key] = self._prepare(store, item_ref, item)
+                    store.record('ADDED', item_ref, collection[key])
+            store.loaded.add(
+                (ref.group, ref.version, ref.resource, ref.namespace))
+            return True
+
+        metadata = payload.get('metadata')
+        if (payload.get('kind') == 'Status' or not metadata or
+                store.count() >= self.max_objects):
+            return False
+        key = (ref.namespace, ref.name)
+        collection = store.collection(ref)
+        if key in collection:
+            return False
+        payload = dict(payload, metadata=dict(metadata, name=ref.name))
+        collection[key] = self._prepare(store, ref, payload)
+        store.record('ADDED', ref, collection[key])
+        return True
+
+    def mutate(self, token, method, path, body, content_type=''):
+        """
+        Apply a POST/PUT/PATCH/DELETE; returns (payload, status) or None
+        when the store does not know enough to answer it
+        """
+        ref = parse_resource_path(path)
+        if ref is None or ref.subresource not in (None, 'status'):
+            return None
+        if ref.subresource == 'status' and method not in ('PUT', 'PATCH'):
+            return None
+
+        store = self.load(token)
+        key = (ref.group, ref.version, ref.resource)
+        with store.lock:
+            for _ in range(self.max_attempts):
+                base_version = store.resource_version
+                checkpoint = store.checkpoint(key)
+                result = self._mutate(store, ref, method, body, content_type)
+                if result is None or result[1] >= 400:
+                    store.restore(checkpoint)
+                    return result
+
+                committed = self._commit(token, store, base_version)
+                if committed:
+                    store.publish()
+                    self.mutations += 1
+                    return result
+                store.restore(checkpoint)
+                if committed is None or not self._sync(token, store, force=True):
+                    return status_response(
+                        503, 'ServiceUnavailable',
+                        'the database is unavailable, please try again later',
+                        ref), 503
+                # Another worker changed the token first; redo the change
+                # on top of its version
+                self.conflicts += 1
+            return status_response(
+                409, 'Conflict',
+                'the object has been modified by another request, please '
+                'try again', ref), 409
+
+    def _mutate(self, store, ref, method, body, content_type):
+        collection = store.collection(ref)
+        if method == 'POST':
+            if ref.name is not None or not isinstance(body, dict):
+                return None
+            return self._create(store, ref, collection, body)
+        if ref.name is None:
+            return None
+
+        key = (ref.namespace, ref.name)
+        existing = collection.get(key)
+        if existing is None and method != 'PUT':
+            if not store.is_loaded(ref):
+                return None
+            return status_response(
+                404, 'NotFound',
+                f'{ref.resource} "{ref.name}" not found', ref), 404
+
+        if method == 'DELETE':
+            del collection[key]
+            deleted = copy.deepcopy(existing)
+            deleted['metadata']['resourceVersion'] = \
+                store.next_resource_version()
+            store.record('DELETED', ref, deleted)
+            return deleted, 200
+        return self._update(store, ref, collection, existing, method, body,
+                            content_type)
+
+    def _create(self, store, ref, collection, body):
+        metadata = body.get('metadata') or {}
+        name = metadata.get('name')
+        if not name and metadata.get('generateName'):
+            suffix = ''.join(
+                random.choices(string.ascii_lowercase + string.digits, k=5))
+            name = metadata['generateName'] + suffix
+        if not name:
+            # Nameless creates such as SelfSubjectAccessReviews and
+            # TokenReviews are answered by the LLM, not stored
+            return None
+
+        ref = ref._replace(name=name)
+        if (ref.namespace, name) in collection:
+            return status_response(
+                409, 'AlreadyExists',
+                f'{ref.resource} "{name}" already exists', ref), 409
+        if store.count() >= self.max_objects:
+            return status_response(
+                403, 'Forbidden',
+                f'exceeded quota: at most {self.max_objects} objects per token',
+                ref), 403
+
+        body = dict(body, metadata=dict(metadata, name=name))
+        obj = self._prepare(store, ref, body)
+        collection[(ref.namespace, name)] = obj
+        store.record('ADDED', ref, obj)
+        return obj, 201
+
+    def _update(self, store, ref, collection, existing, method, body,
+                content_type):
+        if method == 'PUT':
+            if not isinstance(body, dict):
+                return status_response(400, 'BadRequest',
+                                       'the body must be an object'), 400
+            if existing is None and store.count() >= self.max_objects:
+                return status_response(
+                    403, 'Forbidden',
+                    f'exceeded quota: at most {self.max_objects} objects per token',
+                    ref), 403
+            if ref.subresource == 'status':
+                if existing is None:
+                    return status_response(
+                        404, 'NotFound',
+                        f'{ref.resource} "{ref.name}" not found', ref), 404
+                updated = dict(existing, status=body.get('status'))
+            else:
+                updated = dict(body)
+        else:
+            try:
+                if 'json-patch' in content_type:
+                    updated = json_patch(existing, body)
+                else:
+                    # Strategic merge patches are applied as merge patches
+                    updated = merge_patch(existing, body)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                return status_response(422, 'Invalid',
+                                       f'invalid patch: {str(e)}', ref), 422
+            if ref.subresource == 'status':
+                updated = dict(existing, status=updated.get('status'))
+
+        metadata = dict(updated.get('metadata') or {}, name=ref.name)
+        updated = dict(updated, metadata=metadata)
+        obj = self._prepare(store, ref, updated, existing)
+        collection[(ref.namespace, ref.name)] = obj
+        store.record('MODIFIED' if existing is not None else 'ADDED', ref, obj)
+        return obj, 200 if existing is not None else 201
+
+    def forget(self, token, path):
+        """
+        Drop what the store knows about a path whose cache entry was
+        stored or deleted, so the next request is answered from APICache
+        """
+        ref = parse_resource_path(path)
+        if ref is None or ref.subresource is not None:
+            return
+
+        store = self.load(token)
+        key = (ref.group, ref.version, ref.resource)
+        with store.lock:
+            for _ in range(self.max_attempts):
+                base_version = store.resource_version
+                checkpoint = store.checkpoint(key)
+                collection = store.collection(ref)
+                if ref.name is not None:
+                    removed = [(ref.namespace, ref.name)]
+                else:
+                    removed = [item_key for item_key in collection
+                               if ref.namespace is None or
+                               item_key[0] == ref.namespace]
+                removed = [item_key for item_key in removed
+                           if collection.pop(item_key, None) is not None]
+                # The collection's lists are no longer complete
+                loaded = {
+                    loaded for loaded in store.loaded
+                    if loaded[:3] != key or (ref.namespace is not None and
+                                             loaded[3] not in (None, ref.namespace))
+                }
+                if not removed and loaded == store.loaded:
+                    store.restore(checkpoint)
+                    return
+                store.loaded = loaded
+                store.mark('RESET')
+                committed = self._commit(token, store, base_version,
+                                         [(key, item_key) for item_key in removed])
+                if committed:
+                    store.publish()
+                    return
+                if committed is None:
+                    # Keep answering without the objects meanwhile; the
+                    # store is read again once the database is back
+                    store.changes = []
+                    return
+                store.restore(checkpoint)
+                self.conflicts += 1
+                if not self._sync(token, store, force=True):
+                    return
+
+    def has_collection(self, token, path):
+        ref = parse_resource_path(path)
+        if ref is None:
+            return False
+        store = self.load(token)
+        with store.lock:
+            return store.is_loaded(ref)
+
+    def watch(self, token, path, resource_version, notify, matches=None):
+        """
+        Start watching a collection. Returns the watcher (or None if the
+        path cannot be watched) and the events to send before live ones:
+        the current objects when no resourceVersion is given, otherwise the
+        changes since it, or a 410 Expired error when they are not kept.
+        """
+        ref = parse_resource_path(path)
+        if ref is None or ref.subresource is not None:
+            return None, []
+        if ref.name is not None:
+            # Watching one object by URL is a watch on its collection
+            name = ref.name
+            ref = ref._replace(name=None)
+            object_matches = matches
+            matches = lambda obj: (obj.get('metadata', {}).get('name') == name
+                                   and (object_matches is None or
+                                        object_matches(obj)))
+
+        store = self.load(token)
+        watcher = Watcher(ref, notify, matches)
+        key = (ref.group, ref.version, ref.resource)
+        with store.lock:
+            if resource_version in (None, '', '0'):
+                items = self._list_payload(store, ref)['items']
+                events = [{'type': 'ADDED', 'object': obj} for obj in items
+                          if watcher.wants(key, obj)]
+            else:
+                try:
+                    since = int(resource_version)
+                except ValueError:
+                    return None, [self._expired(resource_version)]
+                history = store.history
+                oldest = history[0][0] if history else None
+                if since < store.resource_version and (
+                        oldest is None or since < oldest - 1):
+                    # Older than this worker remembers, e.g. a watch that
+                    # was open on another worker
+                    history = self._events_since(token, since,
+                                                 store.resource_version)
+                    if history is None:
+                        return None, [self._expired(resource_version)]
+                events = [
+                    event for rv, event_key, event in history
+                    if rv > since and watcher.wants(event_key, event['object'])
+                ]
+            store.watchers.add(watcher)
+        self.watchers += 1
+        if self.watch_poll_interval > 0:
+            self._ensure_poller()
+        return watcher, events
+
+    def _events_since(self, token, since, until):
+        """
+        The object changes in (since, until] from cluster_events, or None
+        if some were pruned already
+        """
+        try:
+            with self.app.app_context(), db_breaker.guard():
+                rows = db.session.execute(
+                    db.select(ClusterEvent).where(
+                        ClusterEvent.user_token == uuid.UUID(str(token)),
+                        ClusterEvent.resource_version > since,
+                        ClusterEvent.resource_version <= until).order_by(
+                            ClusterEvent.resource_version)).scalars().all()
+        except (CircuitOpenError,) + DATABASE_ERRORS as e:
+            logger.warning(f"Could not read cluster events of {token}: {str(e)}")
+            return None
+        if [row.resource_version for row in rows] != list(range(since + 1, until + 1)):
+            return None
+        return [(row.resource_version,
+                 (row.api_group, row.version, row.resource),
+                 {'type': row.event_type, 'object': json.loads(row.object)})
+                for row in rows if row.event_type not in MARKER_EVENTS]
+
+    def _expired(self, resource_version):
+        return {
+            'type': 'ERROR',
+            'object': status_response(
+                410, 'Expired',
+                f'too old resource version: {resource_version}')
+        }
+
+    def unwatch(self, token, watcher):
+        store = self.load(token, sync=False)
+        with store.lock:
+            if watcher in store.watchers:
+                store.watchers.discard(watcher)
+                self.watchers -= 1
+
+    def resource_version(self, token):
+        store = self.load(token, sync=False)
+        with store.lock:
+            return str(store.resource_version)
+
+    def stats(self):
+        with self.lock:
+            stores = list(self.stores.values())
+        return {
+            'tokens': len(stores),
+            'objects': sum(store.count() for store in stores),
+            'watchers': self.watchers,
+            'hits': self.hits,
+            'mutations': self.mutations,
+            'conflicts': self.conflicts,
+            'reloads': self.reloads,
+            'synced_events': self.synced
+        }
+
+
+object_store = ObjectStore(
+    max_tokens=int(os.getenv('STORE_MAX_TOKENS', 1000)),
+    max_objects=int(os.getenv('STORE_MAX_OBJECTS', 5000)),
+    sync_interval=STORE_SYNC_INTERVAL,
+    event_retention=STORE_EVENT_RETENTION,
+    watch_poll_interval=WATCH_POLL_INTERVAL)
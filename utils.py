@@ -1,10 +1,37 @@
 from flask import jsonify, request
 from datetime import datetime
-from crewai import Crew
-from agents import kubernetes_api_agent
-from tasks import kubernetes_api_task
+from crew_pool import crew_pool
+from generators import template_generator
+from metrics import json_extract_seconds
+from time import perf_counter
 import re
 import json
+import uuid
+
+
+def parse_bearer_token(auth_header):
+    """
+    Extract the UUID token from an Authorization header.
+    Returns a (token, error message) tuple.
+    """
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None, 'Missing or invalid Authorization header'
+
+    token = auth_header.split(' ')[1]
+    try:
+        uuid.UUID(token)
+    except ValueError:
+        return None, 'Invalid token format - must be UUID'
+
+    return token, None
+
+
+def client_ip(forwarded_for, remote_addr):
+    """Get IP from X-Forwarded-For or fallback to remote_addr"""
+    ip_address = forwarded_for or remote_addr
+    if ip_address and ',' in ip_address:
+        ip_address = ip_address.split(',')[0].strip()
+    return ip_address
 
 
 def validate_request(request):
@@ -85,18 +112,18 @@ def create_response(method, path, request):
         }), 405
 
 
-def simulate_kubernetes_api(request):
+def simulate_kubernetes_api(method, path):
     """
     Simulate a Kubernetes API request and return a response
     """
-
-    kubernetes_api_crew = Crew(agents=[kubernetes_api_agent],
-                               tasks=[kubernetes_api_task],
-                               verbose=True)
-
-    result = kubernetes_api_crew.kickoff(inputs={
-        'request_type': request.method,
-        'api_endpoint': request.path
+    # Well-known kinds come from local templates, the LLM handles the rest
+    generated = template_generator.generate(method, path)
+    if generated is not None:
+        return json.dumps(generated)
+
+    result = crew_pool.kickoff({
+        'request_type': method,
+        'api_endpoint': path
     })
 
     return result.raw
@@ -106,13 +133,16 @@ def markdown_json_to_dict(markdown_json):
     """
     Converts a Markdown JSON code block into a Python dictionary.
     """
+    started = perf_counter()
     # Remove Markdown code block markers
     cleaned_json = re.sub(r"```(?:json)?\n?|```$", "", markdown_json)
 
     try:
         # Parse the JSON string into a Python dictionary
         data = json.loads(cleaned_json)
+        json_extract_seconds.observe(perf_counter() - started, 'ok')
         return data
     except json.JSONDecodeError as e:
+        json_extract_seconds.observe(perf_counter() - started, 'error')
         print(f"Error decoding JSON: {e}")
         return None  # Or raise an exception if you prefer
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import os
+import queue
+from time import monotonic
+
+from selector import Selector
+from store import object_store, parse_resource_path, guess_kind, api_version
+
+WATCH_TIMEOUT = float(os.getenv('WATCH_TIMEOUT', 1800))
+WATCH_BOOKMARK_INTERVAL = float(os.getenv('WATCH_BOOKMARK_INTERVAL', 60))
+WATCH_QUEUE_SIZE = int(os.getenv('WATCH_QUEUE_SIZE', 1000))
+WATCH_MAX = int(os.getenv('WATCH_MAX', 10000))
+# Each watch on the threaded Flask server holds a worker thread until it
+# ends, so there watches are refused unless this is set
+WATCH_THREADED = os.getenv('WATCH_THREADED', 'false').lower() in ('true', '1')
+
+
+def is_watch(query_args):
+    return query_args.get('watch', '').lower() in ('true', '1')
+
+
+class WatchParams:
+    """The query parameters of a ?watch=true request"""
+
+    def __init__(self, query_args, deadline=None):
+        self.resource_version = query_args.get('resourceVersion')
+        self.bookmarks = query_args.get('allowWatchBookmarks',
+                                        '').lower() in ('true', '1')
+        timeout = WATCH_TIMEOUT
+        if query_args.get('timeoutSeconds'):
+            timeout = min(timeout, float(query_args['timeoutSeconds']))
+        if deadline is not None and deadline.remaining() is not None:
+            timeout = min(timeout, deadline.remaining())
+        self.timeout = timeout
+        # Raises SelectorError (a ValueError) for a malformed selector
+        selector = Selector.from_args(query_args)
+        self.matches = selector.matches if selector is not None else None
+
+
+def encode_event(event):
+    return json.dumps(event).encode() + b'\n'
+
+
+def bookmark_event(api_path, resource_version):
+    ref = parse_resource_path(api_path)
+    return {
+        'type': 'BOOKMARK',
+        'object': {
+            'kind': guess_kind(ref.resource),
+            'apiVersion': api_version(ref),
+            'metadata': {
+                'resourceVersion': resource_version
+            }
+        }
+    }
+
+
+def can_watch():
+    return object_store.watchers < WATCH_MAX
+
+
+def watch_events(auth_token, api_path, params):
+    """
+    Generator of NDJSON watch events for the threaded Flask server, only
+    used with WATCH_THREADED. Each open watch blocks its worker thread; the
+    asyncio mode in asgi.py uses async_watch_events instead.
+    """
+    events = queue.Queue(maxsize=WATCH_QUEUE_SIZE)
+    overflow = []
+
+    def notify(event):
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            overflow.append(True)
+
+    watcher, initial = object_store.watch(auth_token, api_path,
+                                          params.resource_version, notify,
+                                          params.matches)
+    try:
+        for event in initial:
+            yield encode_event(event)
+        if watcher is None:
+            return
+
+        ends_at = monotonic() + params.timeout
+        while not overflow:
+            remaining = ends_at - monotonic()
+            if remaining <= 0:
+                return
+            wait = min(remaining, WATCH_BOOKMARK_INTERVAL) if params.bookmarks else remaining
+            try:
+                yield encode_event(events.get(timeout=wait))
+            except queue.Empty:
+                if params.bookmarks:
+                    yield encode_event(
+                        bookmark_event(api_path,
+                                       object_store.resource_version(auth_token)))
+    finally:
+        if watcher is not None:
+            object_store.unwatch(auth_token, watcher)
+
+
+async def async_watch_events(auth_token, api_path, params, executor=None):
+    """
+    Async generator of NDJSON watch events. Idle watchers only hold an
+    asyncio queue; store changes are handed over to the event loop. The
+    watch is set up on `executor`, as it may read from the database.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=WATCH_QUEUE_SIZE)
+    overflow = []
+
+    def put(event):
+        try:
+            events.put_nowait(event)
+        except asyncio.QueueFull:
+            overflow.append(True)
+
+    def notify(event):
+        loop.call_soon_threadsafe(put, event)
+
+    watcher, initial = await loop.run_in_executor(
+        executor, object_store.watch, auth_token, api_path,
+        params.resource_version, notify, params.matches)
+    try:
+        for event in initial:
+            yield encode_event(event)
+        if watcher is None:
+            return
+
+        ends_at = loop.time() + params.timeout
+        while not overflow:
+            remaining = ends_at - loop.time()
+            if remaining <= 0:
+                return
+            wait = min(remaining, WATCH_BOOKMARK_INTERVAL) if params.bookmarks else remaining
+            try:
+                yield encode_event(await asyncio.wait_for(events.get(), wait))
+            except asyncio.TimeoutError:
+                if params.bookmarks:
+                    yield encode_event(
+                        bookmark_event(api_path,
+                                       object_store.resource_version(auth_token)))
+    finally:
+        if watcher is not None:
+            object_store.unwatch(auth_token, watcher)
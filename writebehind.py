@@ -0,0 +1,246 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import uuid
+from time import monotonic, sleep
+
+from breaker import DATABASE_ERRORS, CircuitOpenError, db_breaker
+from models import db, APICache, CacheInvalidation
+
+logger = logging.getLogger(__name__)
+
+
+def _split_env(name, default):
+    return [v.strip() for v in os.getenv(name, default).split(',') if v.strip()]
+
+
+class PersistPolicy:
+    """Decide which generated responses are worth storing in APICache"""
+
+    def __init__(self, methods, path_prefixes, exclude_prefixes,
+                 skip_query_params):
+        self.methods = {m.upper() for m in methods}
+        self.path_prefixes = tuple(path_prefixes)
+        self.exclude_prefixes = tuple(exclude_prefixes)
+        self.skip_query_params = set(skip_query_params)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            methods=_split_env('PERSIST_METHODS', 'GET'),
+            path_prefixes=_split_env('PERSIST_PATH_PREFIXES',
+                                     '/api,/apis,/openapi,/version'),
+            exclude_prefixes=_split_env('PERSIST_EXCLUDE_PREFIXES', ''),
+            skip_query_params=_split_env('PERSIST_SKIP_QUERY_PARAMS',
+                                         'labelSelector,fieldSelector,watch'))
+
+    def should_persist(self, method, path, query_args=None):
+        if method.upper() not in self.methods:
+            return False
+        if not path.startswith(self.path_prefixes):
+            return False
+        if self.exclude_prefixes and path.startswith(self.exclude_prefixes):
+            return False
+        if query_args and self.skip_query_params.intersection(query_args):
+            return False
+        return True
+
+
+class WriteBehindQueue:
+    """
+    Background writer that batches APICache inserts and the cache changes
+    accepted while the database was down.
+
+    Requests only enqueue rows; a daemon thread drains the queue and commits
+    them in batches, so no HTTP response waits on the database. While the
+    database is down the current batch is held and retried, and new rows
+    queue up to `max_queue`.
+    """
+
+    def __init__(self, batch_size=50, flush_interval=0.5, max_queue=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.app = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.pending = []
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self.flush)
+
+    def _ensure_worker(self):
+        # Started lazily so every forked gunicorn worker gets its own thread
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run,
+                                           name='cache-write-behind',
+                                           daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def _user_row(user_token, api_path, response):
+        return {
+            'cache_id': uuid.uuid4(),
+            'user_token': uuid.UUID(str(user_token)),
+            'api_path': api_path,
+            'response': response,
+            'is_predefined': False
+        }
+
+    def enqueue(self, user_token, api_path, response, invalidate=False):
+        """
+        Queue a user cache row; returns its cache_id, or None if the queue
+        is full. With invalidate the path is also added to the cache
+        invalidation log, for entries that replace what workers may hold.
+        """
+        self._ensure_worker()
+        row = self._user_row(user_token, api_path, response)
+        kind = 'entry' if invalidate else 'cache'
+        return row['cache_id'] if self._put(kind, row, api_path) else None
+
+    def enqueue_upsert(self, user_token, api_path, response):
+        """
+        Queue a user cache row that replaces the user's other entries for
+        the path, as POST /cache/bulk does; False if the queue is full
+        """
+        self._ensure_worker()
+        row = self._user_row(user_token, api_path, response)
+        return self._put('upsert', row, api_path)
+
+    def enqueue_delete(self, user_token, cache_id):
+        """
+        Queue the deletion of a user's cache entry; entries of other users
+        and predefined ones are left alone. False if the queue is full.
+        """
+        self._ensure_worker()
+        row = {
+            'cache_id': uuid.UUID(str(cache_id)),
+            'user_token': uuid.UUID(str(user_token))
+        }
+        return self._put('delete', row, f'deletion of {cache_id}')
+
+    def _put(self, kind, row, description):
+        try:
+            self.queue.put_nowait((kind, row))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Write-behind queue full, dropping {description}")
+            return False
+
+    def _next_batch(self, block=True):
+        batch = []
+        try:
+            batch.append(self.queue.get(block=block))
+        except queue.Empty:
+            return batch
+
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Write a batch; returns False if it should be retried later"""
+        with self.app.app_context():
+            try:
+                with db_breaker.guard():
+                    for kind, row in batch:
+                        if kind == 'upsert':
+                            db.session.execute(db.delete(APICache).where(
+                                APICache.user_token == row['user_token'],
+                                APICache.is_predefined == False,
+                                APICache.api_path == row['api_path']))
+                        if kind in ('cache', 'entry', 'upsert'):
+                            db.session.add(APICache(**row))
+                        if kind in ('entry', 'upsert'):
+                            db.session.add(CacheInvalidation(
+                                user_token=row['user_token'],
+                                api_path=row['api_path']))
+                        elif kind == 'delete':
+                            api_paths = db.session.execute(
+                                db.delete(APICache).where(
+                                    APICache.cache_id == row['cache_id'],
+                                    APICache.user_token == row['user_token'],
+                                    APICache.is_predefined == False).returning(
+                                        APICache.api_path)).scalars().all()
+                            for api_path in api_paths:
+                                db.session.add(CacheInvalidation(
+                                    user_token=row['user_token'],
+                                    api_path=api_path))
+                    db.session.commit()
+                self.written += len(batch)
+            except (CircuitOpenError,) + DATABASE_ERRORS as e:
+                db.session.rollback()
+                logger.warning(f"Database unavailable, holding {len(batch)} "
+                               f"rows for retry: {str(e)}")
+                return False
+            except Exception as e:
+                db.session.rollback()
+                self.failed += len(batch)
+                logger.error(f"Error persisting generated responses: {str(e)}")
+        return True
+
+    def _run(self):
+        while True:
+            if self.pending:
+                if db_breaker.is_open():
+                    sleep(1)
+                    continue
+                batch, self.pending = self.pending, []
+            else:
+                batch = self._next_batch()
+            if batch and not self._write(batch):
+                self.pending = batch
+                sleep(1)
+
+    def flush(self):
+        """Synchronously write whatever is still queued"""
+        if self.app is None:
+            return
+        if self.pending:
+            batch, self.pending = self.pending, []
+            if not self._write(batch):
+                self.failed += len(batch)
+                return
+        while True:
+            batch = self._next_batch(block=False)
+            if not batch:
+                return
+            if not self._write(batch):
+                self.failed += len(batch) + self.queue.qsize()
+                return
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'pending_retry': len(self.pending),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+
+persist_policy = PersistPolicy.from_env()
+persist_queue = WriteBehindQueue(
+    batch_size=int(os.getenv('PERSIST_BATCH_SIZE', 50)),
+    flush_interval=float(os.getenv('PERSIST_FLUSH_INTERVAL', 0.5)),
+    max_queue=int(os.getenv('PERSIST_QUEUE_SIZE', 10000)))